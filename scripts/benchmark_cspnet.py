@@ -0,0 +1,141 @@
+import time
+import json
+import argparse
+import resource
+import multiprocessing as mp
+
+import numpy as np
+import torch
+
+import sys
+sys.path.append('.')
+from symmcd.pl_modules.cspnet import CSPNet, N_AXES, N_SS
+
+# decoder settings of conf/model/decoder/cspnet.yaml with the discrete site symmetry model
+DECODER_KWARGS = dict(
+    network='gnn', hidden_dim=1024, latent_dim=256, time_dim=256, num_layers=8, max_atoms=95,
+    act_fn='silu', dis_emb='sin', num_freqs=128, edge_style='fc', ln=True, ip=True, use_ks=False,
+    use_site_symm=True, smooth=True, pred_type=True, pred_site_symm_type=True,
+    site_symm_matrix_embed=True, mask_token=True)
+
+
+def parse_variant(spec):
+    # name:key=value,key=value, values are parsed as json (true/false/numbers)
+    name, _, options = spec.partition(':')
+    kwargs = {}
+    for option in filter(None, options.split(',')):
+        key, value = option.split('=')
+        kwargs[key] = json.loads(value)
+    return name, kwargs
+
+
+def make_inputs(args, batch_size, num_atoms, device):
+    generator = torch.Generator().manual_seed(args.seed)
+    num_atoms = torch.full((batch_size,), num_atoms, dtype=torch.long)
+    num_nodes = int(num_atoms.sum())
+    lattices = torch.eye(3).repeat(batch_size, 1, 1) * 5. + torch.rand(batch_size, 3, 3, generator=generator)
+    inputs = dict(
+        t=torch.randn(batch_size, DECODER_KWARGS['time_dim'], generator=generator),
+        atom_types=torch.softmax(torch.randn(num_nodes, DECODER_KWARGS['max_atoms'], generator=generator), dim=-1),
+        frac_coords=torch.rand(num_nodes, 3, generator=generator),
+        lattice_feats=lattices,
+        lattices=lattices,
+        num_atoms=num_atoms,
+        node2graph=torch.arange(batch_size).repeat_interleave(num_atoms),
+        site_symm_probs=torch.softmax(torch.randn(num_nodes, N_AXES * (N_SS + 1), generator=generator), dim=-1),
+    )
+    return {k: v.to(device) for k, v in inputs.items()}
+
+
+def run_variant(args, kwargs, batch_size, num_atoms, device, queue):
+    torch.manual_seed(args.seed)
+    model = CSPNet(**{**DECODER_KWARGS, 'num_layers': args.num_layers, 'hidden_dim': args.hidden_dim, **kwargs}).to(device)
+    inputs = make_inputs(args, batch_size, num_atoms, device)
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    times = []
+    try:
+        for i in range(args.warmup + args.iters):
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            start = time.perf_counter()
+            outputs = model(**inputs)
+            if not args.forward_only:
+                sum(out.float().pow(2).mean() for out in outputs).backward()
+                model.zero_grad(set_to_none=True)
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            if i >= args.warmup:
+                times.append(time.perf_counter() - start)
+    except torch.cuda.OutOfMemoryError:
+        queue.put({'oom': True})
+        return
+    if device.type == 'cuda':
+        peak_memory_mb = torch.cuda.max_memory_allocated(device) / 2 ** 20
+    else:
+        # ru_maxrss is in kB on linux, this is the peak of the whole worker process
+        peak_memory_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+    with torch.no_grad():
+        outputs = [out.detach().cpu() for out in model(**inputs)]
+    queue.put({
+        'time_per_iter_s': float(np.mean(times)),
+        'crystals_per_s': args.batch_size / float(np.mean(times)),
+        'peak_memory_mb': peak_memory_mb,
+        'outputs': outputs,
+    })
+
+
+def main(args):
+    device = torch.device('cuda' if torch.cuda.is_available() and not args.cpu else 'cpu')
+    # every variant runs in its own process so that peak memory is measured in isolation
+    ctx = mp.get_context('spawn')
+    results = {}
+    for batch_size in args.batch_size:
+        for num_atoms in args.num_atoms:
+            setting = f'batch_size={batch_size},num_atoms={num_atoms}'
+            results[setting] = {}
+            reference = None
+            for spec in args.variants:
+                name, kwargs = parse_variant(spec)
+                queue = ctx.Queue()
+                process = ctx.Process(target=run_variant, args=(args, kwargs, batch_size, num_atoms, device, queue))
+                process.start()
+                result = queue.get()
+                process.join()
+                if not result.get('oom', False):
+                    outputs = result.pop('outputs')
+                    if reference is None:
+                        reference = outputs
+                    result['max_abs_diff_vs_first'] = max(float((a - b).abs().max()) for a, b in zip(reference, outputs))
+                result['kwargs'] = kwargs
+                results[setting][name] = result
+                print(setting, name, {k: v for k, v in result.items() if k != 'kwargs'})
+
+    report = {'device': str(device), 'batch_size': args.batch_size, 'num_atoms': args.num_atoms,
+              'num_layers': args.num_layers, 'hidden_dim': args.hidden_dim, 'results': results}
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--variants', nargs='+',
+                        default=['concat:factorize_edge_mlp=false', 'factorized:factorize_edge_mlp=true'],
+                        help='name:key=value,... CSPNet keyword overrides, the first one is the reference, '
+                             'e.g. base:factorize_edge_mlp=false,fused_dis_emb=false fast:factorize_edge_mlp=true,fused_dis_emb=true '
+                             'or, for memory, base: ckpt:checkpoint_layers=true chunked:edge_chunk_size=65536')
+    parser.add_argument('--batch_size', nargs='+', default=[32], type=int, help='every combination with --num_atoms is run')
+    parser.add_argument('--num_atoms', nargs='+', default=[20], type=int)
+    parser.add_argument('--num_layers', default=DECODER_KWARGS['num_layers'], type=int)
+    parser.add_argument('--hidden_dim', default=DECODER_KWARGS['hidden_dim'], type=int)
+    parser.add_argument('--iters', default=10, type=int)
+    parser.add_argument('--warmup', default=2, type=int)
+    parser.add_argument('--forward_only', action='store_true')
+    parser.add_argument('--cpu', action='store_true')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--out', default=None, help='optional json report')
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,143 @@
+import sys
+import json
+import math
+import argparse
+import platform
+import subprocess
+from collections import defaultdict
+from pathlib import Path
+from statistics import median
+
+# evaluation and visualization stacks, none of them should be imported by training or sampling
+EVAL_MODULES = ['matminer', 'nglview', 'smact', 'scripts.compute_metrics', 'scripts.generation']
+
+# module -> (import time budget in seconds, modules it must not import), every module made to import its evaluation
+# dependencies lazily. The budgets are loose upper bounds that have not been calibrated on the training environment
+# yet, run with --calibrate there and replace them with the printed values
+BUDGETS = {
+    'symmcd.common.utils': (5., EVAL_MODULES + ['scripts.eval_utils']),
+    'symmcd.common.data_utils': (10., EVAL_MODULES + ['scripts.eval_utils']),
+    'symmcd.pl_modules.cspnet': (10., EVAL_MODULES + ['scripts.eval_utils']),
+    'symmcd.pl_modules.model': (15., EVAL_MODULES + ['scripts.eval_utils']),
+    'symmcd.pl_modules.diffusion': (15., EVAL_MODULES + ['scripts.eval_utils']),
+    'symmcd.pl_modules.diffusion_w_type': (15., EVAL_MODULES + ['scripts.eval_utils']),
+    'symmcd.pl_modules.discrete_diffusion_w_site_symm': (15., EVAL_MODULES + ['scripts.eval_utils']),
+    'symmcd.pl_modules.diffusion_w_site_symm': (15., EVAL_MODULES + ['scripts.eval_utils']),
+    'symmcd.pl_data.datamodule': (15., EVAL_MODULES + ['scripts.eval_utils']),
+    'symmcd.common.async_gen_eval': (10., EVAL_MODULES + ['scripts.eval_utils']),
+    'scripts.eval_utils': (15., ['matminer', 'nglview', 'smact', 'scripts.compute_metrics']),
+    'scripts.compute_metrics': (20., ['matminer', 'nglview', 'smact']),
+}
+
+IMPORT_CODE = '''
+import sys, json, resource
+sys.path.insert(0, '.')
+import {module}
+print(json.dumps({{'maxrss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10,
+                  'modules': sorted(sys.modules)}}))
+'''
+
+
+def parse_importtime(stderr):
+    # lines of -X importtime: "import time: self [us] | cumulative | imported package", nested imports are indented
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+class ImportFailed(Exception):
+    pass
+
+
+def import_once(module):
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', IMPORT_CODE.format(module=module)],
+                         capture_output=True, text=True)
+    if out.returncode != 0:
+        raise ImportFailed(out.stderr.strip().splitlines()[-1])
+    result = json.loads(out.stdout.strip().splitlines()[-1])
+    result['times'] = parse_importtime(out.stderr)
+    return result
+
+
+def measure(module, repeats, top):
+    """
+    Import time of module in fresh processes (median over repeats), its peak RSS, the top level packages taking the
+    most time (self times summed per package) and every module loaded with it.
+    """
+    runs = [import_once(module) for _ in range(repeats)]
+    package_s = defaultdict(list)
+    for run in runs:
+        per_package = defaultdict(float)
+        for name, (self_us, _) in run['times'].items():
+            per_package[name.split('.')[0]] += self_us / 1e6
+        for package, seconds in per_package.items():
+            package_s[package].append(seconds)
+    package_s = {package: float(median(seconds)) for package, seconds in package_s.items()}
+    return {
+        'import_s': float(median([run['times'].get(module, (0, 0))[1] / 1e6 for run in runs])),
+        'maxrss_mb': float(median([run['maxrss_mb'] for run in runs])),
+        'num_modules': len(runs[0]['modules']),
+        'top_packages_s': dict(sorted(package_s.items(), key=lambda item: -item[1])[:top]),
+        'modules': runs[0]['modules'],
+    }
+
+
+def main(args):
+    modules = args.modules or list(BUDGETS)
+    report = {'python': sys.version, 'machine': platform.platform(), 'results': {}}
+    failed = []
+    for module in modules:
+        budget_s, forbidden = BUDGETS.get(module, (None, EVAL_MODULES))
+        budget_s = args.budget_s if args.budget_s is not None else budget_s
+        try:
+            result = measure(module, args.repeats, args.top)
+        except ImportFailed as e:
+            # a module that cannot be imported is not within its budget
+            failed.append(module)
+            report['results'][module] = {'budget_s': budget_s, 'error': str(e), 'passed': False}
+            print(f'{module}: import failed, {e}')
+            continue
+        loaded = result.pop('modules')
+        result['budget_s'] = budget_s
+        result['forbidden_loaded'] = sorted(name for name in loaded
+                                            if any(name == f or name.startswith(f + '.') for f in forbidden))
+        result['passed'] = (budget_s is None or result['import_s'] <= budget_s) and len(result['forbidden_loaded']) == 0
+        if not result['passed']:
+            failed.append(module)
+        report['results'][module] = result
+        budget = f'{budget_s}s' if budget_s is not None else 'none'
+        print(f"{module}: {result['import_s']:.2f}s (budget {budget}), {result['maxrss_mb']:.0f} MB, "
+              f"{result['num_modules']} modules, forbidden {result['forbidden_loaded'] or 'none'}")
+    report['failed'] = failed
+    if args.calibrate is not None:
+        # budgets of the measured import times with a margin, rounded up to half seconds, to paste into BUDGETS
+        print('calibrated budgets:')
+        for module, result in report['results'].items():
+            if 'import_s' in result:
+                print(f"    '{module}': {math.ceil(2 * result['import_s'] * args.calibrate) / 2},")
+    if args.out is not None:
+        Path(args.out).write_text(json.dumps(report, indent=2))
+    if len(failed) > 0:
+        print(f'Over budget, importing evaluation modules or failing to import: {failed}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Import time (python -X importtime) and RSS of the entry modules in fresh processes, '
+                    'exits with 1 when one is over its budget or imports an evaluation stack')
+    parser.add_argument('--modules', nargs='+', default=None, help='modules to import, those of BUDGETS by default')
+    parser.add_argument('--budget_s', default=None, type=float, help='one budget for every module instead of BUDGETS')
+    parser.add_argument('--repeats', default=3, type=int)
+    parser.add_argument('--top', default=10, type=int, help='number of packages listed per module')
+    parser.add_argument('--out', default=None, help='optional json report')
+    parser.add_argument('--calibrate', default=None, type=float, metavar='MARGIN',
+                        help='also print budgets of MARGIN times the measured import times (e.g. 1.5)')
+
+    args = parser.parse_args()
+
+    main(args)
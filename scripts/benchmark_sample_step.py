@@ -0,0 +1,121 @@
+import time
+import json
+import argparse
+
+import numpy as np
+import torch
+import hydra
+from hydra import compose, initialize_config_dir
+from torch_geometric.data import Data, Batch
+
+import sys
+sys.path.append('.')
+from symmcd.common.utils import PROJECT_ROOT
+from symmcd.pl_modules.discrete_diffusion_w_site_symm import SG_CONDITION_DIM
+
+
+def build_model(args, device):
+    # randomly initialized discrete site symmetry model, the masked prior needs no marginals from a dataset
+    hydra.core.global_hydra.GlobalHydra.instance().clear()
+    with initialize_config_dir(str(PROJECT_ROOT / 'conf')):
+        cfg = compose(config_name='default', overrides=[
+            'model=discrete_diffusion_w_site_symm', 'model.prior=masked', f'model.timesteps={args.timesteps}',
+            f'model.decoder.hidden_dim={args.hidden_dim}', f'model.decoder.num_layers={args.num_layers}'])
+    model = hydra.utils.instantiate(cfg.model, optim=cfg.optim, data=cfg.data, logging=cfg.logging, _recursive_=False)
+    return model.to(device).eval()
+
+
+def make_batch(args, device):
+    generator = torch.Generator().manual_seed(args.seed)
+    data_list = []
+    for _ in range(args.batch_size):
+        data_list.append(Data(
+            num_atoms=torch.LongTensor([args.num_atoms]),
+            num_nodes=args.num_atoms,
+            spacegroup=int(torch.randint(1, 231, (1,), generator=generator)),
+            sg_condition=(torch.rand(1, SG_CONDITION_DIM, generator=generator) > 0.5).float(),
+        ))
+    return Batch.from_data_list(data_list).to(device)
+
+
+def time_steps(step, state, ctx, timesteps, args):
+    times = []
+    outputs = None
+    for i in range(args.warmup + args.steps):
+        t = timesteps[args.timesteps - i % (args.timesteps - 1)]
+        torch.manual_seed(args.seed + i)
+        start = time.perf_counter()
+        out = step(t, *state, ctx)
+        if timesteps.is_cuda:
+            torch.cuda.synchronize()
+        if i >= args.warmup:
+            times.append(time.perf_counter() - start)
+        if i == 0:
+            outputs = [x.detach().cpu() for x in out]
+    return times, outputs
+
+
+@torch.no_grad()
+def main(args):
+    device = torch.device('cuda' if torch.cuda.is_available() and not args.cpu else 'cpu')
+    torch.manual_seed(args.seed)
+    model = build_model(args, device)
+    batch = make_batch(args, device)
+    state, ctx = model.init_sample(batch, args.step_lr)
+    timesteps = torch.arange(args.timesteps + 1, device=device)
+    # the compiled step draws the same random numbers as the eager one, so that the outputs can be compared
+    torch._inductor.config.fallback_random = True
+
+    results = {}
+    reference = None
+    for mode in args.modes:
+        if mode == 'eager':
+            step = model.sample_step
+        elif mode == 'compile':
+            step = torch.compile(model.sample_step, dynamic=False)
+        elif mode == 'cuda_graph':
+            step = model.capture_sample_step(state, ctx)
+        start = time.perf_counter()
+        times, outputs = time_steps(step, state, ctx, timesteps, args)
+        total = time.perf_counter() - start
+        result = {
+            'time_per_step_s': float(np.mean(times)),
+            'first_steps_s': total - float(np.sum(times)),
+            'crystals_per_s': args.batch_size / float(np.mean(times)),
+        }
+        if reference is None:
+            reference = outputs
+        else:
+            # lattice / coordinates, and the fraction of sampled atom types and site symmetries that agree
+            result['max_abs_diff_vs_first'] = max(float((a - b).abs().max()) for a, b in zip(reference[:3], outputs[:3]))
+            result['discrete_agreement_vs_first'] = min(float((a == b).all(-1).float().mean()) for a, b in zip(reference[3:], outputs[3:]))
+        results[mode] = result
+        print(mode, result)
+
+    report = {'device': str(device), 'torch': torch.__version__, 'batch_size': args.batch_size,
+              'num_atoms': args.num_atoms, 'num_layers': args.num_layers, 'hidden_dim': args.hidden_dim,
+              'results': results}
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modes', nargs='+', default=['eager', 'compile'], choices=['eager', 'compile', 'cuda_graph'],
+                        help='the first one is the reference for the output comparison')
+    parser.add_argument('--batch_size', default=16, type=int)
+    parser.add_argument('--num_atoms', default=20, type=int)
+    parser.add_argument('--num_layers', default=4, type=int)
+    parser.add_argument('--hidden_dim', default=256, type=int)
+    parser.add_argument('--timesteps', default=1000, type=int)
+    parser.add_argument('--steps', default=20, type=int)
+    parser.add_argument('--warmup', default=3, type=int, help='steps excluded from the timing, they include the compilation')
+    parser.add_argument('--step_lr', default=1e-5, type=float)
+    parser.add_argument('--cpu', action='store_true')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--out', default=None, help='optional json report')
+
+    args = parser.parse_args()
+
+    main(args)
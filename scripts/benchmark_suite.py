@@ -0,0 +1,320 @@
+import os
+import sys
+import time
+import json
+import platform
+import argparse
+import subprocess
+import warnings
+from datetime import datetime
+
+import numpy as np
+import torch
+import hydra
+from hydra import compose, initialize_config_dir
+from torch_geometric.data import Data, Batch
+from pyxtal import pyxtal
+from pyxtal.symmetry import Group
+from pymatgen.core.periodic_table import Element
+
+sys.path.append('.')
+from symmcd.common.utils import PROJECT_ROOT
+from symmcd.common.data_utils import (
+    lattice_ks_to_matrix_torch, lattice_params_to_matrix_torch, radius_graph_pbc,
+    min_distance_sqr_pbc, process_one, get_spacegroup_binary_repr)
+from symmcd.pl_modules.cspnet import CSPNet, N_AXES, N_SS
+from symmcd.pl_modules.discrete_diffusion_w_site_symm import modify_frac_coords
+from scripts.benchmark_cspnet import DECODER_KWARGS
+from scripts.symmetry_utils import SymmetryService
+from scripts.compute_metrics import Crystal, GenEval
+
+warnings.simplefilter('ignore')
+
+# a spread of crystal systems, from triclinic to cubic
+SPACEGROUPS = [1, 2, 12, 14, 62, 63, 139, 166, 194, 221, 225, 227]
+ELEMENTS = ['Li', 'O', 'Na', 'Mg', 'Al', 'Si', 'S', 'Cl', 'K', 'Ca', 'Ti', 'Fe', 'Cu', 'Zn', 'Sr', 'Ba']
+MODELS = ['diffusion', 'diffusion_w_type', 'diffusion_w_site_symm', 'discrete_diffusion_w_site_symm']
+
+
+def random_crystals(num_crystals, max_atoms, seed):
+    """
+    Synthetic crystals from pyxtal: a random space group of SPACEGROUPS, 1-3 elements, each on one Wyckoff position
+    (so that the asymmetric unit is known), and at most max_atoms atoms in the conventional cell.
+    """
+    rng = np.random.RandomState(seed)
+    np.random.seed(seed)
+    crystals = []
+    while len(crystals) < num_crystals:
+        group = Group(int(rng.choice(SPACEGROUPS)))
+        species = list(rng.choice(ELEMENTS, rng.randint(1, 4), replace=False))
+        wps = [wp for wp in group.Wyckoff_positions if wp.multiplicity <= max_atoms // len(species)]
+        if len(wps) == 0:
+            continue
+        num_ions = [wps[rng.randint(len(wps))].multiplicity for _ in species]
+        crystal = pyxtal()
+        try:
+            crystal.from_random(3, group.number, species, num_ions)
+        except Exception:
+            continue
+        if crystal.valid:
+            crystals.append(crystal)
+    return crystals
+
+
+def crystal_arrays(crystal):
+    structure = crystal.to_pymatgen()
+    return {
+        'frac_coords': structure.frac_coords,
+        'atom_types': np.array([site.specie.Z for site in structure]),
+        'lengths': np.array(structure.lattice.abc),
+        'angles': np.array(structure.lattice.angles),
+        'spacegroups': crystal.group.number,
+    }
+
+
+def crystal_batch(crystals):
+    data_list = []
+    for crystal in crystals:
+        arrays = crystal_arrays(crystal)
+        num_atoms = len(arrays['atom_types'])
+        lengths = torch.tensor(arrays['lengths'], dtype=torch.float).view(1, -1)
+        angles = torch.tensor(arrays['angles'], dtype=torch.float).view(1, -1)
+        data_list.append(Data(
+            frac_coords=torch.tensor(arrays['frac_coords'], dtype=torch.float),
+            atom_types=torch.LongTensor(arrays['atom_types']),
+            lengths=lengths,
+            angles=angles,
+            num_atoms=num_atoms,
+            num_nodes=num_atoms,
+            spacegroup=crystal.group.number,
+            sg_condition=get_spacegroup_binary_repr(crystal.group.number).float().view(1, -1),
+        ))
+    return Batch.from_data_list(data_list)
+
+
+def asymmetric_unit(crystals):
+    # representatives, site symmetries and atom types as predicted by the site symmetry models
+    frac_coords, site_symm, atom_types, num_repr = [], [], [], []
+    for crystal in crystals:
+        for site in crystal.atom_sites:
+            site.wp.get_site_symmetry()
+            frac_coords.append(site.position)
+            site_symm.append(site.wp.get_site_symmetry_object().to_one_hot().flatten())
+            atom_types.append(site.specie)
+        num_repr.append(len(crystal.atom_sites))
+    traj = {
+        'frac_coords': torch.tensor(np.array(frac_coords), dtype=torch.float),
+        'site_symm': torch.tensor(np.array(site_symm), dtype=torch.float),
+        'atom_types': torch.LongTensor([Element(specie).Z for specie in atom_types]),
+    }
+    return traj, torch.LongTensor([c.group.number for c in crystals]), torch.LongTensor(num_repr)
+
+
+def measure(fn, args):
+    for _ in range(args.warmup):
+        fn()
+    times = []
+    for _ in range(args.iters):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {'mean_s': float(np.mean(times)), 'std_s': float(np.std(times)), 'min_s': float(np.min(times)),
+            'iters': args.iters}
+
+
+def build_model(name, args):
+    # randomly initialized, with a single timestep so that sample() is one step with its set up and post-processing
+    hydra.core.global_hydra.GlobalHydra.instance().clear()
+    overrides = [f'model={name}', 'model.timesteps=1', f'model.decoder.hidden_dim={args.hidden_dim}',
+                 f'model.decoder.num_layers={args.num_layers}']
+    if name == 'discrete_diffusion_w_site_symm':
+        overrides.append('model.prior=masked')
+    with initialize_config_dir(str(PROJECT_ROOT / 'conf')):
+        cfg = compose(config_name='default', overrides=overrides)
+    torch.manual_seed(args.seed)
+    model = hydra.utils.instantiate(cfg.model, optim=cfg.optim, data=cfg.data, logging=cfg.logging, _recursive_=False)
+    return model.eval()
+
+
+def bench_lattice(args, crystals):
+    for batch_size in [256, 4096]:
+        ks = torch.randn(batch_size, 6)
+        yield f'lattice_ks_to_matrix_torch[batch={batch_size}]', lambda: lattice_ks_to_matrix_torch(ks)
+
+
+def bench_radius_graph(args, crystals):
+    batch = crystal_batch(crystals)
+    lattices = lattice_params_to_matrix_torch(batch.lengths, batch.angles)
+    pos = torch.einsum('bi,bij->bj', batch.frac_coords, lattices.repeat_interleave(batch.num_atoms, dim=0))
+    yield f'radius_graph_pbc[batch={batch.num_graphs}]', lambda: radius_graph_pbc(
+        pos, batch.lengths, batch.angles, batch.num_atoms, 7., 20, device=pos.device)
+
+
+def bench_min_distance(args, crystals):
+    batch = crystal_batch(crystals)
+    lattices = lattice_params_to_matrix_torch(batch.lengths, batch.angles)
+    lattices = lattices.repeat_interleave(batch.num_atoms, dim=0)
+    cart_coords1 = torch.einsum('bi,bij->bj', batch.frac_coords, lattices)
+    cart_coords2 = torch.einsum('bi,bij->bj', torch.rand_like(batch.frac_coords), lattices)
+    yield f'min_distance_sqr_pbc[batch={batch.num_graphs}]', lambda: min_distance_sqr_pbc(
+        cart_coords1, cart_coords2, batch.lengths, batch.angles, batch.num_atoms, cart_coords1.device)
+
+
+def bench_cspnet(args, crystals):
+    for edge_style in ['fc', 'knn']:
+        torch.manual_seed(args.seed)
+        model = CSPNet(**{**DECODER_KWARGS, 'hidden_dim': args.hidden_dim, 'num_layers': args.num_layers,
+                          'edge_style': edge_style}).eval()
+        for batch_size in args.batch_sizes:
+            batch = crystal_batch([crystals[i % len(crystals)] for i in range(batch_size)])
+            num_nodes = batch.num_nodes
+            lattices = lattice_params_to_matrix_torch(batch.lengths, batch.angles)
+            inputs = dict(
+                t=torch.randn(batch_size, DECODER_KWARGS['time_dim']),
+                atom_types=torch.softmax(torch.randn(num_nodes, DECODER_KWARGS['max_atoms']), dim=-1),
+                frac_coords=batch.frac_coords, lattice_feats=lattices, lattices=lattices, num_atoms=batch.num_atoms,
+                node2graph=batch.batch, site_symm_probs=torch.softmax(torch.randn(num_nodes, N_AXES * (N_SS + 1)), dim=-1))
+            yield f'cspnet_forward[{edge_style},batch={batch_size}]', lambda model=model, inputs=inputs: model(**inputs)
+
+
+def bench_sample(args, crystals):
+    batch = crystal_batch(crystals)
+    for name in MODELS:
+        model = build_model(name, args)
+        yield f'sample_one_step[{name},batch={batch.num_graphs}]', lambda model=model: model.sample(batch, step_lr=1e-5)
+
+
+def bench_modify_frac_coords(args, crystals):
+    traj, spacegroups, num_repr = asymmetric_unit(crystals)
+    yield f'modify_frac_coords[crystals={len(crystals)}]', lambda: modify_frac_coords(
+        {k: v.clone() for k, v in traj.items()}, spacegroups, num_repr)
+
+
+def bench_process_one(args, crystals):
+    rows = [{'cif': c.to_pymatgen().to(fmt='cif'), 'material_id': str(i)} for i, c in enumerate(crystals[:args.num_eval_crystals])]
+    yield f'process_one[crystals={len(rows)}]', lambda: [
+        process_one(row, niggli=True, primitive=False, graph_method='crystalnn', prop_list=[], use_space_group=True)
+        for row in rows]
+
+
+def bench_gen_eval(args, crystals):
+    arrays = [crystal_arrays(c) for c in crystals[:args.num_eval_crystals]]
+    yield f'crystal_features[crystals={len(arrays)}]', lambda: Crystal.materialize(
+        [Crystal(dict(x)) for x in arrays], ['valid', 'comp_fp', 'struct_fp'], num_workers=1)
+    gt_crys = Crystal.materialize([Crystal(dict(x)) for x in arrays], ['valid', 'comp_fp', 'struct_fp'], num_workers=1)
+    yield f'gen_eval[crystals={len(arrays)}]', lambda: GenEval(
+        [Crystal(dict(x)) for x in arrays], gt_crys, n_samples=0, eval_model_name='mp20', num_workers=1,
+        symmetry_service=SymmetryService(symprec=0.1, num_workers=0),
+        metrics=['validity', 'density', 'num_elems', 'coverage', 'spacegroup']).get_metrics()
+
+
+BENCHMARKS = {
+    'lattice': bench_lattice,
+    'radius_graph': bench_radius_graph,
+    'min_distance': bench_min_distance,
+    'cspnet': bench_cspnet,
+    'sample': bench_sample,
+    'modify_frac_coords': bench_modify_frac_coords,
+    'process_one': bench_process_one,
+    'gen_eval': bench_gen_eval,
+}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=PROJECT_ROOT, text=True).strip()
+    except Exception:
+        return None
+
+
+def machine_info():
+    return {
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'torch_threads': torch.get_num_threads(),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'numpy': np.__version__,
+        'git_commit': git_commit(),
+        'date': datetime.now().isoformat(timespec='seconds'),
+    }
+
+
+@torch.no_grad()
+def run(args):
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    crystals = random_crystals(args.num_crystals, args.max_atoms, args.seed)
+    results = {}
+    for group in args.benchmarks:
+        for name, fn in BENCHMARKS[group](args, crystals):
+            torch.manual_seed(args.seed)
+            np.random.seed(args.seed)
+            results[name] = measure(fn, args)
+            print(f"{name}: {results[name]['mean_s'] * 1e3:.2f} ms")
+    report = {'machine': machine_info(), 'settings': {k: v for k, v in vars(args).items() if k != 'func'},
+              'results': results}
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    for key in ['processor', 'cpu_count', 'torch_threads', 'torch']:
+        if baseline['machine'].get(key) != candidate['machine'].get(key):
+            print(f"warning: {key} differs ({baseline['machine'].get(key)} vs {candidate['machine'].get(key)})")
+
+    regressions = []
+    print(f"{'benchmark':60s} {'baseline ms':>12s} {'candidate ms':>12s} {'ratio':>7s}")
+    for name in sorted(set(baseline['results']) & set(candidate['results'])):
+        # min over the iterations is the least noisy estimate on a shared machine
+        base = baseline['results'][name][args.stat]
+        new = candidate['results'][name][args.stat]
+        ratio = new / base
+        flag = ''
+        if ratio > 1 + args.threshold:
+            flag = 'REGRESSION'
+            regressions.append(name)
+        elif ratio < 1 - args.threshold:
+            flag = 'faster'
+        print(f'{name:60s} {base * 1e3:12.3f} {new * 1e3:12.3f} {ratio:7.2f} {flag}')
+    for name in sorted(set(baseline['results']) ^ set(candidate['results'])):
+        print(f'{name:60s} only in {"baseline" if name in baseline["results"] else "candidate"}')
+    if regressions:
+        print(f'{len(regressions)} regressions beyond {args.threshold:.0%}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(required=True)
+
+    run_parser = subparsers.add_parser('run', help='run the benchmarks on CPU and write a json report')
+    run_parser.add_argument('--benchmarks', nargs='+', default=list(BENCHMARKS), choices=list(BENCHMARKS))
+    run_parser.add_argument('--out', default='benchmark.json')
+    run_parser.add_argument('--num_crystals', default=32, type=int, help='synthetic crystals, i.e. the batch size')
+    run_parser.add_argument('--num_eval_crystals', default=16, type=int, help='crystals for process_one and the metrics')
+    run_parser.add_argument('--max_atoms', default=24, type=int)
+    run_parser.add_argument('--batch_sizes', nargs='+', default=[8, 64], type=int, help='for the CSPNet forward')
+    run_parser.add_argument('--hidden_dim', default=128, type=int)
+    run_parser.add_argument('--num_layers', default=2, type=int)
+    run_parser.add_argument('--iters', default=5, type=int)
+    run_parser.add_argument('--warmup', default=1, type=int)
+    run_parser.add_argument('--threads', default=None, type=int, help='torch threads, fixed for comparable runs')
+    run_parser.add_argument('--seed', default=0, type=int)
+    run_parser.set_defaults(func=run)
+
+    compare_parser = subparsers.add_parser('compare', help='compare two reports, exits with 1 on regressions')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+    compare_parser.add_argument('--threshold', default=0.1, type=float, help='relative slowdown reported as a regression')
+    compare_parser.add_argument('--stat', default='min_s', choices=['min_s', 'mean_s'])
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+
+    args.func(args)
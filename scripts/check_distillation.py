@@ -0,0 +1,112 @@
+import copy
+import argparse
+
+import torch
+import torch.nn.functional as F
+import pytorch_lightning as pl
+from torch_geometric.data import Data, DataLoader
+
+import sys
+sys.path.append('.')
+from scripts.benchmark_sample_step import build_model, make_batch
+from symmcd.common.data_utils import lattice_ks_to_matrix_torch
+from scripts.eval_utils import lattices_to_params_shape
+from symmcd.pl_modules.discrete_diffusion_w_site_symm import SITE_SYMM_AXES, SITE_SYMM_PGS, SG_CONDITION_DIM
+from symmcd.pl_modules.distillation import ProgressiveDistillation
+
+
+def training_crystals(args):
+    # random crystals with the fields noise_batch reads (asymmetric units with one-hot site symmetries)
+    generator = torch.Generator().manual_seed(args.seed)
+    data_list = []
+    for _ in range(args.num_crystals):
+        num_atoms = int(torch.randint(1, args.num_atoms + 1, (1,), generator=generator))
+        ks = torch.randn(1, 6, generator=generator) * 0.1
+        ks[:, 5] = torch.log(torch.tensor(20. * num_atoms)) / 3
+        lengths, angles = lattices_to_params_shape(lattice_ks_to_matrix_torch(ks))
+        site_symm = torch.randint(0, SITE_SYMM_PGS, (num_atoms, SITE_SYMM_AXES), generator=generator)
+        data_list.append(Data(
+            frac_coords=torch.rand(num_atoms, 3, generator=generator),
+            atom_types=torch.randint(1, 95, (num_atoms,), generator=generator),
+            site_symm=F.one_hot(site_symm, SITE_SYMM_PGS).float(),
+            lengths=lengths,
+            angles=angles,
+            ks=ks,
+            num_atoms=torch.LongTensor([num_atoms]),
+            num_nodes=num_atoms,
+            spacegroup=int(torch.randint(1, 231, (1,), generator=generator)),
+            sg_condition=(torch.rand(1, SG_CONDITION_DIM, generator=generator) > 0.5).float(),
+        ))
+    return data_list
+
+
+def fixed_loss(module, batch, seed):
+    torch.manual_seed(seed)
+    with torch.no_grad():
+        return float(module.distillation_loss(batch)['loss'])
+
+
+def main(args):
+    """
+    One stage of progressive distillation on CPU with a random masked prior model and random crystals: a few
+    training steps of the student through pl.Trainer, as in symmcd/distill.py, then sampling with half the steps.
+    Exits with 1 when a loss is not finite, the teacher changes, the student does not, or sampling fails.
+    """
+    torch.manual_seed(args.seed)
+    teacher = build_model(args, 'cpu')
+    student = copy.deepcopy(teacher)
+    teacher_state = copy.deepcopy(teacher.state_dict())
+    student_state = copy.deepcopy(student.state_dict())
+    module = ProgressiveDistillation(teacher, student, teacher_stride=1, lr=args.lr, step_lr=args.step_lr)
+    loader = DataLoader(training_crystals(args), batch_size=args.batch_size, shuffle=True)
+    fixed_batch = next(iter(DataLoader(training_crystals(args), batch_size=args.batch_size)))
+    failures = []
+
+    loss_before = fixed_loss(module, fixed_batch, args.seed)
+    trainer = pl.Trainer(accelerator='cpu', devices=1, max_steps=args.steps, limit_val_batches=0,
+                         num_sanity_val_steps=0, logger=False, enable_checkpointing=False, enable_progress_bar=False)
+    trainer.fit(model=module, train_dataloaders=loader)
+    loss_after = fixed_loss(module, fixed_batch, args.seed)
+    print(f'distillation loss on a fixed batch: {loss_before:.4f} before, {loss_after:.4f} after {args.steps} steps')
+    if not (torch.isfinite(torch.tensor(loss_before)) and torch.isfinite(torch.tensor(loss_after))):
+        failures.append('the distillation loss is not finite')
+    if trainer.global_step != args.steps:
+        failures.append(f'{trainer.global_step} training steps ran, expected {args.steps}')
+    if any(not torch.equal(v, teacher.state_dict()[k]) for k, v in teacher_state.items()):
+        failures.append('the teacher was updated')
+    if all(torch.equal(v, student.state_dict()[k]) for k, v in student_state.items()):
+        failures.append('the student was not updated')
+
+    num_steps = args.timesteps // 2
+    student.hparams.sample_steps = num_steps
+    student.eval()
+    with torch.no_grad():
+        outputs, _ = student.sample(make_batch(args, 'cpu'), step_lr=args.step_lr)
+    if not torch.isfinite(outputs['frac_coords']).all() or not torch.isfinite(outputs['lattices']).all():
+        failures.append(f'the student sampled non finite crystals with {num_steps} steps')
+    else:
+        print(f"the student sampled {len(outputs['num_atoms'])} crystals with {num_steps} steps")
+
+    for failure in failures:
+        print(failure)
+    if len(failures) > 0:
+        sys.exit(1)
+    print('distillation stage ran on CPU')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='CPU smoke check of progressive distillation (masked prior, random model)')
+    parser.add_argument('--num_crystals', default=16, type=int)
+    parser.add_argument('--batch_size', default=4, type=int)
+    parser.add_argument('--num_atoms', default=4, type=int)
+    parser.add_argument('--num_layers', default=1, type=int)
+    parser.add_argument('--hidden_dim', default=32, type=int)
+    parser.add_argument('--timesteps', default=8, type=int)
+    parser.add_argument('--steps', default=8, type=int, help='training steps of the student')
+    parser.add_argument('--lr', default=1e-3, type=float)
+    parser.add_argument('--step_lr', default=1e-5, type=float)
+    parser.add_argument('--seed', default=0, type=int)
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,72 @@
+import argparse
+
+import torch
+
+import sys
+sys.path.append('.')
+from scripts.benchmark_sample_step import build_model, make_batch
+from symmcd.pl_modules.continuous_sampler import ContinuousBatchSampler
+
+
+@torch.no_grad()
+def main(args):
+    """
+    A crystal whose atoms are all of the dummy type is flagged by degenerate_crystals, evicted without output by
+    ContinuousBatchSampler, and yields no outputs when it finishes. Exits with 1 otherwise.
+    """
+    torch.manual_seed(args.seed)
+    model = build_model(args, 'cpu')
+    batch = make_batch(args, 'cpu')
+    dummy = model.dummy_type()
+    failures = []
+
+    state, ctx = model.init_sample(batch, args.step_lr)
+    prob_a = torch.softmax(torch.randn(*ctx['node_mask'].shape, model.discrete_noise.max_atomic_num), dim=-1)
+    prob_a[0] = 0.
+    prob_a[0, :, dummy] = 1.
+    degenerate = model.degenerate_crystals(state, prob_a, 0, ctx)
+    if degenerate.tolist() != [True] + [False] * (args.batch_size - 1):
+        failures.append(f'degenerate_crystals flagged {degenerate.tolist()}, only the first crystal is all dummy')
+
+    sampler = ContinuousBatchSampler(model, batch.to_data_list(), args.batch_size, step_lr=args.step_lr,
+                                     max_admit=args.batch_size)
+    sampler.admit()
+    sampler.build_context()
+    degenerate = model.degenerate_crystals(sampler.state, prob_a, sampler.t, sampler.ctx,
+                                           collapse_t=model.beta_scheduler.timesteps)
+    finished, outputs = sampler.evict(degenerate)
+    if len(finished) > 0 or len(sampler.slots) != args.batch_size - 1 or sampler.counters['pruned'] != 1:
+        failures.append(f"evict kept {len(sampler.slots)} crystals and pruned {sampler.counters['pruned']}, "
+                        f"expected {args.batch_size - 1} and 1")
+
+    # the first remaining crystal finishes with only dummy atoms
+    sampler.build_context()
+    t_t = sampler.state[3]
+    first_nodes = sampler.batch.batch == 0
+    t_t[first_nodes] = 0.
+    t_t[first_nodes, dummy] = 1.
+    sampler.t[0] = 0
+    finished, outputs = sampler.evict()
+    if len(finished) != 1 or outputs is not None:
+        failures.append(f'an all dummy crystal finished with outputs {outputs is not None} ({len(finished)} finished)')
+
+    for failure in failures:
+        print(failure)
+    if len(failures) > 0:
+        sys.exit(1)
+    print('all dummy crystals are flagged and evicted')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check that all dummy crystals are pruned (masked prior, random model)')
+    parser.add_argument('--batch_size', default=3, type=int)
+    parser.add_argument('--num_atoms', default=4, type=int)
+    parser.add_argument('--num_layers', default=1, type=int)
+    parser.add_argument('--hidden_dim', default=32, type=int)
+    parser.add_argument('--timesteps', default=10, type=int)
+    parser.add_argument('--step_lr', default=1e-5, type=float)
+    parser.add_argument('--seed', default=0, type=int)
+
+    args = parser.parse_args()
+
+    main(args)
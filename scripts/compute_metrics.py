@@ -1,12 +1,14 @@
 from collections import Counter
+from collections.abc import Sequence
 import argparse
 import os
 import json
 import warnings
 import numpy as np
+from functools import partial, lru_cache
 from pathlib import Path
 from tqdm import tqdm
-from p_tqdm import p_map
+from p_tqdm import p_map, t_map
 from scipy.stats import wasserstein_distance
 import pandas as pd
 import torch
@@ -14,11 +16,6 @@ import torch
 from pymatgen.core.structure import Structure
 from pymatgen.core.composition import Composition
 from pymatgen.core.lattice import Lattice
-from pymatgen.analysis.structure_matcher import StructureMatcher
-from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
-from matminer.featurizers.site.fingerprint import CrystalNNFingerprint
-from matminer.featurizers.structure import SiteStatsFingerprint
-from matminer.featurizers.composition.composite import ElementProperty
 
 import sys
 sys.path.append('.')
@@ -33,20 +30,32 @@ from pyxtal import pyxtal
 import pickle
 
 warnings.simplefilter("ignore")
+from scripts.symmetry_utils import SymmetryService, get_spacegroup_number, structure_to_cell
+from scripts.structure_index import KEY_SYMPREC, StructureIndex, crystal_keys, unique_flags
+from scripts.gen_store import open_generation, generation_source
+from symmcd.common.profiling import PROFILER, timed
 from scripts.eval_utils import (
     smact_validity, structure_validity, CompScaler, get_fp_pdist,
     load_config, load_data, get_crystals_list, prop_model_eval, compute_cov)
 
 Crystal_Tol = 0.1
-CrystalNNFP = CrystalNNFingerprint.from_preset("ops")
-CrystalNNFP_full = SiteStatsFingerprint(
-    CrystalNNFingerprint.from_preset('ops'),
-    stats=('mean', 'maximum', 'minimum', 'std_dev'))
-CrystalNNFP_plus = SiteStatsFingerprint(
-    CrystalNNFingerprint.from_preset('ops'),
-    stats=('mean', 'maximum'))
 
-CompFP = ElementProperty.from_preset('magpie')
+
+@lru_cache(maxsize=None)
+def fingerprint_featurizers():
+    """
+    (CrystalNNFP, CrystalNNFP_full, CompFP): the CrystalNN site fingerprint, its site statistics and the magpie
+    composition featurizer. matminer and the presets are loaded on first use, not when this module is imported.
+    """
+    from matminer.featurizers.site.fingerprint import CrystalNNFingerprint
+    from matminer.featurizers.structure import SiteStatsFingerprint
+    from matminer.featurizers.composition.composite import ElementProperty
+    CrystalNNFP = CrystalNNFingerprint.from_preset("ops")
+    CrystalNNFP_full = SiteStatsFingerprint(
+        CrystalNNFingerprint.from_preset('ops'),
+        stats=('mean', 'maximum', 'minimum', 'std_dev'))
+    CompFP = ElementProperty.from_preset('magpie')
+    return CrystalNNFP, CrystalNNFP_full, CompFP
 
 Percentiles = {
     'mp20': np.array([-3.17562208, -2.82196882, -2.52814761]),
@@ -78,7 +87,25 @@ def club_consecutive_elements(arr):
 
     return output
 
+def compute_crystal_fields(crystal, fields):
+    return crystal.compute(fields)
+
+
 class Crystal(object):
+    """
+    Features are computed lazily on first access and cached on the instance.
+    Use `Crystal.materialize` to compute a set of features for many crystals in parallel.
+    """
+
+    # stage method -> attributes it sets, in dependency order
+    STAGES = {
+        'get_structure': ('structure', 'constructed', 'invalid_reason'),
+        'get_composition': ('elems', 'comps'),
+        'get_validity': ('comp_valid', 'struct_valid', 'valid'),
+        'get_fingerprints': ('comp_fp', 'struct_fp'),
+        'get_symmetry': ('real_spacegroup', 'spacegroup_match'),
+    }
+    FIELD_STAGES = {field: stage for stage, fields in STAGES.items() for field in fields}
 
     def __init__(self, crys_array_dict, full_fingerprint=False):
         self.frac_coords = crys_array_dict['frac_coords']
@@ -95,24 +122,61 @@ class Crystal(object):
         if np.isnan(self.lengths).any() or np.isinf(self.lengths).any():
             self.lengths = np.array([1, 1, 1]) * 100
             crys_array_dict['lengths'] = self.lengths
-            
-            self.constructed = False
-            self.invalid_reason = 'nan_value'
         
         self.dict = crys_array_dict
+        PROFILER.count('crystal/init')
         if len(self.atom_types.shape) > 1:
             # this implies the distribution over atom_types is passed instead of the atom_types
             self.dict['atom_types'] = (np.argmax(self.atom_types, axis=-1) + 1)
             self.atom_types = (np.argmax(self.atom_types, axis=-1) + 1)
 
-        self.get_structure()
-        self.get_composition()
-        self.get_validity()
-        self.get_fingerprints()
-        self.get_symmetry()
-
-
+    def __getattr__(self, name):
+        # only reached when the attribute is not set yet, i.e. the stage producing it has not run
+        stage = Crystal.FIELD_STAGES.get(name)
+        if stage is None:
+            raise AttributeError(name)
+        getattr(self, stage)()
+        return self.__dict__[name]
+
+    def has_stage(self, stage):
+        return Crystal.STAGES[stage][0] in self.__dict__
+
+    def compute(self, fields):
+        stages = set(Crystal.FIELD_STAGES[field] for field in fields)
+        for stage in Crystal.STAGES:
+            if stage in stages and not self.has_stage(stage):
+                getattr(self, stage)()
+        return self
+
+    @staticmethod
+    def materialize(crystals, fields, num_workers=None, block_size=16384):
+        """
+        Compute `fields` for every crystal, in parallel over the crystals that are missing any of them.
+        Returns a new list, since the crystals come back from the worker processes as copies.
+        The crystals are taken block_size at a time, so a LazyCrystals is read and built while it is computed.
+        """
+        stages = set(Crystal.FIELD_STAGES[field] for field in fields)
+        materialized = []
+        for start in range(0, len(crystals), block_size):
+            block = [crystals[i] for i in range(start, min(start + block_size, len(crystals)))]
+            todo = [i for i, c in enumerate(block) if not all(c.has_stage(stage) for stage in stages)]
+            if len(todo) > 0 and 'get_fingerprints' in stages:
+                # built once here, the forked workers inherit them
+                fingerprint_featurizers()
+            if num_workers == 1 or len(todo) <= 1:
+                done = [block[i].compute(fields) for i in todo]
+            else:
+                done = p_map(partial(compute_crystal_fields, fields=fields), [block[i] for i in todo],
+                             num_cpus=num_workers or os.cpu_count())
+            for i, c in zip(todo, done):
+                block[i] = c
+            materialized.extend(block)
+        return materialized
+
+    @timed('crystal/get_structure')
     def get_structure(self):
+        self.structure = None
+        self.invalid_reason = None
         if (1 > self.atom_types).any() or (self.atom_types > 94).any():
             self.constructed = False
             self.invalid_reason = f"{self.atom_types=} are not with range"
@@ -158,6 +222,7 @@ class Crystal(object):
                 self.constructed = False
                 self.invalid_reason = 'construction_raises_exception'
 
+    @timed('crystal/get_composition')
     def get_composition(self):
         elem_counter = Counter(self.atom_types)
         if len(elem_counter) == 0:
@@ -172,6 +237,7 @@ class Crystal(object):
         self.elems = elems
         self.comps = tuple(counts.astype('int').tolist())
 
+    @timed('crystal/get_validity')
     def get_validity(self):
         if self.constructed:
             if len(self.elems) == 0:
@@ -184,6 +250,7 @@ class Crystal(object):
             self.struct_valid = False
         self.valid = self.comp_valid and self.struct_valid
 
+    @timed('crystal/get_fingerprints')
     def get_fingerprints(self):
         if len(self.atom_types) == 0:
             self.struct_fp = None
@@ -193,8 +260,11 @@ class Crystal(object):
             self.struct_fp = None
             self.comp_fp = None
             return 
+        # a failed fingerprint marks the crystal invalid, so validity has to exist before
+        self.compute(['valid'])
         elem_counter = Counter(self.atom_types)
         comp = Composition(elem_counter)
+        CrystalNNFP, CrystalNNFP_full, CompFP = fingerprint_featurizers()
         self.comp_fp = CompFP.featurize(comp)
         if self.full_fingerprint:
             try:
@@ -216,47 +286,131 @@ class Crystal(object):
                 return
             self.struct_fp = np.array(site_fps).mean(axis=0)
 
+    @timed('crystal/get_symmetry')
     def get_symmetry(self):
         if self.constructed:
-            try:
-                spga = SpacegroupAnalyzer(self.structure, symprec=Crystal_Tol)
-                self.real_spacegroup = spga.get_space_group_number()
-            except Exception:
-                self.real_spacegroup = 1
-            if self.real_spacegroup is None:
-                # Default to setting to 1
-                self.real_spacegroup = 1
+            self.set_real_spacegroup(
+                get_spacegroup_number(structure_to_cell(self.structure), symprec=Crystal_Tol))
         else:
-            self.real_spacegroup = None
+            self.set_real_spacegroup(None)
+
+    def set_real_spacegroup(self, real_spacegroup):
+        if self.constructed and real_spacegroup is None:
+            # Default to setting to 1
+            real_spacegroup = 1
+        self.real_spacegroup = real_spacegroup
         self.spacegroup_match = self.real_spacegroup == self.spacegroup
 
+class LazyCrystals(Sequence):
+    """
+    Crystals of a sequence of crystal arrays, such as the CrystalList of a generation store, built when accessed.
+    """
+
+    def __init__(self, crys_array_list):
+        self.crys_array_list = crys_array_list
+
+    def __len__(self):
+        return len(self.crys_array_list)
+
+    def __getitem__(self, index):
+        return Crystal(self.crys_array_list[index])
+
+
+def match_prefilter(pred_structure, gt_structure, vol_tol=None):
+    """
+    Cheap necessary conditions for StructureMatcher to find a match.
+    Different reduced compositions can never be matched by the default species comparator.
+    The volume-per-atom check is only exact when the matcher does not rescale volumes (scale=False).
+    """
+    if pred_structure.composition.reduced_composition != gt_structure.composition.reduced_composition:
+        return False
+    if vol_tol is not None:
+        pred_vpa = pred_structure.volume / len(pred_structure)
+        gt_vpa = gt_structure.volume / len(gt_structure)
+        if abs(pred_vpa - gt_vpa) > vol_tol * gt_vpa:
+            return False
+    return True
+
+
+def match_one_target(matcher, pred_structures, gt_structure, vol_tol=None, early_exit_rms=None):
+    """
+    Compute rms distances between every candidate in pred_structures and gt_structure.
+    Invalid candidates are passed as None. If early_exit_rms is set, candidates after the
+    first match with rms <= early_exit_rms are skipped and reported as nan.
+    """
+    rms_dists = []
+    for k, pred_structure in enumerate(pred_structures):
+        if pred_structure is None or gt_structure is None:
+            rms_dists.append(None)
+            continue
+        if not match_prefilter(pred_structure, gt_structure, vol_tol):
+            rms_dists.append(None)
+            continue
+        try:
+            rms_dist = matcher.get_rms_dist(pred_structure, gt_structure)
+            rms_dist = None if rms_dist is None else rms_dist[0]
+        except Exception:
+            rms_dist = None
+        rms_dists.append(rms_dist)
+        if early_exit_rms is not None and rms_dist is not None and rms_dist <= early_exit_rms:
+            rms_dists.extend([np.nan] * (len(pred_structures) - k - 1))
+            break
+    return rms_dists
+
+
+def match_chunk(chunk, matcher, vol_tol=None, early_exit_rms=None):
+    return [match_one_target(matcher, pred_structures, gt_structure, vol_tol, early_exit_rms)
+            for pred_structures, gt_structure in chunk]
+
+
+class MatchEngine(object):
+    """
+    Runs StructureMatcher over (candidates, target) tasks with a process pool.
+    Tasks are grouped in chunks so that every worker receives a few hundred matches at once.
+    With num_workers=1 everything runs in the current process.
+    """
+
+    def __init__(self, matcher, num_workers=None, chunk_size=64, vol_tol=None, early_exit_rms=None):
+        self.matcher = matcher
+        self.num_workers = os.cpu_count() if num_workers is None else num_workers
+        self.chunk_size = chunk_size
+        self.vol_tol = vol_tol
+        self.early_exit_rms = early_exit_rms
+
+    def run(self, tasks):
+        """
+        tasks: list of (pred_structures, gt_structure)
+        returns: list of lists of rms distances (None when not matched)
+        """
+        chunks = [tasks[i:i + self.chunk_size] for i in range(0, len(tasks), self.chunk_size)]
+        func = partial(match_chunk, matcher=self.matcher, vol_tol=self.vol_tol,
+                       early_exit_rms=self.early_exit_rms)
+        if self.num_workers <= 1 or len(chunks) <= 1:
+            results = [func(chunk) for chunk in tqdm(chunks)]
+        else:
+            results = p_map(func, chunks, num_cpus=self.num_workers)
+        return [rms_dists for chunk_result in results for rms_dists in chunk_result]
+
+
 class RecEval(object):
 
-    def __init__(self, pred_crys, gt_crys, stol=0.5, angle_tol=10, ltol=0.3):
+    def __init__(self, pred_crys, gt_crys, stol=0.5, angle_tol=10, ltol=0.3,
+                 num_workers=None, chunk_size=64, vol_tol=None):
         assert len(pred_crys) == len(gt_crys)
+        from pymatgen.analysis.structure_matcher import StructureMatcher
         self.matcher = StructureMatcher(
             stol=stol, angle_tol=angle_tol, ltol=ltol)
         self.preds = pred_crys
         self.gts = gt_crys
+        self.engine = MatchEngine(self.matcher, num_workers=num_workers,
+                                  chunk_size=chunk_size, vol_tol=vol_tol)
 
     def get_match_rate_and_rms(self):
-        def process_one(pred, gt, is_valid):
-            if not is_valid:
-                return None
-            try:
-                rms_dist = self.matcher.get_rms_dist(
-                    pred.structure, gt.structure)
-                rms_dist = None if rms_dist is None else rms_dist[0]
-                return rms_dist
-            except Exception:
-                return None
         validity = [c1.valid and c2.valid for c1,c2 in zip(self.preds, self.gts)]
+        tasks = [([pred.structure if is_valid else None], gt.structure if is_valid else None)
+                 for pred, gt, is_valid in zip(self.preds, self.gts, validity)]
 
-        rms_dists = []
-        for i in tqdm(range(len(self.preds))):
-            rms_dists.append(process_one(
-                self.preds[i], self.gts[i], validity[i]))
-        rms_dists = np.array(rms_dists)
+        rms_dists = np.array([rms[0] for rms in self.engine.run(tasks)])
         match_rate = sum(rms_dists != None) / len(self.preds)
         mean_rms_dist = rms_dists[rms_dists != None].mean()
         return {'match_rate': match_rate,
@@ -270,33 +424,33 @@ class RecEval(object):
 
 class RecEvalBatch(object):
 
-    def __init__(self, pred_crys, gt_crys, stol=0.5, angle_tol=10, ltol=0.3):
+    def __init__(self, pred_crys, gt_crys, stol=0.5, angle_tol=10, ltol=0.3,
+                 num_workers=None, chunk_size=16, vol_tol=None, early_exit_rms=None):
+        # early_exit_rms: stop testing candidates of a target once one matches with rms <= early_exit_rms.
+        # match_rate is unaffected; each per-target min rms is then only known up to early_exit_rms.
+        from pymatgen.analysis.structure_matcher import StructureMatcher
         self.matcher = StructureMatcher(
             stol=stol, angle_tol=angle_tol, ltol=ltol)
         self.preds = pred_crys
         self.gts = gt_crys
         self.batch_size = len(self.preds)
+        self.engine = MatchEngine(self.matcher, num_workers=num_workers, chunk_size=chunk_size,
+                                  vol_tol=vol_tol, early_exit_rms=early_exit_rms)
 
     def get_match_rate_and_rms(self):
-        def process_one(pred, gt, is_valid):
-            if not is_valid:
-                return None
-            try:
-                rms_dist = self.matcher.get_rms_dist(
-                    pred.structure, gt.structure)
-                rms_dist = None if rms_dist is None else rms_dist[0]
-                return rms_dist
-            except Exception:
-                return None
+        tasks = []
+        for i in range(len(self.preds[0])):
+            pred_structures = [self.preds[j][i].structure if self.preds[j][i].valid else None
+                               for j in range(self.batch_size)]
+            tasks.append((pred_structures, self.gts[i].structure if self.gts[i].constructed else None))
 
         rms_dists = []
         self.all_rms_dis = np.zeros((self.batch_size, len(self.gts)))
-        for i in tqdm(range(len(self.preds[0]))):
+        for i, target_rms_dists in enumerate(self.engine.run(tasks)):
             tmp_rms_dists = []
-            for j in range(self.batch_size):
-                rmsd = process_one(self.preds[j][i], self.gts[i], self.preds[j][i].valid)
+            for j, rmsd in enumerate(target_rms_dists):
                 self.all_rms_dis[j][i] = rmsd
-                if rmsd is not None:
+                if rmsd is not None and not np.isnan(rmsd):
                     tmp_rms_dists.append(rmsd)
             if len(tmp_rms_dists) == 0:
                 rms_dists.append(None)
@@ -316,16 +470,55 @@ class RecEvalBatch(object):
 
 
 
+GEN_METRICS = ('validity', 'density', 'prop', 'num_elems', 'coverage', 'spacegroup')
+# StructureMatcher based, only computed when requested
+OPTIONAL_GEN_METRICS = ('uniqueness', 'novelty')
+
+
 class GenEval(object):
 
-    def __init__(self, pred_crys, gt_crys, n_samples=1000, eval_model_name=None, gt_prop_eval_path=None):
-        self.crys = pred_crys
-        self.gt_crys = gt_crys
+    def __init__(self, pred_crys, gt_crys, n_samples=1000, eval_model_name=None, gt_prop_eval_path=None,
+                 symmetry_service=None, metrics=None, num_workers=None, prop_device=None,
+                 prop_graph_method='crystalnn', train_index=None):
         self.n_samples = n_samples
+        self.num_workers = num_workers
+        # StructureIndex of the training set, for novelty
+        self.train_index = train_index
+        self.sample_keys = None
+        self.unique = None
         self.eval_model_name = eval_model_name
         self.gt_prop_eval_path = gt_prop_eval_path
-
-        valid_crys = [c for c in pred_crys if c.valid]
+        if gt_prop_eval_path is not None and prop_graph_method != 'crystalnn':
+            # cached gt predictions must come from the same kind of graph as the generated ones, v2 since the radius
+            # path reduces the crystals (the caches of the unreduced version are not read)
+            self.gt_prop_eval_path = gt_prop_eval_path.replace('.pt', f'_{prop_graph_method}_v2.pt')
+        self.prop_device = prop_device
+        self.prop_graph_method = prop_graph_method
+        if symmetry_service is None:
+            symmetry_service = SymmetryService(symprec=Crystal_Tol)
+        self.symmetry_service = symmetry_service
+        self.real_spacegroups_computed = False
+        # subset of GEN_METRICS to compute, all of them by default
+        self.metrics = GEN_METRICS if metrics is None else tuple(metrics)
+        assert all(m in GEN_METRICS + OPTIONAL_GEN_METRICS for m in self.metrics), f'unknown metrics {self.metrics}'
+
+        # only compute the crystal features the requested metrics need. A failed fingerprint makes a crystal invalid,
+        # so they are skipped only for validity alone, whose valid is then logged as valid_without_fp
+        self.skip_fingerprints = set(self.metrics) <= {'validity'}
+        pred_fields, gt_fields = ['valid'], []
+        if 'density' in self.metrics or 'num_elems' in self.metrics:
+            gt_fields.append('structure')
+        if not self.skip_fingerprints:
+            pred_fields += ['comp_fp', 'struct_fp']
+        if 'coverage' in self.metrics:
+            gt_fields += ['comp_fp', 'struct_fp']
+        # with worker processes the Crystal stages are only timed as a whole here
+        with PROFILER.timer('gen_eval/materialize_pred'):
+            self.crys = Crystal.materialize(pred_crys, pred_fields, num_workers=num_workers)
+        with PROFILER.timer('gen_eval/materialize_gt'):
+            self.gt_crys = Crystal.materialize(gt_crys, gt_fields, num_workers=num_workers) if gt_fields else gt_crys
+
+        valid_crys = [c for c in self.crys if c.valid]
         if n_samples == 0:
             # use all valid crystals instead
             self.valid_samples = valid_crys
@@ -343,7 +536,7 @@ class GenEval(object):
         valid = np.array([c.valid for c in self.crys]).mean()
         return {'comp_valid': comp_valid,
                 'struct_valid': struct_valid,
-                'valid': valid}
+                'valid_without_fp' if self.skip_fingerprints else 'valid': valid}
 
 
     def get_density_wdist(self):
@@ -363,25 +556,38 @@ class GenEval(object):
     def get_prop_wdist(self):
         if self.eval_model_name is not None:
             pred_props = prop_model_eval(self.eval_model_name, [
-                                         c.dict for c in self.valid_samples])
+                                         c.dict for c in self.valid_samples],
+                                         device=self.prop_device, graph_method=self.prop_graph_method)
             if self.gt_prop_eval_path is not None and os.path.exists(self.gt_prop_eval_path):
                 gt_props = torch.load(self.gt_prop_eval_path)
             else:
                 gt_props = prop_model_eval(self.eval_model_name, [
-                                           c.dict for c in self.gt_crys])
+                                           c.dict for c in self.gt_crys],
+                                           device=self.prop_device, graph_method=self.prop_graph_method)
                 torch.save(gt_props, self.gt_prop_eval_path)
             wdist_prop = wasserstein_distance(pred_props, gt_props)
             return {'wdist_prop': wdist_prop}
         else:
             return {'wdist_prop': None}
 
+    def compute_real_spacegroups(self):
+        # one batched spglib pass over the valid samples instead of a SpacegroupAnalyzer per Crystal
+        if self.real_spacegroups_computed:
+            return
+        real_spacegroups = self.symmetry_service.get_spacegroups(self.valid_samples)
+        for c, real_spacegroup in zip(self.valid_samples, real_spacegroups):
+            c.set_real_spacegroup(real_spacegroup)
+        self.real_spacegroups_computed = True
+
     def get_spacegroup_wdist(self):
+        self.compute_real_spacegroups()
         pred_spacegroup = [c.real_spacegroup for c in self.valid_samples]
         gt_spacegroup = [c.spacegroup for c in self.gt_crys]
         wdist_spacegroup = wasserstein_distance(pred_spacegroup, gt_spacegroup)
         return {'wdist_spacegroup': wdist_spacegroup}
 
     def get_spacegroup_match(self):
+        self.compute_real_spacegroups()
         spacegroup_match = np.array([c.spacegroup_match for c in self.valid_samples]).mean()
         return {'spacegroup_match': spacegroup_match}
 
@@ -394,18 +600,59 @@ class GenEval(object):
             comp_cutoff=cutoff_dict['comp'])
         return cov_metrics_dict
 
+    def get_sample_keys(self):
+        # bucket keys of the valid samples, shared by uniqueness and novelty, sampled when they can be (detected at the
+        # symprec of the index otherwise)
+        if self.sample_keys is None:
+            symprec = self.train_index.symprec if self.train_index is not None else KEY_SYMPREC
+            self.sample_keys = crystal_keys(self.valid_samples, symprec=symprec, num_workers=self.num_workers)
+        return self.sample_keys
+
+    def get_uniqueness(self):
+        self.unique = unique_flags([c.structure for c in self.valid_samples], self.get_sample_keys(),
+                                   num_workers=self.num_workers)
+        return {'unique_rate': self.unique.mean()}
+
+    def get_novelty(self):
+        if self.train_index is None:
+            return {'novel_rate': None}
+        novel = self.train_index.novel_flags([c.structure for c in self.valid_samples], self.get_sample_keys(),
+                                             num_workers=self.num_workers, recheck_detected=True)
+        metrics = {'novel_rate': novel.mean()}
+        if self.unique is not None:
+            metrics['unique_novel_rate'] = (self.unique & novel).mean()
+        return metrics
+
     def get_metrics(self):
         metrics = {}
-        metrics.update(self.get_validity())
+        if 'validity' in self.metrics:
+            with PROFILER.timer('gen_eval/validity'):
+                metrics.update(self.get_validity())
         if len(self.valid_samples) == 0:
             print("No valid crystals generated")
             return metrics
-        metrics.update(self.get_density_wdist())
-        metrics.update(self.get_prop_wdist())
-        metrics.update(self.get_num_elem_wdist())
-        metrics.update(self.get_coverage())
-        metrics.update(self.get_spacegroup_wdist())
-        metrics.update(self.get_spacegroup_match())
+        if 'density' in self.metrics:
+            with PROFILER.timer('gen_eval/density'):
+                metrics.update(self.get_density_wdist())
+        if 'prop' in self.metrics:
+            with PROFILER.timer('gen_eval/prop'):
+                metrics.update(self.get_prop_wdist())
+        if 'num_elems' in self.metrics:
+            with PROFILER.timer('gen_eval/num_elems'):
+                metrics.update(self.get_num_elem_wdist())
+        if 'coverage' in self.metrics:
+            with PROFILER.timer('gen_eval/coverage'):
+                metrics.update(self.get_coverage())
+        if 'spacegroup' in self.metrics:
+            with PROFILER.timer('gen_eval/spacegroup'):
+                metrics.update(self.get_spacegroup_wdist())
+                metrics.update(self.get_spacegroup_match())
+        if 'uniqueness' in self.metrics:
+            with PROFILER.timer('gen_eval/uniqueness'):
+                metrics.update(self.get_uniqueness())
+        if 'novelty' in self.metrics:
+            with PROFILER.timer('gen_eval/novelty'):
+                metrics.update(self.get_novelty())
         return metrics
 
 
@@ -419,6 +666,9 @@ def get_file_paths(root_path, task, label='', suffix='pt'):
 
 
 def get_crystal_array_list(file_path, batch_idx=0):
+    if batch_idx == -2 and os.path.isdir(file_path):
+        # a generation store, read lazily
+        return open_generation(file_path).get_crystals_list(), None
     data = load_data(file_path)
     if batch_idx == -1:
         batch_size = data['frac_coords'].shape[0]
@@ -469,7 +719,10 @@ def get_crystal_array_list(file_path, batch_idx=0):
 
 def get_gt_crys_ori(cif):
     structure = Structure.from_str(cif,fmt='cif')
-    spacegroup = structure.get_space_group_info()[1]
+    # same tolerances as Structure.get_space_group_info, without building a SpacegroupAnalyzer
+    spacegroup = get_spacegroup_number(structure_to_cell(structure), symprec=0.01)
+    if spacegroup is None:
+        spacegroup = structure.get_space_group_info()[1]
     lattice = structure.lattice
     crys_array_dict = {
         'frac_coords':structure.frac_coords,
@@ -494,15 +747,44 @@ def get_gt_crys_ori_conventional(cif):
     }
     return Crystal(crys_array_dict) 
 
+def gen_eval_from_arrays(pred_crys_array_list, gt_csv_path, gt_crys_path, eval_model_name,
+                         gt_prop_eval_path=None, metrics=None, prop_device=None, train_csv_path=None,
+                         train_index_path=None, prop_graph_method='radius'):
+    """
+    GenEval metrics of sampled crystal arrays, as used by the evaluation during training: the proxy property model
+    is the resident evaluator with radius graphs by default, without CrystalNN.
+    """
+    gen_crys = [Crystal(x) for x in pred_crys_array_list]
+    train_index = None
+    if metrics is not None and 'novelty' in metrics and train_index_path is not None:
+        train_index = StructureIndex.load_or_build(train_index_path, train_csv_path)
+    if os.path.exists(gt_crys_path):
+        gt_crys = torch.load(gt_crys_path)
+    else:
+        csv = pd.read_csv(gt_csv_path)
+        gt_crys = t_map(get_gt_crys_ori, csv['cif'])
+    gen_evaluator = GenEval(gen_crys, gt_crys, n_samples=0, eval_model_name=eval_model_name,
+                            gt_prop_eval_path=gt_prop_eval_path, metrics=metrics, prop_device=prop_device,
+                            prop_graph_method=prop_graph_method, train_index=train_index)
+    gen_metrics = gen_evaluator.get_metrics()
+    if not os.path.exists(gt_crys_path):
+        torch.save(gen_evaluator.gt_crys, gt_crys_path)
+    return gen_metrics
+
 def main(args):
     all_metrics = {}
+    if args.profile:
+        PROFILER.configure()
 
     cfg = load_config(args.root_path)
     eval_model_name = cfg.data.eval_model_name
 
     if 'gen' in args.tasks:
 
-        gen_file_path = get_file_paths(args.root_path, 'gen', args.label)
+        gen_file_path = str(generation_source(get_file_paths(args.root_path, 'gen', args.label),
+                                              get_file_paths(args.root_path, 'gen', args.label, suffix='store'),
+                                              args.gen_source))
+        print(f'Reading {gen_file_path}')
         crys_array_list, _ = get_crystal_array_list(gen_file_path, batch_idx = -2)
         if args.gt_crys_file != '':
             if os.path.exists(args.gt_crys_file):
@@ -512,7 +794,6 @@ def main(args):
                 print("Reading gt_crys csv")
                 csv = pd.read_csv(args.gt_file)
                 gt_crys = p_map(get_gt_crys_ori_conventional, csv['cif'])
-                torch.save(gt_crys, args.gt_crys_file)
         elif args.gt_file != '':
             print("Reading gt_crys csv")
             csv = pd.read_csv(args.gt_file)
@@ -526,17 +807,37 @@ def main(args):
             recon_file_path = get_file_paths(args.root_path, 'recon', args.label)
             _, true_crystal_array_list = get_crystal_array_list(
                 recon_file_path)
-            gt_crys = p_map(lambda x: Crystal(x), true_crystal_array_list)
-        if os.path.exists(args.root_path + f'/gen_crys_{args.label}.pt'):
-            gen_crys = torch.load(args.root_path + f'/gen_crys_{args.label}.pt')
+            gt_crys = [Crystal(x) for x in true_crystal_array_list]
+        gen_crys_file = args.root_path + f'/gen_crys_{args.label}.pt'
+        if os.path.exists(gen_crys_file):
+            gen_crys = torch.load(gen_crys_file)
         else:
-            gen_crys = p_map(lambda x: Crystal(x), crys_array_list)
-            torch.save(gen_crys, args.root_path + f'/gen_crys_{args.label}.pt')
-
+            # built as GenEval computes them, the crystals of a store are read one chunk at a time
+            gen_crys = LazyCrystals(crys_array_list)
+
+        train_index = None
+        if args.gen_metrics is not None and 'novelty' in args.gen_metrics:
+            # built from the training csv on the first run, loaded afterwards
+            train_file = args.train_file or cfg.data.datamodule.datasets.train.path
+            train_index_path = args.train_index or cfg.data.get('novelty_index_path', None) or \
+                str(Path(train_file).with_suffix('')) + '_structure_index.pt'
+            train_index = StructureIndex.load_or_build(train_index_path, train_file, num_workers=args.num_workers)
+
+        symmetry_service = SymmetryService(symprec=Crystal_Tol, timeout=args.symmetry_timeout,
+                                           num_workers=args.symmetry_workers, cache_path=args.symmetry_cache)
         gen_evaluator = GenEval(
             gen_crys, gt_crys, eval_model_name=eval_model_name, n_samples=args.n_samples,
-            gt_prop_eval_path=cfg.data.datamodule.datasets.test[0].gt_prop_eval_path)
+            gt_prop_eval_path=cfg.data.datamodule.datasets.test[0].gt_prop_eval_path,
+            symmetry_service=symmetry_service, metrics=args.gen_metrics, num_workers=args.num_workers,
+            prop_graph_method=args.prop_graph_method, train_index=train_index)
         gen_metrics = gen_evaluator.get_metrics()
+        if symmetry_service.num_timeouts > 0:
+            print(f'Symmetry detection timed out for {symmetry_service.num_timeouts} structures')
+        # crystals are saved after evaluation so that the cached files hold the computed features
+        if not os.path.exists(gen_crys_file):
+            torch.save(gen_evaluator.crys, gen_crys_file)
+        if args.gt_crys_file != '' and not os.path.exists(args.gt_crys_file):
+            torch.save(gen_evaluator.gt_crys, args.gt_crys_file)
         all_metrics.update(gen_metrics)
 
 
@@ -550,23 +851,30 @@ def main(args):
             csv = pd.read_csv(args.gt_file)
             gt_crys = p_map(get_gt_crys_ori, csv['cif'])
         else:
-            gt_crys = p_map(lambda x: Crystal(x), true_crystal_array_list)
+            gt_crys = [Crystal(x) for x in true_crystal_array_list]
+        # fingerprints are included since a failed fingerprint also marks a crystal invalid
+        rec_fields = ['valid', 'comp_fp', 'struct_fp']
+        gt_crys = Crystal.materialize(gt_crys, rec_fields, num_workers=args.num_workers)
 
         if not args.multi_eval:
-            pred_crys = p_map(lambda x: Crystal(x), crys_array_list)
+            pred_crys = Crystal.materialize([Crystal(x) for x in crys_array_list], rec_fields,
+                                            num_workers=args.num_workers)
         else:
             pred_crys = []
             for i in range(len(crys_array_list)):
                 print(f"Processing batch {i}")
-                pred_crys.append(p_map(lambda x: Crystal(x), crys_array_list[i]))   
+                pred_crys.append(Crystal.materialize([Crystal(x) for x in crys_array_list[i]], rec_fields,
+                                                     num_workers=args.num_workers))
 
 
         if 'csp' in args.tasks: 
 
             if args.multi_eval:
-                rec_evaluator = RecEvalBatch(pred_crys, gt_crys)
+                rec_evaluator = RecEvalBatch(pred_crys, gt_crys, num_workers=args.num_workers,
+                                             vol_tol=args.match_vol_tol, early_exit_rms=args.early_exit_rms)
             else:
-                rec_evaluator = RecEval(pred_crys, gt_crys)
+                rec_evaluator = RecEval(pred_crys, gt_crys, num_workers=args.num_workers,
+                                        vol_tol=args.match_vol_tol)
 
             recon_metrics = rec_evaluator.get_metrics()
 
@@ -598,6 +906,9 @@ def main(args):
         with open(metrics_out_file, 'w') as f:
             json.dump(all_metrics, f)
 
+    if args.profile:
+        PROFILER.save(metrics_out_file.replace('.json', '_profile.json'))
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -610,5 +921,29 @@ if __name__ == '__main__':
     parser.add_argument('--n_samples', type=int, default=1000)
     parser.add_argument('--conventional', type=bool, default=False,
                         help='whether to use the conventional lattice instead of the primitive lattice')
+    parser.add_argument('--num_workers', type=int, default=None,
+                        help='number of processes used for structure matching (default: all cpus)')
+    parser.add_argument('--match_vol_tol', type=float, default=None,
+                        help='relative volume-per-atom tolerance used to skip matching (only exact for scale=False matchers)')
+    parser.add_argument('--early_exit_rms', type=float, default=None,
+                        help='with --multi_eval, stop testing candidates of a target once one matches below this rms')
+    parser.add_argument('--gen_source', default='auto', choices=['auto', 'pt', 'store'],
+                        help='eval_gen.pt or eval_gen.store, by default the one written last')
+    parser.add_argument('--gen_metrics', nargs='+', default=None, choices=GEN_METRICS + OPTIONAL_GEN_METRICS,
+                        help='generation metrics to compute (default: all of GEN_METRICS)')
+    parser.add_argument('--train_file', default='',
+                        help='training csv for novelty (default: the train dataset of the run config)')
+    parser.add_argument('--train_index', default=None,
+                        help='structure index of the training set, built from --train_file if it does not exist')
+    parser.add_argument('--prop_graph_method', default='crystalnn', choices=['crystalnn', 'radius'],
+                        help='graphs for the proxy property model: the original CrystalNN graphs or faster on-device radius graphs')
+    parser.add_argument('--symmetry_timeout', type=float, default=10.,
+                        help='seconds allowed for spacegroup detection of a single generated structure')
+    parser.add_argument('--symmetry_workers', type=int, default=None,
+                        help='spacegroup detection processes (default: 4, or the number of cpus if fewer)')
+    parser.add_argument('--symmetry_cache', default=None,
+                        help='pickle file used to cache detected spacegroups across runs')
+    parser.add_argument('--profile', action='store_true',
+                        help='write the time spent in each stage to eval_metrics_profile.json')
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,337 @@
+import os
+import csv
+import gzip
+import time
+import argparse
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+import torch
+from p_tqdm import p_imap
+
+import sys
+sys.path.append('.')
+from symmcd.common.data_utils import chemical_symbols, lattice_params_to_matrix
+from scripts.gen_store import open_generation
+
+FORMATS = ('cif', 'extxyz')
+LAYOUTS = ('archive', 'shards')
+INDEX_FIELDS = ['id', 'name', 'file', 'chunk_offset', 'chunk_size', 'offset', 'length', 'num_atoms', 'formula',
+                'spacegroup']
+
+
+def formula(atom_types):
+    # unreduced, elements in order of atomic number (e.g. Na4Cl4), unlike the reduced formulas of pymatgen
+    elements, counts = np.unique(atom_types, return_counts=True)
+    return ''.join(f'{chemical_symbols[z]}{n}' for z, n in zip(elements, counts))
+
+
+def cell_volume(lengths, angles):
+    cos = np.cos(np.radians(angles))
+    return float(np.prod(lengths) * np.sqrt(max(1 - (cos ** 2).sum() + 2 * np.prod(cos), 0.)))
+
+
+def cif_block(name, lengths, angles, frac_coords, atom_types):
+    """
+    P1 CIF data block of one crystal, formatted from the arrays directly. It has the cell, the P1 symmetry operation
+    and the atom sites of the blocks of CifWriter, but not byte for byte (no _chemical_formula_structural nor
+    _cell_formula_units_Z, formula_sum as in formula). check_export parses the blocks back with pymatgen.
+    """
+    symbols = [chemical_symbols[z] for z in atom_types]
+    lines = [
+        f'data_{name}',
+        "_symmetry_space_group_name_H-M   'P 1'",
+        f'_cell_length_a   {lengths[0]:.8f}',
+        f'_cell_length_b   {lengths[1]:.8f}',
+        f'_cell_length_c   {lengths[2]:.8f}',
+        f'_cell_angle_alpha   {angles[0]:.8f}',
+        f'_cell_angle_beta   {angles[1]:.8f}',
+        f'_cell_angle_gamma   {angles[2]:.8f}',
+        '_symmetry_Int_Tables_number   1',
+        f"_chemical_formula_sum   '{formula(atom_types)}'",
+        f'_cell_volume   {cell_volume(lengths, angles):.8f}',
+        'loop_',
+        ' _symmetry_equiv_pos_site_id',
+        ' _symmetry_equiv_pos_as_xyz',
+        "  1  'x, y, z'",
+        'loop_',
+        ' _atom_site_type_symbol',
+        ' _atom_site_label',
+        ' _atom_site_symmetry_multiplicity',
+        ' _atom_site_fract_x',
+        ' _atom_site_fract_y',
+        ' _atom_site_fract_z',
+        ' _atom_site_occupancy',
+    ]
+    lines += [f'  {s}  {s}{i}  1  {x:.8f}  {y:.8f}  {z:.8f}  1'
+              for i, (s, (x, y, z)) in enumerate(zip(symbols, frac_coords.tolist()))]
+    return '\n'.join(lines) + '\n'
+
+
+def extxyz_block(name, lengths, angles, frac_coords, atom_types):
+    # one extxyz frame, the lattice vectors as rows (those of pymatgen's Lattice.from_parameters)
+    lattice = lattice_params_to_matrix(*lengths.tolist(), *angles.tolist())
+    cart_coords = frac_coords @ lattice
+    lattice = ' '.join(f'{v:.8f}' for v in lattice.reshape(-1).tolist())
+    lines = [str(len(atom_types)),
+             f'Lattice="{lattice}" Properties=species:S:1:pos:R:3 name={name} pbc="T T T"']
+    lines += [f'{chemical_symbols[z]} {x:.8f} {y:.8f} {z_:.8f}'
+              for z, (x, y, z_) in zip(atom_types, cart_coords.tolist())]
+    return '\n'.join(lines) + '\n'
+
+
+BLOCKS = {'cif': cif_block, 'extxyz': extxyz_block}
+
+
+def flat_arrays(frac_coords, atom_types, lengths, angles, num_atoms, spacegroups=None):
+    # numpy arrays of a generation output (eval_gen.pt), atom type distributions reduced to atomic numbers
+    arrays = {'frac_coords': frac_coords, 'atom_types': atom_types, 'lengths': lengths, 'angles': angles,
+              'num_atoms': num_atoms, 'spacegroups': spacegroups}
+    arrays = {k: (v.detach().cpu().numpy() if torch.is_tensor(v) else v) for k, v in arrays.items() if v is not None}
+    if arrays['atom_types'].ndim == 2:
+        arrays['atom_types'] = arrays['atom_types'].argmax(-1) + 1
+    return arrays
+
+
+def split_chunks(arrays, chunk_size):
+    # consecutive crystals, with the slices of the per atom arrays
+    offsets = np.concatenate([[0], np.cumsum(arrays['num_atoms'])])
+    for chunk_id, start in enumerate(range(0, len(arrays['num_atoms']), chunk_size)):
+        end = min(start + chunk_size, len(arrays['num_atoms']))
+        chunk = {k: v[start:end] for k, v in arrays.items() if k not in ('frac_coords', 'atom_types')}
+        chunk['frac_coords'] = arrays['frac_coords'][offsets[start]:offsets[end]]
+        chunk['atom_types'] = arrays['atom_types'][offsets[start]:offsets[end]]
+        chunk['chunk_id'] = chunk_id
+        chunk['start'] = start
+        yield chunk
+
+
+def export_chunk(chunk, fmt='cif', prefix='', compresslevel=6, shard_dir=None):
+    """
+    Formats the crystals of a chunk and compresses them as one gzip member. Returns the member (None when written to
+    a shard of shard_dir) and the index rows, with the offsets of the crystals in the uncompressed member.
+    """
+    block = BLOCKS[fmt]
+    texts, rows = [], []
+    offset, atom_start = 0, 0
+    for i, num_atom in enumerate(chunk['num_atoms'].tolist()):
+        atom_types = chunk['atom_types'][atom_start:atom_start + num_atom]
+        frac_coords = chunk['frac_coords'][atom_start:atom_start + num_atom]
+        atom_start += num_atom
+        crystal_id = chunk['start'] + i
+        name = f'{prefix}{crystal_id}'
+        text = block(name, chunk['lengths'][i], chunk['angles'][i], frac_coords, atom_types).encode()
+        texts.append(text)
+        spacegroup = int(chunk['spacegroups'][i]) if 'spacegroups' in chunk else ''
+        rows.append({'id': crystal_id, 'name': name, 'offset': offset, 'length': len(text), 'num_atoms': num_atom,
+                     'formula': formula(atom_types), 'spacegroup': spacegroup})
+        offset += len(text)
+    member = gzip.compress(b''.join(texts), compresslevel=compresslevel, mtime=0)
+    if shard_dir is not None:
+        file = f"shard_{chunk['chunk_id']:05d}.{fmt}.gz"
+        (Path(shard_dir) / file).write_bytes(member)
+        for row in rows:
+            row.update({'file': file, 'chunk_offset': 0, 'chunk_size': len(member)})
+        return None, rows
+    return member, rows
+
+
+def store_chunks(store, chunk_size):
+    # split_chunks over the chunks of a generation store, one store chunk in memory at a time
+    start = 0
+    for c in range(store.num_chunks):
+        data = store.load_chunk(c)
+        arrays = flat_arrays(*(data.get(k) for k in ('frac_coords', 'atom_types', 'lengths', 'angles', 'num_atoms',
+                                                     'spacegroups')))
+        for chunk in split_chunks(arrays, chunk_size):
+            chunk['start'] += start
+            yield chunk
+        start += len(arrays['num_atoms'])
+
+
+def export_chunks(out_dir, chunks, num_chunks=None, fmt='cif', layout='archive', prefix='', num_workers=None,
+                  compresslevel=6):
+    """
+    Writes chunks of crystals (those of split_chunks or store_chunks) to out_dir in parallel, see export_crystals.
+    Returns the path of the index.
+    """
+    assert fmt in FORMATS and layout in LAYOUTS
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    # shard names from a running count, the chunk ids of store_chunks restart in every store chunk
+    chunks = ({**chunk, 'chunk_id': chunk_id} for chunk_id, chunk in enumerate(chunks))
+    func = partial(export_chunk, fmt=fmt, prefix=prefix, compresslevel=compresslevel,
+                   shard_dir=str(out_dir) if layout == 'shards' else None)
+    if num_workers == 1:
+        results = map(func, chunks)
+    else:
+        results = p_imap(func, chunks, num_cpus=num_workers or os.cpu_count(), total=num_chunks)
+
+    index_path = out_dir / 'index.csv'
+    archive_file = f'crystals.{fmt}.gz'
+    with open(index_path, 'w', newline='') as index_file:
+        writer = csv.DictWriter(index_file, fieldnames=INDEX_FIELDS)
+        writer.writeheader()
+        if layout == 'archive':
+            with open(out_dir / archive_file, 'wb') as archive:
+                for member, rows in results:
+                    chunk_offset = archive.tell()
+                    archive.write(member)
+                    for row in rows:
+                        row.update({'file': archive_file, 'chunk_offset': chunk_offset, 'chunk_size': len(member)})
+                    writer.writerows(rows)
+        else:
+            for _, rows in results:
+                writer.writerows(rows)
+    return index_path
+
+
+def export_crystals(out_dir, frac_coords, atom_types, lengths, angles, num_atoms, spacegroups=None, fmt='cif',
+                    layout='archive', prefix='', chunk_size=1024, num_workers=None, compresslevel=6):
+    """
+    Writes crystals given as the flat arrays of a generation output to out_dir, in parallel over chunks of crystals.
+    layout 'archive': a single crystals.<fmt>.gz of concatenated gzip members (one per chunk), which decompresses to
+    one multi-block CIF or multi-frame extxyz file. layout 'shards': one shard_<chunk>.<fmt>.gz per chunk, written by
+    the workers. index.csv gives the file, the compressed member and the uncompressed offset of every crystal,
+    see read_crystal. Returns the path of the index.
+    """
+    arrays = flat_arrays(frac_coords, atom_types, lengths, angles, num_atoms, spacegroups)
+    num_chunks = (len(arrays['num_atoms']) + chunk_size - 1) // chunk_size
+    return export_chunks(out_dir, split_chunks(arrays, chunk_size), num_chunks, fmt=fmt, layout=layout,
+                         prefix=prefix, num_workers=num_workers, compresslevel=compresslevel)
+
+
+def export_store(out_dir, store, fmt='cif', layout='archive', prefix='', chunk_size=1024, num_workers=None,
+                 compresslevel=6):
+    """
+    export_crystals of a generation store (or legacy file of open_generation), read one store chunk at a time.
+    """
+    num_chunks = sum((chunk['num_crystals'] + chunk_size - 1) // chunk_size for chunk in store.meta['chunks'])
+    return export_chunks(out_dir, store_chunks(store, chunk_size), num_chunks, fmt=fmt, layout=layout,
+                         prefix=prefix, num_workers=num_workers, compresslevel=compresslevel)
+
+
+def read_index(index_path):
+    with open(index_path, newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def read_crystal(out_dir, row):
+    """
+    The CIF block or extxyz frame of one row of read_index, only decompressing its chunk.
+    """
+    with open(Path(out_dir) / row['file'], 'rb') as f:
+        f.seek(int(row['chunk_offset']))
+        member = gzip.decompress(f.read(int(row['chunk_size'])))
+    return member[int(row['offset']):int(row['offset']) + int(row['length'])].decode()
+
+
+def random_crystals(num_crystals, max_atoms=20, seed=0):
+    # flat arrays of random crystals, to measure the export throughput
+    rng = np.random.default_rng(seed)
+    num_atoms = rng.integers(1, max_atoms + 1, num_crystals)
+    return {
+        'frac_coords': rng.random((num_atoms.sum(), 3)),
+        'atom_types': rng.integers(1, 95, num_atoms.sum()),
+        'lengths': rng.uniform(3., 10., (num_crystals, 3)),
+        'angles': rng.uniform(60., 120., (num_crystals, 3)),
+        'num_atoms': num_atoms,
+        'spacegroups': rng.integers(1, 231, num_crystals),
+    }
+
+
+def parse_extxyz(text):
+    # lengths, angles, fractional coordinates and atomic numbers of one extxyz frame of extxyz_block
+    from pymatgen.core.lattice import Lattice
+    lines = text.splitlines()
+    matrix = np.array(lines[1].split('Lattice="')[1].split('"')[0].split(), dtype=float).reshape(3, 3)
+    lattice = Lattice(matrix)
+    symbols = [line.split()[0] for line in lines[2:]]
+    cart_coords = np.array([line.split()[1:4] for line in lines[2:]], dtype=float)
+    return (np.array(lattice.abc), np.array(lattice.angles), lattice.get_fractional_coords(cart_coords),
+            np.array([chemical_symbols.index(s) for s in symbols]))
+
+
+def parse_cif(text):
+    # the same, read back by pymatgen's CIF parser
+    from pymatgen.core.structure import Structure
+    structure = Structure.from_str(text, fmt='cif')
+    return (np.array(structure.lattice.abc), np.array(structure.lattice.angles), structure.frac_coords,
+            np.array(structure.atomic_numbers))
+
+
+def check_export(out_dir, crystal, num_check=100, fmt='cif', seed=0, atol=1e-5):
+    """
+    Parses num_check random crystals of an export back (CIF with pymatgen) and compares them with crystal(id), which
+    gives the lengths, angles, frac_coords and atom_types of the source. Returns the ids that differ.
+    """
+    parse = parse_cif if fmt == 'cif' else parse_extxyz
+    rows = read_index(Path(out_dir) / 'index.csv')
+    rng = np.random.default_rng(seed)
+    mismatches = []
+    for k in rng.choice(len(rows), min(num_check, len(rows)), replace=False):
+        row = rows[k]
+        lengths, angles, frac_coords, atom_types = crystal(int(row['id']))
+        parsed = parse(read_crystal(out_dir, row))
+        # the parser wraps the coordinates into the unit cell
+        diff = parsed[2] - np.asarray(frac_coords) if len(parsed[2]) == len(frac_coords) else None
+        if (diff is None or not np.array_equal(parsed[3], np.asarray(atom_types))
+                or not np.allclose(parsed[0], lengths, atol=atol) or not np.allclose(parsed[1], angles, atol=atol)
+                or not np.allclose(diff - np.round(diff), 0., atol=atol)):
+            mismatches.append(int(row['id']))
+    return mismatches
+
+
+def main(args):
+    if args.gen_file is not None:
+        store = open_generation(args.gen_file)
+        num_crystals = len(store)
+
+        def crystal(i):
+            c = store.crystal(i)
+            atom_types = c['atom_types'].argmax(-1) + 1 if c['atom_types'].ndim == 2 else c['atom_types']
+            return c['lengths'], c['angles'], c['frac_coords'], atom_types
+        export = partial(export_store, store=store)
+    else:
+        arrays = random_crystals(args.num_random, seed=args.seed)
+        num_crystals = len(arrays['num_atoms'])
+        offsets = np.concatenate([[0], np.cumsum(arrays['num_atoms'])])
+
+        def crystal(i):
+            atoms = slice(offsets[i], offsets[i + 1])
+            return arrays['lengths'][i], arrays['angles'][i], arrays['frac_coords'][atoms], arrays['atom_types'][atoms]
+        export = partial(export_crystals, **arrays)
+    start_time = time.time()
+    index_path = export(args.out_dir, fmt=args.format, layout=args.layout, prefix=args.prefix,
+                        chunk_size=args.chunk_size, num_workers=args.num_workers, compresslevel=args.compresslevel)
+    elapsed = time.time() - start_time
+    print(f'{num_crystals} crystals in {elapsed:.1f}s ({num_crystals / elapsed:.0f}/s, '
+          f'{60 * num_crystals / elapsed:.0f}/min), index {index_path}')
+    if args.check > 0:
+        mismatches = check_export(args.out_dir, crystal, args.check, fmt=args.format, seed=args.seed)
+        print(f'parity: {min(args.check, num_crystals) - len(mismatches)}/{min(args.check, num_crystals)} crystals '
+              f'read back identical' + (f', differing ids {mismatches[:20]}' if mismatches else ''))
+        if mismatches:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export generated crystals to compressed CIF or extxyz files with an index')
+    parser.add_argument('--gen_file', default=None, help='generation output (eval_gen.store or eval_gen.pt), random crystals otherwise')
+    parser.add_argument('--num_random', default=100000, type=int, help='number of random crystals without --gen_file')
+    parser.add_argument('--out_dir', required=True)
+    parser.add_argument('--format', default='cif', choices=FORMATS)
+    parser.add_argument('--layout', default='archive', choices=LAYOUTS)
+    parser.add_argument('--prefix', default='', help='prefix of the crystal names (CIF data blocks)')
+    parser.add_argument('--chunk_size', default=1024, type=int, help='crystals per gzip member')
+    parser.add_argument('--num_workers', default=None, type=int, help='export processes (default: all cpus)')
+    parser.add_argument('--compresslevel', default=6, type=int)
+    parser.add_argument('--check', default=100, type=int,
+                        help='crystals read back (CIF with pymatgen) and compared with the source after the export, '
+                             'exits with 1 on a difference (0: no check)')
+    parser.add_argument('--seed', default=0, type=int)
+
+    args = parser.parse_args()
+
+    main(args)
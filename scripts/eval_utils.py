@@ -11,22 +11,19 @@ from hydra import initialize_config_dir
 from itertools import product
 from pymatgen.core import Structure, Lattice
 from pymatgen.core.sites import PeriodicSite
-import nglview
 
 from pathlib import Path
 
-import smact
-from smact.screening import pauling_test
-
 import sys
 sys.path.append('.')
 
 from symmcd.common.constants import CompScalerMeans, CompScalerStds
-from symmcd.common.data_utils import StandardScaler, chemical_symbols
+from symmcd.common.data_utils import StandardScaler, chemical_symbols, radius_graph_pbc_wrapper, reduce_crystal
+from symmcd.common.profiling import timed
 from symmcd.pl_data.dataset import TensorCrystDataset
 from symmcd.pl_data.datamodule import worker_init_fn
 
-from torch_geometric.data import DataLoader
+from torch_geometric.data import DataLoader, Data, Batch
 
 CompScaler = StandardScaler(
     means=np.array(CompScalerMeans),
@@ -37,6 +34,8 @@ import pdb
 
 
 def plot3d(structure, spacefill=True, show_axes=True):
+    # visualization only, nglview is not imported with this module
+    import nglview
 
     eps = 1e-8
     sites = []
@@ -109,6 +108,22 @@ def load_config(model_path):
     return cfg
 
 
+def find_checkpoint(model_path, cfg):
+    # the checkpoint load_model loads: the one of the latest epoch in the run dir
+    ckpt = None
+    ckpts = list(model_path.glob('*.ckpt'))
+    if len(ckpts) > 0:
+        ckpt_epochs = np.array(
+            [int(ckpt.parts[-1].split('-')[0].split('=')[1]) for ckpt in ckpts if 'last' not in ckpt.parts[-1]])
+        ckpt = str(ckpts[ckpt_epochs.argsort()[-1]])
+    # with data.eval_async, the checkpoints of the run dir are the last ones and the best one on the
+    # generation metrics is kept by AsyncGenEval
+    best_ckpt = model_path / 'gen_eval' / f'best_{cfg.train.monitor_metric}.ckpt'
+    if cfg.data.get('eval_async', False) and best_ckpt.exists():
+        ckpt = str(best_ckpt)
+    return ckpt
+
+
 def load_model(model_path, load_data=False, testing=True):
     hydra.core.global_hydra.GlobalHydra.instance().clear()
     with initialize_config_dir(str(model_path)):
@@ -120,11 +135,7 @@ def load_model(model_path, load_data=False, testing=True):
             logging=cfg.logging,
             _recursive_=False,
         )
-        ckpts = list(model_path.glob('*.ckpt'))
-        if len(ckpts) > 0:
-            ckpt_epochs = np.array(
-                [int(ckpt.parts[-1].split('-')[0].split('=')[1]) for ckpt in ckpts if 'last' not in ckpt.parts[-1]])
-            ckpt = str(ckpts[ckpt_epochs.argsort()[-1]])
+        ckpt = find_checkpoint(model_path, cfg)
         # model = model.load_from_checkpoint(ckpt, strict=False) # old PyTorch lightning, no longer supported
         if cfg.model._target_ == "symmcd.pl_modules.diffusion.CSPDiffusion":
             from symmcd.pl_modules.diffusion import CSPDiffusion as Model
@@ -161,6 +172,7 @@ def load_model(model_path, load_data=False, testing=True):
     return model, test_loader, cfg
 
 
+@timed('get_crystals_list')
 def get_crystals_list(
         frac_coords, atom_types, lengths, angles, num_atoms, **kwargs):
     """
@@ -210,6 +222,8 @@ def get_crystals_list(
 def smact_validity(comp, count,
                    use_pauling_test=True,
                    include_alloys=True):
+    import smact
+    from smact.screening import pauling_test
     elem_symbols = tuple([chemical_symbols[elem] for elem in comp])
     space = smact.element_dictionary(elem_symbols)
     smact_elems = [e[1] for e in space.items()]
@@ -269,41 +283,114 @@ def get_fp_pdist(fp_array):
     return fp_pdists.mean()
 
 
-def prop_model_eval(eval_model_name, crystal_array_list):
-
-    model_path = get_model_path(eval_model_name)
-
-    model, _, _ = load_model(model_path)
-    cfg = load_config(model_path)
+class PropModelEvaluator(object):
+    """
+    Proxy property model kept in memory for the lifetime of the process, with its data config.
+    With graph_method='radius', crystals are reduced with the niggli/primitive settings of the proxy
+    model's data config, then graphs are built on the fly with radius_graph_pbc on the model's device
+    (no CrystalNN), using the cutoff and max_num_neighbors of the proxy encoder. With
+    graph_method='crystalnn', graphs are built on the CPU by TensorCrystDataset, as the proxy model
+    was trained.
+    """
 
-    dataset = TensorCrystDataset(
-        crystal_array_list, cfg.data.niggli, cfg.data.primitive,
-        cfg.data.graph_method, cfg.data.preprocess_workers,
-        cfg.data.lattice_scale_method)
+    def __init__(self, eval_model_name, device='cpu', batch_size=256):
+        model, _, cfg = load_model(get_model_path(eval_model_name))
+        self.cfg = cfg
+        self.device = torch.device(device)
+        self.model = model.to(self.device).eval()
+        self.model.scaler.match_device(torch.zeros(1, device=self.device))
+        self.batch_size = batch_size
+        self.niggli = cfg.data.niggli
+        self.primitive = cfg.data.primitive
+        self.cutoff = self.model.encoder.cutoff
+        self.max_num_neighbors = self.model.encoder.max_num_neighbors
+
+    def reduce(self, crystal_array):
+        crystal = Structure(
+            lattice=Lattice.from_parameters(*(np.asarray(crystal_array['lengths']).tolist()
+                                              + np.asarray(crystal_array['angles']).tolist())),
+            species=crystal_array['atom_types'],
+            coords=crystal_array['frac_coords'],
+            coords_are_cartesian=False)
+        crystal = reduce_crystal(crystal, self.niggli, self.primitive)
+        return {'frac_coords': crystal.frac_coords, 'atom_types': np.array(crystal.atomic_numbers),
+                'lengths': np.array(crystal.lattice.abc), 'angles': np.array(crystal.lattice.angles)}
+
+    def build_batch(self, crystal_array_list):
+        if self.niggli or self.primitive:
+            crystal_array_list = [self.reduce(crystal_array) for crystal_array in crystal_array_list]
+        data_list = [Data(
+            frac_coords=torch.Tensor(crystal_array['frac_coords']),
+            atom_types=torch.LongTensor(crystal_array['atom_types']),
+            lengths=torch.Tensor(crystal_array['lengths']).view(1, -1),
+            angles=torch.Tensor(crystal_array['angles']).view(1, -1),
+            num_atoms=len(crystal_array['atom_types']),
+            num_nodes=len(crystal_array['atom_types']),
+        ) for crystal_array in crystal_array_list]
+        batch = Batch.from_data_list(data_list).to(self.device)
+        edge_index, to_jimages, num_bonds = radius_graph_pbc_wrapper(
+            batch, self.cutoff, self.max_num_neighbors, self.device)
+        batch.edge_index = edge_index
+        batch.to_jimages = to_jimages
+        batch.num_bonds = num_bonds
+        return batch
+
+    def crystalnn_batches(self, crystal_array_list):
+        dataset = TensorCrystDataset(
+            crystal_array_list, self.cfg.data.niggli, self.cfg.data.primitive,
+            self.cfg.data.graph_method, self.cfg.data.preprocess_workers,
+            self.cfg.data.lattice_scale_method)
+        dataset.scaler = self.model.scaler.copy()
+        loader = DataLoader(
+            dataset,
+            shuffle=False,
+            batch_size=self.batch_size,
+            num_workers=0,
+            worker_init_fn=worker_init_fn)
+        for batch in loader:
+            yield batch.to(self.device)
+
+    def radius_batches(self, crystal_array_list):
+        for i in range(0, len(crystal_array_list), self.batch_size):
+            yield self.build_batch(crystal_array_list[i:i + self.batch_size])
+
+    @torch.no_grad()
+    def predict(self, crystal_array_list, graph_method='radius'):
+        all_preds = []
+        if graph_method == 'crystalnn':
+            batches = self.crystalnn_batches(crystal_array_list) if len(crystal_array_list) > 0 else []
+        else:
+            batches = self.radius_batches(crystal_array_list)
+        for batch in batches:
+            preds = self.model(batch)
+            scaled_preds = self.model.scaler.inverse_transform(preds)
+            all_preds.append(scaled_preds.detach().cpu().numpy())
+        if len(all_preds) == 0:
+            return []
+        all_preds = np.concatenate(all_preds, axis=0).squeeze(1)
+        return all_preds.tolist()
 
-    dataset.scaler = model.scaler.copy()
 
-    loader = DataLoader(
-        dataset,
-        shuffle=False,
-        batch_size=256,
-        num_workers=0,
-        worker_init_fn=worker_init_fn)
+# resident proxy evaluators, one per (model, device)
+PROP_EVALUATORS = {}
 
-    model.eval()
 
-    all_preds = []
+def get_prop_evaluator(eval_model_name, device='cpu'):
+    key = (eval_model_name, str(torch.device(device)))
+    if key not in PROP_EVALUATORS:
+        PROP_EVALUATORS[key] = PropModelEvaluator(eval_model_name, device=device)
+    return PROP_EVALUATORS[key]
 
-    for batch in loader:
-        # NOTE: hacky-fix to run the pre-trained proxy models (CrystGNN_Supervise) for getting preds, model is in cuda and batch is in cpu
-        model = model.to('cpu')
-        preds = model(batch)
-        model.scaler.match_device(preds)
-        scaled_preds = model.scaler.inverse_transform(preds)
-        all_preds.append(scaled_preds.detach().cpu().numpy())
 
-    all_preds = np.concatenate(all_preds, axis=0).squeeze(1)
-    return all_preds.tolist()
+def prop_model_eval(eval_model_name, crystal_array_list, device=None, graph_method='crystalnn'):
+    """
+    Predictions of the resident PropModelEvaluator on `device` (default cuda if available), loaded once per process.
+    graph_method='crystalnn' builds CrystalNN graphs on the CPU, as the proxy model was trained.
+    graph_method='radius' builds radius graphs on `device`, as used by the evaluation during training.
+    """
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    return get_prop_evaluator(eval_model_name, device).predict(crystal_array_list, graph_method=graph_method)
 
 
 def filter_fps(struc_fps, comp_fps):
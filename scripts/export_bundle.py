@@ -0,0 +1,87 @@
+import sys
+import time
+import json
+import argparse
+import subprocess
+import platform
+from pathlib import Path
+
+import numpy as np
+
+sys.path.append('.')
+
+
+def load_once(args):
+    # run in a fresh process by cold_start: imports and loading are timed separately
+    start = time.perf_counter()
+    if args.mode == 'bundle':
+        from symmcd.common.bundle import load_bundle
+    else:
+        from scripts.eval_utils import load_model
+    import_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if args.mode == 'bundle':
+        model, _, _ = load_bundle(args.path)
+    else:
+        model, _, _ = load_model(Path(args.path))
+    load_s = time.perf_counter() - start
+    print(json.dumps({'import_s': import_s, 'load_s': load_s,
+                      'num_parameters': sum(p.numel() for p in model.parameters())}))
+
+
+def cold_start(args):
+    """
+    Time to a loaded model of load_model on the model directory and of load_bundle on the bundle, each in fresh
+    processes (alternating, repeats times). The files are in the page cache after the first run, so this measures
+    the work done by the loaders rather than disk reads.
+    """
+    results = {'model_path': args.model_path, 'bundle': args.bundle, 'machine': platform.platform()}
+    runs = {'load_model': [], 'load_bundle': []}
+    for _ in range(args.repeats):
+        for name, mode, path in [('load_model', 'model_dir', args.model_path), ('load_bundle', 'bundle', args.bundle)]:
+            start = time.perf_counter()
+            out = subprocess.run([sys.executable, __file__, '_load_once', '--mode', mode, '--path', path],
+                                 check=True, capture_output=True, text=True).stdout
+            process_s = time.perf_counter() - start
+            runs[name].append({**json.loads(out.strip().splitlines()[-1]), 'process_s': process_s})
+    for name, name_runs in runs.items():
+        results[name] = {key: float(np.median([run[key] for run in name_runs]))
+                         for key in ['import_s', 'load_s', 'process_s']}
+        results[name]['runs'] = name_runs
+    results['load_speedup'] = results['load_model']['load_s'] / results['load_bundle']['load_s']
+    print(json.dumps({k: v for k, v in results.items() if k in ['load_model', 'load_bundle', 'load_speedup']}, indent=2))
+    if args.out is not None:
+        Path(args.out).write_text(json.dumps(results, indent=2))
+
+
+def main(args):
+    if args.command == 'export':
+        from symmcd.common.bundle import export_bundle
+        start = time.perf_counter()
+        export_bundle(Path(args.model_path), args.out)
+        print(f'Wrote {args.out} ({Path(args.out).stat().st_size / 2 ** 20:.1f} MiB) in {time.perf_counter() - start:.1f}s')
+    elif args.command == 'cold_start':
+        cold_start(args)
+    else:
+        load_once(args)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export_parser = subparsers.add_parser('export', help='write the inference bundle of a model directory')
+    export_parser.add_argument('--model_path', required=True)
+    export_parser.add_argument('--out', required=True)
+    cold_start_parser = subparsers.add_parser('cold_start', help='compare the load time of a model directory and its bundle')
+    cold_start_parser.add_argument('--model_path', required=True)
+    cold_start_parser.add_argument('--bundle', required=True)
+    cold_start_parser.add_argument('--repeats', default=3, type=int)
+    cold_start_parser.add_argument('--out', default=None, help='json file with the timings of every run')
+    load_once_parser = subparsers.add_parser('_load_once')
+    load_once_parser.add_argument('--mode', choices=['model_dir', 'bundle'], required=True)
+    load_once_parser.add_argument('--path', required=True)
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,172 @@
+import sys
+import json
+import argparse
+from pathlib import Path
+
+import torch
+
+sys.path.append('.')
+from symmcd.pl_modules.cspnet import CSPNet, ExportableCSPNet, export_edges, N_AXES
+from scripts.benchmark_cspnet import DECODER_KWARGS
+
+INPUT_NAMES = ['t', 'atom_types', 'frac_coords', 'lattice_feats', 'lattices', 'node2graph', 'site_symm_probs',
+               'edge_index', 'edge_shift']
+OUTPUT_NAMES = ['lattice_out', 'coord_out', 'type_out', 'site_symm_out']
+# overrides of DECODER_KWARGS covering the branches of ExportableCSPNet, checked without --model_path
+VARIANTS = {
+    'default': {},
+    'site_symm_vector_embed': {'site_symm_matrix_embed': False},
+    'no_site_symm_head': {'pred_site_symm_type': False},
+    'no_site_symm': {'use_site_symm': False, 'pred_site_symm_type': False},
+    'ks': {'use_ks': True, 'ip': False},
+    'knn_edges': {'edge_style': 'knn', 'cutoff': 7., 'max_neighbors': 20},
+    'discrete_types': {'smooth': False, 'mask_token': False},
+    'gt_frac_coords': {'use_gt_frac_coords': True},
+    'no_dis_emb_no_ln': {'dis_emb': 'none', 'ln': False},
+}
+
+
+def make_inputs(decoder, batch_size, num_atoms, seed):
+    # random crystals with the input sizes of decoder, num_atoms per crystal drawn in [1, num_atoms]
+    generator = torch.Generator().manual_seed(seed)
+    hidden_dim = decoder.coord_out.in_features
+    time_dim = decoder.atom_latent_emb.in_features - hidden_dim
+    if decoder.use_site_symm:
+        time_dim -= decoder.site_symm_embedding.out_features
+    if decoder.use_gt_frac_coords and decoder.dis_emb is not None:
+        time_dim -= decoder.dis_emb.dim
+    num_atoms = torch.randint(1, num_atoms + 1, (batch_size,), generator=generator)
+    num_nodes = int(num_atoms.sum())
+    lattices = torch.eye(3).repeat(batch_size, 1, 1) * 5. + torch.rand(batch_size, 3, 3, generator=generator)
+    if decoder.smooth:
+        max_atoms = decoder.node_embedding.in_features
+        atom_types = torch.softmax(torch.randn(num_nodes, max_atoms, generator=generator), dim=-1)
+    else:
+        atom_types = torch.randint(1, decoder.node_embedding.num_embeddings + 1, (num_nodes,), generator=generator)
+    inputs = dict(
+        t=torch.randn(batch_size, time_dim, generator=generator),
+        atom_types=atom_types,
+        frac_coords=torch.rand(num_nodes, 3, generator=generator),
+        lattice_feats=torch.randn(batch_size, 6, generator=generator) if decoder.use_ks else lattices,
+        lattices=lattices,
+        num_atoms=num_atoms,
+        node2graph=torch.arange(batch_size).repeat_interleave(num_atoms),
+        site_symm_probs=torch.softmax(torch.randn(num_nodes, N_AXES * decoder.n_ss, generator=generator), dim=-1),
+    )
+    return inputs
+
+
+def export_inputs(decoder, inputs):
+    edge_index, edge_shift = export_edges(decoder, inputs['num_atoms'], inputs['frac_coords'], inputs['lattices'],
+                                          inputs['node2graph'])
+    inputs = {**inputs, 'edge_index': edge_index, 'edge_shift': edge_shift}
+    return tuple(inputs[name] for name in INPUT_NAMES)
+
+
+def reference_outputs(decoder, inputs):
+    # outputs of the eager decoder with the fixed signature of ExportableCSPNet
+    outputs = decoder(**inputs)
+    coord_out = outputs[1]
+    empty = coord_out[:, :0]
+    type_out = outputs[2] if decoder.pred_type else empty
+    site_symm_out = outputs[-1] if decoder.pred_site_symm_type else empty
+    return outputs[0], coord_out, type_out, site_symm_out
+
+
+def max_abs_diff(reference, outputs):
+    return {name: float((ref - torch.as_tensor(out)).abs().max()) if ref.numel() > 0 else 0.
+            for name, ref, out in zip(OUTPUT_NAMES, reference, outputs)}
+
+
+def check_decoder(decoder, args, out_dir):
+    """
+    Outputs of ExportableCSPNet, eager and after each export in args.formats, against those of the eager CSPNet:
+    the largest absolute difference per output and batch.
+    """
+    decoder = decoder.cpu().eval()
+    exportable = ExportableCSPNet(decoder).eval()
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    # the second batch has other sizes, so that the exported graphs are checked with dynamic shapes
+    batches = [make_inputs(decoder, args.batch_size, args.num_atoms, args.seed),
+               make_inputs(decoder, args.batch_size + 3, args.num_atoms + 5, args.seed + 1)]
+    with torch.no_grad():
+        references = [reference_outputs(decoder, inputs) for inputs in batches]
+        batches = [export_inputs(decoder, inputs) for inputs in batches]
+        report = {'eager': [max_abs_diff(ref, exportable(*inputs)) for ref, inputs in zip(references, batches)]}
+
+        if 'torchscript' in args.formats:
+            path = out_dir / 'decoder.torchscript.pt'
+            torch.jit.script(exportable).save(str(path))
+            scripted = torch.jit.load(str(path))
+            report['torchscript'] = [max_abs_diff(ref, scripted(*inputs)) for ref, inputs in zip(references, batches)]
+
+        if 'onnx' in args.formats:
+            path = out_dir / 'decoder.onnx'
+            dynamic_axes = {'t': [0], 'atom_types': [0], 'frac_coords': [0], 'lattice_feats': [0], 'lattices': [0],
+                            'node2graph': [0], 'site_symm_probs': [0], 'edge_index': [1], 'edge_shift': [0],
+                            'lattice_out': [0], 'coord_out': [0], 'type_out': [0], 'site_symm_out': [0]}
+            torch.onnx.export(exportable, batches[0], str(path), input_names=INPUT_NAMES, output_names=OUTPUT_NAMES,
+                              dynamic_axes=dynamic_axes, opset_version=args.opset)
+            try:
+                import onnxruntime
+            except ImportError:
+                onnxruntime = None
+                print('onnxruntime is not installed, the ONNX graph is exported but not checked')
+            if onnxruntime is not None:
+                session = onnxruntime.InferenceSession(str(path), providers=['CPUExecutionProvider'])
+                graph_inputs = {i.name for i in session.get_inputs()}
+                report['onnx'] = []
+                for ref, inputs in zip(references, batches):
+                    feed = {name: x.numpy() for name, x in zip(INPUT_NAMES, inputs) if name in graph_inputs}
+                    report['onnx'].append(max_abs_diff(ref, session.run(OUTPUT_NAMES, feed)))
+    return report
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    out_dir = Path(args.out_dir)
+    if args.model_path is not None:
+        from scripts.eval_utils import load_model
+        model, _, _ = load_model(Path(args.model_path))
+        decoders = {'model': model.decoder}
+    else:
+        # small random decoders, one per variant
+        decoders = {}
+        for name in args.variants:
+            torch.manual_seed(args.seed)
+            decoders[name] = CSPNet(**{**DECODER_KWARGS, 'num_layers': args.num_layers, 'hidden_dim': args.hidden_dim,
+                                       **VARIANTS[name]})
+
+    report = {}
+    for name, decoder in decoders.items():
+        report[name] = check_decoder(decoder, args, out_dir if len(decoders) == 1 else out_dir / name)
+        report[name]['max_abs_diff'] = max(diff for key, runs in report[name].items() for run in runs
+                                           for diff in run.values())
+        print(f"{name}: max abs diff {report[name]['max_abs_diff']:.2e} ({', '.join(k for k in report[name] if k != 'max_abs_diff')})")
+    report['max_abs_diff'] = max(r['max_abs_diff'] for r in report.values())
+    report['passed'] = report['max_abs_diff'] <= args.atol
+    print(json.dumps(report, indent=2))
+    (out_dir / 'export_parity.json').write_text(json.dumps(report, indent=2))
+    if not report['passed']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the decoder with ExportableCSPNet and check it against the eager CSPNet on CPU')
+    parser.add_argument('--model_path', default=None, help='decoder of a trained model, a random one of benchmark_cspnet otherwise')
+    parser.add_argument('--variants', nargs='+', default=list(VARIANTS), choices=list(VARIANTS),
+                        help='decoder configurations checked without --model_path')
+    parser.add_argument('--formats', nargs='+', default=['torchscript', 'onnx'], choices=['torchscript', 'onnx'])
+    parser.add_argument('--out_dir', default='decoder_export')
+    parser.add_argument('--batch_size', default=4, type=int)
+    parser.add_argument('--num_atoms', default=8, type=int, help='largest number of atoms of the random crystals')
+    parser.add_argument('--num_layers', default=2, type=int)
+    parser.add_argument('--hidden_dim', default=128, type=int)
+    parser.add_argument('--opset', default=16, type=int, help='16 or later, for ScatterElements with a sum reduction')
+    parser.add_argument('--atol', default=1e-4, type=float)
+    parser.add_argument('--seed', default=0, type=int)
+
+    args = parser.parse_args()
+
+    main(args)
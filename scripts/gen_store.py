@@ -0,0 +1,255 @@
+import os
+import json
+import shutil
+import bisect
+from collections import OrderedDict
+from collections.abc import Sequence
+from pathlib import Path
+
+import numpy as np
+import torch
+
+STORE_VERSION = 1
+ATOM_COLUMNS = ('frac_coords', 'atom_types', 'site_symmetries')
+CRYSTAL_COLUMNS = ('lengths', 'angles', 'num_atoms', 'spacegroups')
+# memory mapped chunks kept open, every column of a chunk holds a file descriptor
+MAX_OPEN_CHUNKS = 8
+
+
+def to_numpy(x):
+    return x.detach().cpu().numpy() if torch.is_tensor(x) else np.asarray(x)
+
+
+def compact(name, array):
+    # smaller dtypes where they are exact: one-hot site symmetries as uint8, atomic numbers as int16
+    if name == 'site_symmetries' and np.array_equal(array, array.astype(np.uint8)):
+        return array.astype(np.uint8)
+    if name == 'atom_types' and array.ndim == 1:
+        return array.astype(np.int16)
+    if name in ('num_atoms', 'spacegroups'):
+        return array.astype(np.int32)
+    return array
+
+
+def expand(name, array):
+    # the dtypes of the generation outputs, for the arrays of a single crystal
+    if name == 'site_symmetries' and array.dtype == np.uint8:
+        return array.astype(np.float32)
+    if array.dtype in (np.int16, np.int32):
+        return array.astype(np.int64)
+    return np.array(array)
+
+
+def write_meta(path, meta):
+    # atomic, so that a reader never sees the meta of a half written chunk
+    tmp = Path(path) / 'meta.json.tmp'
+    tmp.write_text(json.dumps(meta, indent=2, default=str))
+    os.replace(tmp, Path(path) / 'meta.json')
+
+
+class GenStore(object):
+    """
+    Generation outputs as a directory of chunks, one per appended batch. A chunk holds one .npy file per column: the
+    per atom columns (ATOM_COLUMNS) flat over the crystals of the chunk, the per crystal columns (CRYSTAL_COLUMNS) with
+    num_atoms giving the offsets. meta.json lists the chunks and the evaluation settings, and is marked complete by
+    finalize once the writer is done. Chunks are memory mapped when read, so that neither writing nor iterating over
+    the crystals holds more than a few chunks in memory.
+    """
+
+    def __init__(self, path, allow_partial=False):
+        self.path = Path(path)
+        self.meta = json.loads((self.path / 'meta.json').read_text())
+        if self.meta.get('version') != STORE_VERSION:
+            raise ValueError(f'{path} is not a generation store of version {STORE_VERSION}')
+        if not self.meta.get('complete', False) and not allow_partial:
+            raise ValueError(f'{path} is incomplete (the generation was interrupted or is still running)')
+        self.open_chunks = OrderedDict()
+        self.update_index()
+
+    @classmethod
+    def create(cls, path, eval_setting=None):
+        """
+        An empty store at path, replacing the store that may be there (as torch.save replaced eval_gen.pt).
+        """
+        path = Path(path)
+        if path.exists():
+            if not (path / 'meta.json').exists():
+                raise FileExistsError(f'{path} exists and is not a generation store')
+            shutil.rmtree(path)
+        path.mkdir(parents=True)
+        write_meta(path, {'version': STORE_VERSION, 'eval_setting': eval_setting, 'complete': False, 'columns': [],
+                          'chunks': []})
+        return cls(path, allow_partial=True)
+
+    def update_index(self):
+        counts = [chunk['num_crystals'] for chunk in self.meta['chunks']]
+        self.chunk_starts = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    def __len__(self):
+        return int(self.chunk_starts[-1])
+
+    @property
+    def num_chunks(self):
+        return len(self.meta['chunks'])
+
+    @property
+    def columns(self):
+        return self.meta['columns']
+
+    def append(self, frac_coords, atom_types, lengths, angles, num_atoms, spacegroups=None, site_symmetries=None):
+        """
+        Writes the outputs of one batch (tensors or arrays, flat over atoms as returned by sample()) as a new chunk.
+        """
+        arrays = {'frac_coords': frac_coords, 'atom_types': atom_types, 'lengths': lengths, 'angles': angles,
+                  'num_atoms': num_atoms, 'spacegroups': spacegroups, 'site_symmetries': site_symmetries}
+        arrays = {name: compact(name, to_numpy(x)) for name, x in arrays.items() if x is not None}
+        if len(arrays['num_atoms']) == 0:
+            # empty arrays cannot be memory mapped
+            return
+        if int(arrays['num_atoms'].sum()) != len(arrays['frac_coords']):
+            raise ValueError('num_atoms does not sum to the number of atoms')
+        columns = sorted(arrays)
+        if self.meta.get('complete', False):
+            raise ValueError(f'{self.path} is complete, create a new store to append to')
+        if self.num_chunks > 0 and columns != self.columns:
+            raise ValueError(f'the chunk has the columns {columns}, the store {self.columns}')
+        name = f'chunk_{self.num_chunks:06d}'
+        tmp = self.path / f'{name}.tmp'
+        tmp.mkdir()
+        for column, array in arrays.items():
+            np.save(tmp / f'{column}.npy', array)
+        os.replace(tmp, self.path / name)
+        self.meta['columns'] = columns
+        self.meta['chunks'].append({'name': name, 'num_crystals': len(arrays['num_atoms']),
+                                    'num_atoms': len(arrays['frac_coords'])})
+        write_meta(self.path, self.meta)
+        self.update_index()
+
+    def finalize(self):
+        # marks the store as complete, readers refuse it before
+        self.meta['complete'] = True
+        write_meta(self.path, self.meta)
+
+    def load_chunk(self, i):
+        chunk_dir = self.path / self.meta['chunks'][i]['name']
+        return {column: np.load(chunk_dir / f'{column}.npy', mmap_mode='r') for column in self.columns}
+
+    def chunk(self, i):
+        # memory mapped columns of chunk i and its atom offsets, the last MAX_OPEN_CHUNKS chunks are kept open
+        if i in self.open_chunks:
+            self.open_chunks.move_to_end(i)
+            return self.open_chunks[i]
+        chunk = self.load_chunk(i)
+        chunk['atom_offsets'] = np.concatenate([[0], np.cumsum(chunk['num_atoms'])])
+        self.open_chunks[i] = chunk
+        if len(self.open_chunks) > MAX_OPEN_CHUNKS:
+            self.open_chunks.popitem(last=False)
+        return chunk
+
+    def chunk_crystal(self, chunk, j):
+        # crystal j of a chunk, as the dicts of get_crystals_list (with spacegroups and site_symmetries if stored)
+        start, end = chunk['atom_offsets'][j], chunk['atom_offsets'][j + 1]
+        crystal = {column: expand(column, chunk[column][start:end]) for column in ATOM_COLUMNS if column in chunk}
+        crystal.update({column: expand(column, chunk[column][j]) for column in CRYSTAL_COLUMNS if column in chunk})
+        del crystal['num_atoms']
+        if 'site_symmetries' not in chunk:
+            crystal.pop('spacegroups', None)
+        return crystal
+
+    def crystal(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        c = bisect.bisect_right(self.chunk_starts, i) - 1
+        return self.chunk_crystal(self.chunk(c), i - int(self.chunk_starts[c]))
+
+    def crystals(self):
+        for c in range(self.num_chunks):
+            chunk = self.chunk(c)
+            for j in range(len(chunk['num_atoms'])):
+                yield self.chunk_crystal(chunk, j)
+
+    def get_crystals_list(self):
+        """
+        The crystals as get_crystals_list of eval_utils, read lazily.
+        """
+        return CrystalList(self)
+
+    def arrays(self):
+        """
+        Every column concatenated over the chunks, as the arrays saved in eval_gen.pt. Loads the whole store.
+        """
+        chunks = [self.load_chunk(c) for c in range(self.num_chunks)]
+        return {column: np.concatenate([chunk[column] for chunk in chunks]) for column in self.columns}
+
+
+class LegacyGenFile(GenStore):
+    """
+    Reader of the eval_gen.pt files saved with torch.save, loaded in memory as a single chunk.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        data = torch.load(path, map_location='cpu')
+        self.legacy_arrays = {name: compact(name, to_numpy(data[name])) for name in ATOM_COLUMNS + CRYSTAL_COLUMNS
+                              if data.get(name) is not None}
+        eval_setting = data.get('eval_setting')
+        self.meta = {
+            'version': STORE_VERSION,
+            'eval_setting': vars(eval_setting) if hasattr(eval_setting, '__dict__') else eval_setting,
+            'complete': True,
+            'columns': sorted(self.legacy_arrays),
+            'chunks': [{'name': None, 'num_crystals': len(self.legacy_arrays['num_atoms']),
+                        'num_atoms': len(self.legacy_arrays['frac_coords'])}],
+        }
+        self.open_chunks = OrderedDict()
+        self.update_index()
+
+    def append(self, *args, **kwargs):
+        raise TypeError('legacy generation files are read only, write to a GenStore')
+
+    def load_chunk(self, i):
+        return dict(self.legacy_arrays)
+
+
+class CrystalList(Sequence):
+    # the crystals of a store, read when accessed
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.store.crystal(i) for i in range(*index.indices(len(self)))]
+        return self.store.crystal(index if index >= 0 else index + len(self))
+
+    def __iter__(self):
+        return self.store.crystals()
+
+
+def open_generation(path):
+    """
+    A complete generation store directory, or a legacy eval_gen.pt file.
+    """
+    path = Path(path)
+    if (path / 'meta.json').exists():
+        return GenStore(path)
+    return LegacyGenFile(path)
+
+
+def generation_source(pt_path, store_path, source='auto'):
+    """
+    The generation output to read: pt_path or store_path with source 'pt' or 'store', otherwise the one that exists
+    or, if both do, the one written last (the meta.json of a store is rewritten when it is finalized).
+    """
+    pt_path, store_path = Path(pt_path), Path(store_path)
+    if source == 'pt':
+        return pt_path
+    if source == 'store':
+        return store_path
+    if not (store_path / 'meta.json').exists():
+        return pt_path
+    if not pt_path.exists():
+        return store_path
+    return store_path if (store_path / 'meta.json').stat().st_mtime > pt_path.stat().st_mtime else pt_path
@@ -2,7 +2,9 @@ import time
 import argparse
 import torch
 import csv
+import json
 import os
+import multiprocessing as mp
 from collections import Counter, defaultdict
 from tqdm import tqdm
 from torch.optim import Adam
@@ -25,7 +27,12 @@ POINT = np.array([0.5, 0.5, 0.5]) + EPS
 
 import sys
 sys.path.append('.')
-from scripts.eval_utils import load_model, lattices_to_params_shape, get_crystals_list
+from scripts.eval_utils import load_model, load_config, find_checkpoint, lattices_to_params_shape, get_crystals_list
+from symmcd.common.profiling import PROFILER, timed, merge_reports
+from symmcd.pl_modules.continuous_sampler import ContinuousBatchSampler
+from symmcd.pl_modules.cspnet import quantize_dynamic_int8
+from scripts.crystal_export import FORMATS, LAYOUTS, export_crystals, export_store
+from scripts.gen_store import GenStore
 
 
 train_dist = {
@@ -78,7 +85,10 @@ train_dist = {
             0.08995430424528301]
 }
 
-def diffusion(loader, model, step_lr):
+def diffusion(loader, model, step_lr, step_mode='eager', device=None, continuous_slots=0, prune_every=0, store=None):
+    # with a GenStore, every batch is appended to it instead of being kept in memory, and None is returned
+    if continuous_slots > 0:
+        return continuous_diffusion(loader.dataset, model, step_lr, continuous_slots, device, prune_every, store)
 
     frac_coords = []
     num_atoms = []
@@ -88,10 +98,20 @@ def diffusion(loader, model, step_lr):
     site_symmetries = []
     for idx, batch in enumerate(loader):
 
-        if torch.cuda.is_available():
+        if device is not None:
+            batch = batch.to(device)
+        elif torch.cuda.is_available():
             batch.cuda()
-        outputs, traj = model.sample(batch, step_lr = step_lr)
+        # only the discrete site symmetry model has compiled / CUDA graph sampling steps
+        sample_kwargs = {} if step_mode == 'eager' else {'step_mode': step_mode}
+        if prune_every > 0:
+            sample_kwargs['prune_every'] = prune_every
+        with PROFILER.timer('generation/sample'):
+            outputs, traj = model.sample(batch, step_lr = step_lr, **sample_kwargs)
         del traj
+        if store is not None:
+            append_outputs(store, outputs, outputs['spacegroup'])
+            continue
         frac_coords.append(outputs['frac_coords'].detach().cpu())
         num_atoms.append(outputs['num_atoms'].detach().cpu())
         atom_types.append(outputs['atom_types'].detach().cpu())
@@ -99,6 +119,8 @@ def diffusion(loader, model, step_lr):
         spacegroups.append(outputs['spacegroup'].detach().cpu())
         site_symmetries.append(outputs['site_symm'].detach().cpu())
 
+    if store is not None:
+        return None
     frac_coords = torch.cat(frac_coords, dim=0)
     num_atoms = torch.cat(num_atoms, dim=0)
     atom_types = torch.cat(atom_types, dim=0)
@@ -111,6 +133,56 @@ def diffusion(loader, model, step_lr):
         frac_coords, atom_types, lattices, lengths, angles, num_atoms, spacegroups, site_symmetries
     )
 
+def continuous_diffusion(dataset, model, step_lr, num_slots, device=None, prune_every=0, store=None):
+    # the crystals of dataset through a ContinuousBatchSampler, in the order in which they finish
+    if device is not None:
+        model.to(device)
+
+    frac_coords = []
+    num_atoms = []
+    atom_types = []
+    lattices = []
+    spacegroups = []
+    site_symmetries = []
+    sampler = ContinuousBatchSampler(model, dataset, num_slots, step_lr=step_lr, prune_every=prune_every)
+    with PROFILER.timer('generation/sample'):
+        for finished, outputs in tqdm(sampler):
+            if outputs is None:
+                continue
+            if store is not None:
+                append_outputs(store, outputs, outputs['spacegroup'][outputs['crystal_index']])
+                continue
+            frac_coords.append(outputs['frac_coords'].detach().cpu())
+            num_atoms.append(outputs['num_atoms'].detach().cpu())
+            atom_types.append(outputs['atom_types'].detach().cpu())
+            lattices.append(outputs['lattices'].detach().cpu())
+            spacegroups.append(outputs['spacegroup'][outputs['crystal_index']].detach().cpu())
+            site_symmetries.append(outputs['site_symm'].detach().cpu())
+    print(f"{sampler.counters['crystals']} crystals ({sampler.counters['pruned']} pruned) in {sampler.counters['steps']} steps, "
+          f"{sampler.counters['slot_steps'] / max(sampler.counters['steps'], 1):.1f} crystals per step on average")
+    if store is not None:
+        return None
+
+    frac_coords = torch.cat(frac_coords, dim=0)
+    num_atoms = torch.cat(num_atoms, dim=0)
+    atom_types = torch.cat(atom_types, dim=0)
+    lattices = torch.cat(lattices, dim=0)
+    spacegroups = torch.cat(spacegroups, dim=0)
+    site_symmetries = torch.cat(site_symmetries, dim=0)
+    lengths, angles = lattices_to_params_shape(lattices)
+
+    return (
+        frac_coords, atom_types, lattices, lengths, angles, num_atoms, spacegroups, site_symmetries
+    )
+
+def append_outputs(store, outputs, spacegroups):
+    lengths, angles = lattices_to_params_shape(outputs['lattices'].detach().cpu())
+    with PROFILER.timer('generation/store'):
+        store.append(outputs['frac_coords'].detach().cpu(), outputs['atom_types'].detach().cpu(), lengths, angles,
+                     outputs['num_atoms'].detach().cpu(), spacegroups=spacegroups.detach().cpu(),
+                     site_symmetries=outputs['site_symm'].detach().cpu())
+
+
 class SampleDataset(Dataset):
 
     def __init__(self, dataset, total_num, train_ori_path=None, sg_info_path=None, restrict_spacegroups=None,):
@@ -209,6 +281,7 @@ class SampleDataset(Dataset):
             torch.save((sg_num_atoms_hashable, sg_dist, sg_number_binary_mapper), sg_info_path)
         return  sg_num_atoms, sg_dist, sg_number_binary_mapper
 
+@timed('generation/save_cif')
 def save_cif(model_path, crys_array_list, label):
     if label == '':
         cif_path = model_path / 'crystal.csv'
@@ -228,49 +301,254 @@ def save_cif(model_path, crys_array_list, label):
                 species=atom_types,
                 coords=crys_dict['frac_coords'],
                 coords_are_cartesian=False)
-        csvwriter.writerow([crystal.to(fmt='cif')])
+            csvwriter.writerow([crystal.to(fmt='cif')])
 
-def main(args):
-    # load_data if do reconstruction.
-    model_path = Path(args.model_path)
-    model, _, cfg = load_model(
-        model_path, load_data=False)
+def quantize_for_cpu(model):
+    # --cpu_quantized: the decoder with int8 Linear layers, the rest of the model (embeddings, posteriors) in fp32
+    model.to('cpu')
+    model.decoder = quantize_dynamic_int8(model.decoder)
+    return model
 
-    if torch.cuda.is_available():
-        model.to('cuda')
 
-    print('Evaluate the diffusion model.')
+def sample_loader(args, cfg, num_batches):
     restrict_spacegroups = np.array(args.restrict_spacegroups) if args.restrict_spacegroups is not None else None
     test_set = SampleDataset(args.dataset, 
-                             args.batch_size * args.num_batches_to_samples, 
+                             args.batch_size * num_batches, 
                              train_ori_path=cfg.data.datamodule.datasets.train.save_path,
                              sg_info_path=cfg.data.datamodule.datasets.train.sg_info_path,
                              restrict_spacegroups=restrict_spacegroups)
-    test_loader = DataLoader(test_set, batch_size = args.batch_size)
+    return DataLoader(test_set, batch_size = args.batch_size)
+
+
+def checkpoint_fingerprint(model_path):
+    # the checkpoint load_model samples from, with its size and modification time (checkpoints such as the best one
+    # of AsyncGenEval are overwritten in place)
+    ckpt = find_checkpoint(model_path, load_config(model_path))
+    if ckpt is None:
+        return None
+    stat = os.stat(ckpt)
+    return {'path': str(Path(ckpt).relative_to(model_path)), 'size': stat.st_size, 'mtime': int(stat.st_mtime)}
+
+
+def shard_settings(args):
+    # shards are only reused by a run with the same settings, every one that changes the sampled crystals
+    seeds = [int(s.generate_state(1)[0]) for s in np.random.SeedSequence(args.seed).spawn(args.num_shards)]
+    batches = np.array_split(np.arange(args.num_batches_to_samples), args.num_shards)
+    checkpoint = checkpoint_fingerprint(Path(args.model_path))
+    return [{
+        'shard': shard,
+        'seed': seeds[shard],
+        'batches': batches[shard].tolist(),
+        'batch_size': args.batch_size,
+        'dataset': args.dataset,
+        'restrict_spacegroups': args.restrict_spacegroups,
+        'step_lr': args.step_lr,
+        'step_mode': args.step_mode,
+        'continuous_slots': args.continuous_slots,
+        'prune_every': args.prune_every,
+        'cpu_quantized': args.cpu_quantized,
+        'checkpoint': checkpoint,
+    } for shard in range(args.num_shards)]
+
+
+def shard_file(shard_dir, setting):
+    return shard_dir / f"shard_{setting['shard']:04d}.pt"
+
+
+def setting_file(shard_dir, setting):
+    # sidecar of a shard with its setting, written before the shard, so that it is checked without loading the shard
+    return shard_dir / f"shard_{setting['shard']:04d}.json"
+
+
+def saved_setting(shard_dir, setting):
+    # the setting a shard was generated with, None for shards without a sidecar (generated before the sidecars)
+    if setting_file(shard_dir, setting).exists():
+        return json.loads(setting_file(shard_dir, setting).read_text())
+    return None
+
+
+def generate_shards(args, settings, shard_dir, device):
+    # worker process: one model on one device, shards written one by one as they complete
+    if device.startswith('cuda'):
+        torch.cuda.set_device(device)
+    if args.profile and not PROFILER.enabled:
+        PROFILER.configure(cuda_sync=args.profile_cuda_sync)
+    model, _, cfg = load_model(Path(args.model_path), load_data=False)
+    if args.cpu_quantized:
+        quantize_for_cpu(model)
+    else:
+        model.to(device)
+    for setting in settings:
+        if len(setting['batches']) == 0 or shard_file(shard_dir, setting).exists():
+            continue
+        # SampleDataset draws space groups and numbers of atoms with the global numpy generator
+        np.random.seed(setting['seed'] % 2 ** 32)
+        torch.manual_seed(setting['seed'])
+        loader = sample_loader(args, cfg, len(setting['batches']))
+        start_time = time.time()
+        PROFILER.reset()
+        (frac_coords, atom_types, lattices, lengths, angles, num_atoms, spacegroups, site_symmetries) = diffusion(loader, model, args.step_lr, args.step_mode, device, args.continuous_slots, args.prune_every)
+        # written under a temporary name first, so that an interrupted write does not count as a completed shard
+        tmp_file = shard_file(shard_dir, setting).with_suffix('.tmp')
+        torch.save({
+            'shard_setting': setting,
+            'frac_coords': frac_coords,
+            'num_atoms': num_atoms,
+            'atom_types': atom_types,
+            'lengths': lengths,
+            'angles': angles,
+            'spacegroups': spacegroups,
+            'site_symmetries': site_symmetries,
+            'profile': PROFILER.report() if args.profile else None,
+        }, tmp_file)
+        setting_file(shard_dir, setting).write_text(json.dumps(setting, indent=2))
+        os.replace(tmp_file, shard_file(shard_dir, setting))
+        print(f"Shard {setting['shard']} done on {device} in {time.time() - start_time:.1f}s")
+
+
+def sharded_diffusion(args, shard_dir, store=None):
+    settings = shard_settings(args)
+    shard_dir.mkdir(exist_ok=True)
+    for setting in settings:
+        if shard_file(shard_dir, setting).exists() and saved_setting(shard_dir, setting) != setting:
+            raise ValueError(f'{shard_file(shard_dir, setting)} was generated with other settings '
+                             f'({saved_setting(shard_dir, setting)}), use another --label or remove {shard_dir}')
+    todo = [setting for setting in settings if not shard_file(shard_dir, setting).exists()]
+    print(f'{len(settings) - len(todo)}/{len(settings)} shards already generated')
+
+    if torch.cuda.is_available() and not args.cpu and not args.cpu_quantized:
+        devices = [f'cuda:{i}' for i in range(torch.cuda.device_count())]
+    else:
+        devices = ['cpu']
+    num_workers = min(args.num_workers or len(devices), max(len(todo), 1))
+    if num_workers == 1:
+        generate_shards(args, todo, shard_dir, devices[0])
+    else:
+        if devices == ['cpu']:
+            torch.set_num_threads(max(1, (os.cpu_count() or 1) // num_workers))
+        ctx = mp.get_context('spawn')
+        processes = []
+        for worker in range(num_workers):
+            # one worker per device, cycling through the devices when there are more workers
+            process = ctx.Process(target=generate_shards,
+                                  args=(args, todo[worker::num_workers], shard_dir, devices[worker % len(devices)]))
+            process.start()
+            processes.append(process)
+        for process in processes:
+            process.join()
+
+    missing = [setting['shard'] for setting in settings if not shard_file(shard_dir, setting).exists()]
+    if missing:
+        raise RuntimeError(f'shards {missing} failed, rerun to generate only those')
+
+    if store is not None:
+        # one chunk per shard, in shard order, with a single shard in memory at a time
+        profiles = []
+        for setting in settings:
+            shard = torch.load(shard_file(shard_dir, setting))
+            store.append(shard['frac_coords'], shard['atom_types'], shard['lengths'], shard['angles'],
+                         shard['num_atoms'], spacegroups=shard['spacegroups'], site_symmetries=shard['site_symmetries'])
+            if shard.get('profile') is not None:
+                profiles.append(shard['profile'])
+        return None, profiles
+
+    # merge, in shard order
+    shards = [torch.load(shard_file(shard_dir, setting)) for setting in settings]
+    arrays = tuple(torch.cat([shard[k] for shard in shards], dim=0) for k in
+                   ['frac_coords', 'atom_types', 'lengths', 'angles', 'num_atoms', 'spacegroups', 'site_symmetries'])
+    return arrays, [shard['profile'] for shard in shards if shard.get('profile') is not None]
 
-    start_time = time.time()
-    (frac_coords, atom_types, lattices, lengths, angles, num_atoms, spacegroups, site_symmetries) = diffusion(test_loader, model, args.step_lr)
+
+def main(args):
+    model_path = Path(args.model_path)
 
     if args.label == '':
         gen_out_name = 'eval_gen.pt'
     else:
         gen_out_name = f'eval_gen_{args.label}.pt'
 
-    torch.save({
-        'eval_setting': args,
-        'frac_coords': frac_coords,
-        'num_atoms': num_atoms,
-        'atom_types': atom_types,
-        'lengths': lengths,
-        'angles': angles,
-        'spacegroups': spacegroups,
-        'site_symmetries': site_symmetries,
-    }, model_path / gen_out_name)
+    if args.profile:
+        PROFILER.configure(cuda_sync=args.profile_cuda_sync, record_functions=args.torch_trace)
+    shard_reports = []
+    # a single eval_gen.pt by default, the chunked eval_gen.store/ with --output_format store
+    store = None
+    if args.output_format == 'store':
+        store = GenStore.create(model_path / (Path(gen_out_name).stem + '.store'), eval_setting=vars(args))
+
+    if args.num_shards > 0:
+        print('Evaluate the diffusion model.')
+        shard_dir = model_path / (Path(gen_out_name).stem + '_shards')
+        outputs, shard_reports = sharded_diffusion(args, shard_dir, store)
+        if store is None:
+            (frac_coords, atom_types, lengths, angles, num_atoms, spacegroups, site_symmetries) = outputs
+    else:
+        # load_data if do reconstruction.
+        with PROFILER.timer('generation/load_model'):
+            model, _, cfg = load_model(
+                model_path, load_data=False)
+
+        if args.cpu_quantized:
+            quantize_for_cpu(model)
+        elif torch.cuda.is_available():
+            model.to('cuda')
+        device = 'cpu' if args.cpu_quantized else None
+
+        print('Evaluate the diffusion model.')
+        test_loader = sample_loader(args, cfg, args.num_batches_to_samples)
+
+        start_time = time.time()
+        if args.torch_trace:
+            # the PROFILER timers show up as ranges in the trace
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            with torch.profiler.profile(activities=activities) as torch_profiler:
+                outputs = diffusion(test_loader, model, args.step_lr, args.step_mode, device, args.continuous_slots, args.prune_every, store)
+            torch_profiler.export_chrome_trace(str(model_path / (Path(gen_out_name).stem + '_trace.json')))
+        else:
+            outputs = diffusion(test_loader, model, args.step_lr, args.step_mode, device, args.continuous_slots, args.prune_every, store)
+        if store is None:
+            (frac_coords, atom_types, lattices, lengths, angles, num_atoms, spacegroups, site_symmetries) = outputs
+
+    if store is None:
+        torch.save({
+            'eval_setting': args,
+            'frac_coords': frac_coords,
+            'num_atoms': num_atoms,
+            'atom_types': atom_types,
+            'lengths': lengths,
+            'angles': angles,
+            'spacegroups': spacegroups,
+            'site_symmetries': site_symmetries,
+        }, model_path / gen_out_name)
+    else:
+        store.finalize()
+        print(f'{len(store)} crystals in {store.num_chunks} chunks saved to {store.path}')
 
     if args.save_cif is not None:
-        crys_array_list = get_crystals_list(frac_coords, atom_types, lengths, angles, num_atoms, spacegroups=spacegroups, site_symmetries=site_symmetries)
+        if store is None:
+            crys_array_list = get_crystals_list(frac_coords, atom_types, lengths, angles, num_atoms, spacegroups=spacegroups, site_symmetries=site_symmetries)
+        else:
+            crys_array_list = store.get_crystals_list()
         save_cif(model_path, crys_array_list, args.label)
 
+    if args.export_format is not None:
+        export_dir = model_path / f'{Path(gen_out_name).stem}_{args.export_format}'
+        with PROFILER.timer('generation/export'):
+            if store is None:
+                export_crystals(export_dir, frac_coords, atom_types, lengths, angles, num_atoms,
+                                spacegroups=spacegroups, fmt=args.export_format, layout=args.export_layout)
+            else:
+                export_store(export_dir, store, fmt=args.export_format, layout=args.export_layout)
+
+    if args.profile:
+        # the timers of the shards, which may come from other processes, over the wall time of this run
+        report = merge_reports(shard_reports) if args.num_shards > 0 else PROFILER.report()
+        report['wall_time_s'] = PROFILER.report()['wall_time_s']
+        report['eval_setting'] = vars(args)
+        with open(model_path / (Path(gen_out_name).stem + '_profile.json'), 'w') as f:
+            json.dump(report, f, indent=2)
+
 
 
 if __name__ == '__main__':
@@ -283,6 +561,34 @@ if __name__ == '__main__':
     parser.add_argument('--label', default='')
     parser.add_argument('--restrict_spacegroups', nargs='+', type=int, help='list of spacegroups to sample from')
     parser.add_argument('--save_cif', help='option to save cif files', default=None)
+    parser.add_argument('--output_format', default='pt', choices=['pt', 'store'],
+                        help='a single eval_gen.pt, or the chunked eval_gen.store/ appended per batch')
+    parser.add_argument('--export_format', default=None, choices=FORMATS,
+                        help='also export the crystals to <gen_out>_<format>/ with crystal_export')
+    parser.add_argument('--export_layout', default='archive', choices=LAYOUTS,
+                        help='a single gzip archive or one gzip shard per chunk, both with an index.csv')
+    parser.add_argument('--step_mode', default='eager', choices=['eager', 'compile', 'cuda_graph'],
+                        help='how each sampling step runs: eager, torch.compile or replayed from a CUDA graph')
+    parser.add_argument('--continuous_slots', default=0, type=int,
+                        help='sample with continuous batching in a pool of this many crystals at their own timesteps '
+                             '(discrete site symmetry model, eager steps), 0 to sample batch by batch')
+    parser.add_argument('--prune_every', default=0, type=int,
+                        help='every this many steps, drop the crystals with diverged lattices, non finite coordinates '
+                             'or only dummy atoms near t = 0 (discrete site symmetry model, eager steps), 0 to disable')
+    parser.add_argument('--num_shards', default=0, type=int,
+                        help='split the batches into shards, each saved when done and skipped when rerun, 0 to disable')
+    parser.add_argument('--num_workers', default=None, type=int,
+                        help='processes generating the shards, defaults to one per GPU (or 1 on CPU)')
+    parser.add_argument('--seed', default=0, type=int, help='master seed, the seeds of the shards are derived from it')
+    parser.add_argument('--cpu', action='store_true', help='generate the shards on CPU even if GPUs are available')
+    parser.add_argument('--cpu_quantized', action='store_true',
+                        help='sample on CPU with the Linear layers of the decoder quantized to int8 (dynamic quantization)')
+    parser.add_argument('--profile', action='store_true',
+                        help='write the time spent in each stage of sampling to eval_gen_profile.json')
+    parser.add_argument('--profile_cuda_sync', action='store_true',
+                        help='synchronize CUDA around every timer, slower but attributes GPU time to the right stage')
+    parser.add_argument('--torch_trace', action='store_true',
+                        help='with --profile, also write a torch.profiler chrome trace to eval_gen_trace.json (not with --num_shards)')
 
     args = parser.parse_args()
 
@@ -0,0 +1,116 @@
+import sys
+import copy
+import time
+import json
+import argparse
+import platform
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch_geometric.data import DataLoader
+
+sys.path.append('.')
+from scripts.eval_utils import load_model
+from scripts.generation import SampleDataset
+from scripts.compute_metrics import gen_eval_from_arrays
+from symmcd.pl_modules.cspnet import quantize_dynamic_int8
+
+
+def seed_all(seed):
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def step_errors(model, quantized, batch, args):
+    """
+    Differences of the quantized model at every step along the trajectory of the fp32 model: both start from the
+    same state with the same noise, so that the errors of a step do not accumulate into the next ones.
+    """
+    num_steps = args.num_steps or model.beta_scheduler.timesteps
+    stride = model.beta_scheduler.timesteps // num_steps
+    seed_all(args.seed)
+    state, ctx = model.init_sample(batch, args.step_lr, stride=stride)
+    timesteps = torch.arange(model.beta_scheduler.timesteps + 1)
+    steps = []
+    times = {'fp32': 0., 'int8': 0.}
+    for t in range(model.beta_scheduler.timesteps, 0, -stride):
+        outputs = {}
+        for name, m in [('fp32', model), ('int8', quantized)]:
+            torch.manual_seed(args.seed + t)
+            start = time.perf_counter()
+            outputs[name] = m.reverse_step(timesteps[t], *state, ctx)
+            times[name] += time.perf_counter() - start
+        (x, l, k, prob_a, prob_ss), (x_q, l_q, k_q, prob_a_q, prob_ss_q) = outputs['fp32'], outputs['int8']
+        node_mask = ctx['node_mask']
+        # wrapped differences of the fractional coordinates, total variation of the categorical posteriors
+        dx = (x_q - x) - (x_q - x).round()
+        steps.append({
+            't': t,
+            'frac_coords_max_abs': dx.abs().max().item(),
+            'frac_coords_mean_abs': dx.abs().mean().item(),
+            'lattice_rel': ((l_q - l).norm(dim=(-2, -1)) / l.norm(dim=(-2, -1))).mean().item(),
+            'atom_types_tv': (0.5 * (prob_a_q - prob_a).abs().sum(-1))[node_mask].mean().item(),
+            'site_symm_tv': (0.5 * (prob_ss_q - prob_ss).abs().sum(-1) / model.discrete_noise.site_symm_axes)[node_mask].mean().item(),
+        })
+        # the fp32 trajectory goes on
+        t_s, symm_s = model.discrete_noise.sample_discrete_features(prob_a, prob_ss, node_mask)
+        state = (x % 1., l, k, model.from_dense_nodes(t_s, ctx), model.from_dense_nodes(symm_s, ctx))
+
+    keys = [key for key in steps[0] if key != 't']
+    summary = {key: {'mean': float(np.mean([step[key] for step in steps])), 'max': float(np.max([step[key] for step in steps]))}
+               for key in keys}
+    return {'summary': summary, 'step_time_s': times, 'step_speedup': times['fp32'] / times['int8'], 'steps': steps}
+
+
+def gen_eval(model, args):
+    seed_all(args.seed)
+    model.hparams.data.eval_generate_samples = args.num_samples
+    start = time.perf_counter()
+    with torch.no_grad():
+        pred_crys_array_list = model.sample_gen_eval_arrays(num_steps=args.num_steps)
+    sample_time = time.perf_counter() - start
+    metrics = gen_eval_from_arrays(pred_crys_array_list, prop_device='cpu', **model.gen_eval_kwargs())
+    return {'sample_time_s': sample_time, 'metrics': {k: (float(v) if v is not None else None) for k, v in metrics.items()}}
+
+
+def main(args):
+    torch.set_num_threads(args.threads)
+    model, _, cfg = load_model(Path(args.model_path), load_data=False)
+    model.to('cpu').eval()
+    quantized = copy.deepcopy(model)
+    quantized.decoder = quantize_dynamic_int8(model.decoder)
+
+    dataset = SampleDataset(args.dataset, args.batch_size,
+                            train_ori_path=cfg.data.datamodule.datasets.train.save_path,
+                            sg_info_path=cfg.data.datamodule.datasets.train.sg_info_path)
+    seed_all(args.seed)
+    batch = next(iter(DataLoader(dataset, batch_size=args.batch_size)))
+
+    results = {'model_path': args.model_path, 'seed': args.seed, 'threads': args.threads, 'machine': platform.platform(),
+               'quantized_linear_layers': sum(1 for m in quantized.decoder.modules()
+                                              if isinstance(m, torch.ao.nn.quantized.dynamic.Linear))}
+    with torch.no_grad():
+        results['per_step'] = step_errors(model, quantized, batch, args)
+    print(json.dumps({'per_step': results['per_step']['summary'], 'step_speedup': results['per_step']['step_speedup']}, indent=2))
+    if args.num_samples > 0:
+        results['gen_eval'] = {'fp32': gen_eval(model, args), 'int8': gen_eval(quantized, args)}
+        print(json.dumps(results['gen_eval'], indent=2))
+    Path(args.out).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Accuracy and speed of the int8 decoder of generation.py --cpu_quantized')
+    parser.add_argument('--model_path', required=True)
+    parser.add_argument('--dataset', default='mp')
+    parser.add_argument('--batch_size', default=50, type=int, help='crystals of the per step comparison')
+    parser.add_argument('--num_samples', default=500, type=int, help='crystals sampled for the GenEval metrics, 0 to skip')
+    parser.add_argument('--num_steps', default=None, type=int)
+    parser.add_argument('--step_lr', default=1e-5, type=float)
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--threads', default=8, type=int)
+    parser.add_argument('--out', default='quantization_benchmark.json')
+
+    args = parser.parse_args()
+
+    main(args)
@@ -1,4 +1,5 @@
 import time
+import json
 import argparse
 import torch
 
@@ -8,10 +9,16 @@ from pathlib import Path
 from types import SimpleNamespace
 from torch_geometric.data import Data, Batch, DataLoader
 from torch.utils.data import Dataset
-from eval_utils import load_model, lattices_to_params_shape, get_crystals_list
+
+import sys
+sys.path.append('.')
+from scripts.eval_utils import load_model, lattices_to_params_shape, get_crystals_list
+from scripts.generation import SampleDataset as SpacegroupSampleDataset
+from scripts.compute_metrics import Crystal
 
 from pymatgen.core.structure import Structure
 from pymatgen.core.lattice import Lattice
+from pymatgen.core.composition import Composition
 from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
 from pymatgen.io.cif import CifWriter
 from pyxtal.symmetry import Group
@@ -47,6 +54,8 @@ chemical_symbols = [
     'Rf', 'Db', 'Sg', 'Bh', 'Hs', 'Mt', 'Ds', 'Rg', 'Cn', 'Nh', 'Fl', 'Mc',
     'Lv', 'Ts', 'Og']
 
+MAX_ATOMIC_NUM = 94
+
 def diffusion(loader, model, step_lr):
 
     frac_coords = []
@@ -54,14 +63,25 @@ def diffusion(loader, model, step_lr):
     atom_types = []
     lattices = []
     input_data_list = []
+    num_infeasible = 0
     for idx, batch in enumerate(loader):
 
         if torch.cuda.is_available():
             batch.cuda()
         outputs, traj = model.sample(batch, step_lr = step_lr)
+        if len(outputs.get('infeasible_index', [])) > 0:
+            # constrained sampling: the crystals whose site symmetries admit no assignment of the composition are dropped
+            keep = ~torch.isin(outputs['crystal_index'], outputs['infeasible_index'])
+            keep_atoms = keep.repeat_interleave(outputs['num_atoms'])
+            outputs = {'frac_coords': outputs['frac_coords'][keep_atoms], 'atom_types': outputs['atom_types'][keep_atoms],
+                       'num_atoms': outputs['num_atoms'][keep], 'lattices': outputs['lattices'][keep]}
+            num_infeasible += int((~keep).sum())
         frac_coords.append(outputs['frac_coords'].detach().cpu())
         num_atoms.append(outputs['num_atoms'].detach().cpu())
+        # atomic numbers, the atom types of the discrete model are one-hot
         atom_types.append(outputs['atom_types'].detach().cpu())
+        if atom_types[-1].dim() == 2:
+            atom_types[-1] = atom_types[-1].argmax(-1) + 1
         lattices.append(outputs['lattices'].detach().cpu())
 
     frac_coords = torch.cat(frac_coords, dim=0)
@@ -69,9 +89,11 @@ def diffusion(loader, model, step_lr):
     atom_types = torch.cat(atom_types, dim=0)
     lattices = torch.cat(lattices, dim=0)
     lengths, angles = lattices_to_params_shape(lattices)
+    if num_infeasible > 0:
+        print(f"{num_infeasible} crystals dropped, their site symmetries admit no assignment of the composition")
 
     return (
-        frac_coords, atom_types, lattices, lengths, angles, num_atoms
+        frac_coords, atom_types, lattices, lengths, angles, num_atoms, num_infeasible
     )
 
 class SampleDataset(Dataset):
@@ -100,6 +122,51 @@ class SampleDataset(Dataset):
             num_nodes=len(self.chem_list),
         )
 
+class CompositionDataset(Dataset):
+    """
+    Crystals of the discrete site symmetry model for a formula: space groups and numbers of representatives are drawn
+    from the training statistics, with at least one representative per element. With constrained, the reduced
+    composition is set as a vector of counts per atom type, with which sample() can only reach this composition.
+    Otherwise the atom types are unconstrained, as when generating and filtering on the formula.
+    """
+
+    def __init__(self, formula, num_evals, sg_num_atoms, sg_dist, sg_number_binary_mapper, constrained=True):
+        super().__init__()
+        self.num_evals = num_evals
+        self.constrained = constrained
+        self.sg_number_binary_mapper = sg_number_binary_mapper
+        composition = Composition(formula).reduced_composition
+        self.composition = torch.zeros(1, MAX_ATOMIC_NUM)
+        for elem, count in composition.items():
+            if chemical_symbols.index(str(elem)) > MAX_ATOMIC_NUM:
+                raise ValueError(f'{elem} is not an atom type of the model')
+            self.composition[0, chemical_symbols.index(str(elem)) - 1] = count
+        # numbers of representatives that can hold all the elements
+        min_atoms = len(composition)
+        self.sg_num_atoms = {}
+        for sg, dist in sg_num_atoms.items():
+            dist = {n: p for n, p in dist.items() if n >= min_atoms}
+            if sum(dist.values()) > 0:
+                self.sg_num_atoms[sg] = {n: p / sum(dist.values()) for n, p in dist.items()}
+        self.sg_dist = np.array([sg_dist[sg - 1] if sg in self.sg_num_atoms else 0. for sg in range(1, 231)])
+        self.sg_dist = self.sg_dist / self.sg_dist.sum()
+
+    def __len__(self) -> int:
+        return self.num_evals
+
+    def __getitem__(self, index):
+        spacegroup = np.random.choice(230, p = self.sg_dist) + 1
+        num_atom = np.random.choice(list(self.sg_num_atoms[spacegroup].keys()), p = list(self.sg_num_atoms[spacegroup].values()))
+        data = Data(
+            num_atoms=torch.LongTensor([num_atom]),
+            num_nodes=num_atom,
+            spacegroup=spacegroup,
+            sg_condition=self.sg_number_binary_mapper[spacegroup],
+        )
+        if self.constrained:
+            data.composition = self.composition
+        return data
+
 def get_pymatgen(crystal_array):
     frac_coords = crystal_array['frac_coords']
     atom_types = crystal_array['atom_types']
@@ -114,6 +181,46 @@ def get_pymatgen(crystal_array):
     except:
         return None
 
+def count_hits(crystal_list, formula):
+    # structures that can be built, are valid (Crystal) and have the formula
+    target = Composition(formula).reduced_formula
+    hits = 0
+    for crystal_array in crystal_list:
+        structure = get_pymatgen(crystal_array)
+        if structure is None or structure.composition.reduced_formula != target:
+            continue
+        hits += int(Crystal(crystal_array).valid)
+    return hits
+
+
+def compare_filter(args, model, stats, tar_dir):
+    """
+    Samples per valid hit of composition-constrained sampling against the generate-and-filter baseline, with the
+    same space groups and numbers of representatives (same seed).
+    """
+    results = {}
+    for mode in ['filter', 'constrained']:
+        np.random.seed(args.seed)
+        torch.manual_seed(args.seed)
+        test_set = CompositionDataset(args.formula, args.num_evals, *stats, constrained=mode == 'constrained')
+        test_loader = DataLoader(test_set, batch_size = min(args.batch_size, args.num_evals))
+        start_time = time.time()
+        (frac_coords, atom_types, lattices, lengths, angles, num_atoms, num_infeasible) = diffusion(test_loader, model, args.step_lr)
+        sample_time = time.time() - start_time
+        hits = count_hits(get_crystals_list(frac_coords, atom_types, lengths, angles, num_atoms), args.formula)
+        results[mode] = {
+            'samples': args.num_evals,
+            'infeasible': num_infeasible,
+            'valid_hits': hits,
+            'samples_per_hit': args.num_evals / hits if hits > 0 else None,
+            'sample_time_s': sample_time,
+            'seconds_per_hit': sample_time / hits if hits > 0 else None,
+        }
+        print(mode, results[mode])
+    with open(os.path.join(tar_dir, 'composition_benchmark.json'), 'w') as f:
+        json.dump({'formula': args.formula, 'seed': args.seed, **results}, f, indent=2)
+
+
 def main(args):
     # load_data if do reconstruction.
     model_path = Path(args.model_path)
@@ -128,15 +235,29 @@ def main(args):
 
     print('Evaluate the diffusion model.')
 
-    test_set = SampleDataset(args.formula, args.num_evals)
+    if hasattr(model, 'discrete_noise'):
+        # the discrete site symmetry model samples space groups and atom types, only the training statistics are used
+        stats = SpacegroupSampleDataset(args.dataset, 0,
+                                        train_ori_path=cfg.data.datamodule.datasets.train.save_path,
+                                        sg_info_path=cfg.data.datamodule.datasets.train.sg_info_path)
+        stats = (stats.sg_num_atoms, stats.sg_dist, stats.sg_number_binary_mapper)
+        if args.compare_filter:
+            compare_filter(args, model, stats, tar_dir)
+            return
+        test_set = CompositionDataset(args.formula, args.num_evals, *stats, constrained=args.constrained)
+    else:
+        test_set = SampleDataset(args.formula, args.num_evals)
     test_loader = DataLoader(test_set, batch_size = min(args.batch_size, args.num_evals))
 
     start_time = time.time()
-    (frac_coords, atom_types, lattices, lengths, angles, num_atoms) = diffusion(test_loader, model, args.step_lr)
+    (frac_coords, atom_types, lattices, lengths, angles, num_atoms, _) = diffusion(test_loader, model, args.step_lr)
 
     crystal_list = get_crystals_list(frac_coords, atom_types, lengths, angles, num_atoms)
 
     strcuture_list = p_map(get_pymatgen, crystal_list)
+    target = Composition(args.formula).reduced_formula
+    num_hits = sum(structure is not None and structure.composition.reduced_formula == target for structure in strcuture_list)
+    print(f"{num_hits}/{len(strcuture_list)} structures with the formula {target}")
 
     for i,structure in enumerate(strcuture_list):
         tar_file = os.path.join(tar_dir, f"{args.formula}_{i+1}.cif")
@@ -156,6 +277,15 @@ if __name__ == '__main__':
     parser.add_argument('--num_evals', default=1, type=int)
     parser.add_argument('--batch_size', default=500, type=int)
     parser.add_argument('--step_lr', default=1e-5, type=float)
+    parser.add_argument('--dataset', default='mp',
+                        help='discrete site symmetry model: mp, perov or carbon, as in scripts/generation.py')
+    parser.add_argument('--constrained', action='store_true',
+                        help='discrete site symmetry model: constrain the atom types to the formula instead of '
+                             'sampling them freely (generate and filter)')
+    parser.add_argument('--compare_filter', action='store_true',
+                        help='discrete site symmetry model: write the samples per valid hit of constrained sampling '
+                             'and of generate and filter to composition_benchmark.json instead of cif files')
+    parser.add_argument('--seed', default=0, type=int)
 
     args = parser.parse_args()
 
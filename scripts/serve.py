@@ -0,0 +1,310 @@
+import time
+import json
+import argparse
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+import queue
+
+import numpy as np
+import torch
+from torch_geometric.data import Data, Batch
+from pymatgen.core.structure import Structure
+from pymatgen.core.lattice import Lattice
+from pymatgen.core.composition import Composition
+from pymatgen.io.cif import CifWriter
+
+import sys
+sys.path.append('.')
+from scripts.eval_utils import load_model, lattices_to_params_shape, get_crystals_list
+from scripts.generation import SampleDataset
+from symmcd.common.data_utils import chemical_symbols
+from symmcd.common.bundle import load_bundle
+
+
+class GenerationRequest:
+    """
+    num_crystals crystals of the given space groups (any of them, drawn with the training distribution restricted to
+    them), number of atoms in the asymmetric unit and reduced formula. The formula is a filter on the generated
+    crystals, which are generated again until num_crystals match or max_attempts * num_crystals were generated.
+    """
+    def __init__(self, num_crystals, spacegroups=None, num_atoms=None, formula=None, fmt='cif'):
+        self.num_crystals = num_crystals
+        self.spacegroups = spacegroups
+        self.num_atoms = num_atoms
+        self.formula = Composition(formula).reduced_formula if formula is not None else None
+        self.fmt = fmt
+        self.to_schedule = num_crystals
+        self.scheduled = 0
+        self.delivered = 0
+        self.generated = 0
+        self.done = False
+        self.results = queue.Queue()
+        self.start_time = time.perf_counter()
+
+
+class BatchWorker(threading.Thread):
+    """
+    Runs model.sample on batches made of the crystals of all waiting requests, up to max_batch_size crystals,
+    waiting at most max_wait_ms after the first request for others to join the batch.
+    """
+    def __init__(self, model, stats, args):
+        super().__init__(daemon=True)
+        self.model = model
+        # space group and number of atom distributions of the training set
+        self.sg_num_atoms, self.sg_dist, self.sg_number_binary_mapper = stats
+        self.args = args
+        self.pending = deque()
+        self.cond = threading.Condition()
+        self.counters = {'batches': 0, 'crystals': 0, 'sample_time_s': 0., 'requests': 0}
+
+    def validate(self, request):
+        spacegroups = request.spacegroups or list(range(1, 231))
+        known = [sg for sg in spacegroups if sg in self.sg_number_binary_mapper]
+        if len(known) == 0:
+            raise ValueError(f'none of the space groups {request.spacegroups} is in the training set')
+        if request.num_atoms is None and not any(sg in self.sg_num_atoms for sg in known):
+            raise ValueError('num_atoms is required for these space groups')
+        if request.fmt not in ['cif', 'arrays']:
+            raise ValueError(f'unknown format {request.fmt}')
+
+    def submit(self, request):
+        self.validate(request)
+        with self.cond:
+            self.pending.append(request)
+            self.counters['requests'] += 1
+            self.cond.notify()
+
+    def sample_data(self, request):
+        if request.spacegroups is None:
+            spacegroup = np.random.choice(230, p=self.sg_dist) + 1
+        else:
+            spacegroups = np.array([sg for sg in request.spacegroups if sg in self.sg_number_binary_mapper])
+            p = self.sg_dist[spacegroups - 1]
+            p = p / p.sum() if p.sum() > 0 else np.full(len(spacegroups), 1. / len(spacegroups))
+            spacegroup = np.random.choice(spacegroups, p=p)
+        if request.num_atoms is not None:
+            num_atom = request.num_atoms
+        else:
+            num_atom = np.random.choice(list(self.sg_num_atoms[spacegroup].keys()), p=list(self.sg_num_atoms[spacegroup].values()))
+        return Data(
+            num_atoms=torch.LongTensor([num_atom]),
+            num_nodes=num_atom,
+            spacegroup=spacegroup,
+            sg_condition=self.sg_number_binary_mapper[spacegroup],
+        )
+
+    def next_batch(self):
+        with self.cond:
+            while not self.pending:
+                self.cond.wait()
+            deadline = time.perf_counter() + self.args.max_wait_ms / 1000
+            while sum(r.to_schedule for r in self.pending) < self.args.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            # first come first served, a request larger than a batch is spread over several batches
+            owners = []
+            while self.pending and len(owners) < self.args.max_batch_size:
+                request = self.pending[0]
+                n = min(request.to_schedule, self.args.max_batch_size - len(owners))
+                owners.extend([request] * n)
+                request.to_schedule -= n
+                request.scheduled += n
+                if request.to_schedule == 0:
+                    self.pending.popleft()
+        return owners
+
+    def reschedule(self, request):
+        # crystals that came out empty or did not match the formula are generated again
+        with self.cond:
+            if request.done:
+                return
+            if request.delivered >= request.num_crystals or request.generated >= self.args.max_attempts * request.num_crystals:
+                request.done = True
+                request.to_schedule = 0
+                if request in self.pending:
+                    self.pending.remove(request)
+                request.results.put(None if request.delivered >= request.num_crystals else RuntimeError(
+                    f'only {request.delivered} matching crystals after {request.generated} attempts'))
+            elif request.scheduled == 0 and request.to_schedule == 0:
+                request.to_schedule = request.num_crystals - request.delivered
+                self.pending.append(request)
+                self.cond.notify()
+
+    def sample_batch(self, owners):
+        batch = Batch.from_data_list([self.sample_data(request) for request in owners]).to(self.model.device)
+        start = time.perf_counter()
+        with torch.no_grad():
+            outputs, traj = self.model.sample(batch, step_lr=self.args.step_lr, **self.args.sample_kwargs)
+        del traj
+        self.counters['sample_time_s'] += time.perf_counter() - start
+        self.counters['batches'] += 1
+        self.counters['crystals'] += len(owners)
+
+        crystal_index = outputs['crystal_index'].cpu()
+        lengths, angles = lattices_to_params_shape(outputs['lattices'].cpu())
+        crystals = get_crystals_list(
+            outputs['frac_coords'].cpu(), outputs['atom_types'].cpu(), lengths, angles, outputs['num_atoms'].cpu(),
+            spacegroups=batch.spacegroup.cpu()[crystal_index], site_symmetries=outputs['site_symm'].cpu())
+        for request in owners:
+            request.generated += 1
+        for i, crystal in zip(crystal_index.tolist(), crystals):
+            request = owners[i]
+            if request.delivered >= request.num_crystals:
+                continue
+            if request.formula is not None and formula(crystal) != request.formula:
+                continue
+            request.delivered += 1
+            request.results.put(crystal)
+
+    def run(self):
+        while True:
+            owners = self.next_batch()
+            try:
+                self.sample_batch(owners)
+            except Exception as e:
+                # fail the requests of the batch instead of the worker
+                for request in dict.fromkeys(owners):
+                    with self.cond:
+                        request.done = True
+                        if request in self.pending:
+                            self.pending.remove(request)
+                    request.results.put(e)
+            finally:
+                # the crystals of the batch are no longer in flight, whether it succeeded or not
+                with self.cond:
+                    for request in owners:
+                        request.scheduled -= 1
+                for request in dict.fromkeys(owners):
+                    self.reschedule(request)
+
+def species(crystal):
+    # atomic numbers, the atom types of the discrete model are one-hot
+    atom_types = crystal['atom_types']
+    return atom_types.argmax(-1) + 1 if atom_types.ndim == 2 else atom_types
+
+
+def formula(crystal):
+    elements, counts = np.unique(species(crystal), return_counts=True)
+    return Composition({chemical_symbols[z]: int(n) for z, n in zip(elements.tolist(), counts)}).reduced_formula
+
+
+def crystal_to_json(crystal, fmt):
+    if fmt == 'arrays':
+        return {**{k: v.tolist() for k, v in crystal.items()}, 'atom_types': species(crystal).tolist()}
+    structure = Structure(
+        lattice=Lattice.from_parameters(*(crystal['lengths'].tolist() + crystal['angles'].tolist())),
+        species=species(crystal).tolist(), coords=crystal['frac_coords'], coords_are_cartesian=False)
+    return {'cif': str(CifWriter(structure)), 'spacegroup': int(crystal['spacegroups'])}
+
+
+def make_handler(worker):
+    class Handler(BaseHTTPRequestHandler):
+        # HTTP/1.0: the response is streamed and ends when the connection is closed
+
+        def send_json(self, code, obj):
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(obj).encode())
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self.send_json(200, worker.counters)
+            else:
+                self.send_json(404, {'error': f'unknown path {self.path}'})
+
+        def do_POST(self):
+            if self.path != '/generate':
+                self.send_json(404, {'error': f'unknown path {self.path}'})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                request = GenerationRequest(int(body.get('num_crystals', 1)), body.get('spacegroups'),
+                                            body.get('num_atoms'), body.get('formula'), body.get('format', 'cif'))
+                worker.submit(request)
+            except (ValueError, KeyError, TypeError) as e:
+                self.send_json(400, {'error': str(e)})
+                return
+
+            # one json object per line and per crystal, as they are generated
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.end_headers()
+            index = 0
+            while True:
+                result = request.results.get()
+                if result is None or isinstance(result, Exception):
+                    break
+                try:
+                    line = {'index': index, **crystal_to_json(result, request.fmt)}
+                except Exception as e:
+                    # e.g. a degenerate lattice that pymatgen rejects
+                    line = {'index': index, 'error': str(e)}
+                self.wfile.write((json.dumps(line) + '\n').encode())
+                self.wfile.flush()
+                index += 1
+            done = {'done': True, 'num_crystals': index, 'generated': request.generated,
+                    'latency_s': time.perf_counter() - request.start_time}
+            if isinstance(result, Exception):
+                done['error'] = str(result)
+            self.wfile.write((json.dumps(done) + '\n').encode())
+
+        def log_message(self, format, *args):
+            if worker.args.verbose:
+                super().log_message(format, *args)
+
+    return Handler
+
+
+def main(args):
+    model_path = Path(args.model_path)
+    stats = None
+    if model_path.is_file():
+        # inference bundle of scripts/export_bundle.py, with the space group statistics
+        model, cfg, stats = load_bundle(model_path)
+    else:
+        model, _, cfg = load_model(model_path, load_data=False)
+    if torch.cuda.is_available() and not args.cpu:
+        model.to('cuda')
+    model.eval()
+    args.sample_kwargs = {k: v for k, v in [('step_mode', args.step_mode), ('num_steps', args.num_steps)]
+                          if v is not None}
+
+    if stats is None:
+        # only the training statistics of SampleDataset are used
+        dataset = SampleDataset(args.dataset, 0,
+                                train_ori_path=cfg.data.datamodule.datasets.train.save_path,
+                                sg_info_path=cfg.data.datamodule.datasets.train.sg_info_path)
+        stats = (dataset.sg_num_atoms, dataset.sg_dist, dataset.sg_number_binary_mapper)
+    worker = BatchWorker(model, stats, args)
+    worker.start()
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(worker))
+    print(f'Serving {model_path} on http://{args.host}:{args.port} (POST /generate, GET /stats)')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', required=True, help='model directory or inference bundle')
+    parser.add_argument('--dataset', required=True, help='mp, perov or carbon, as in scripts/generation.py')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', default=8765, type=int)
+    parser.add_argument('--max_batch_size', default=500, type=int, help='crystals per sample() call')
+    parser.add_argument('--max_wait_ms', default=50., type=float,
+                        help='time a batch waits for more requests before sampling when it is not full')
+    parser.add_argument('--max_attempts', default=20, type=int,
+                        help='crystals generated per requested crystal before a request fails (formula filter)')
+    parser.add_argument('--step_lr', default=1e-5, type=float)
+    parser.add_argument('--step_mode', default=None, choices=['eager', 'compile', 'cuda_graph'])
+    parser.add_argument('--num_steps', default=None, type=int, help='sampling steps, e.g. for distilled models')
+    parser.add_argument('--cpu', action='store_true')
+    parser.add_argument('--verbose', action='store_true', help='log every http request')
+
+    args = parser.parse_args()
+
+    main(args)
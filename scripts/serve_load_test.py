@@ -0,0 +1,93 @@
+import time
+import json
+import argparse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def generate(args, request_id):
+    body = {'num_crystals': args.num_crystals, 'format': args.format}
+    if args.spacegroups is not None:
+        body['spacegroups'] = args.spacegroups
+    if args.num_atoms is not None:
+        body['num_atoms'] = args.num_atoms
+    if args.formula is not None:
+        body['formula'] = args.formula
+    request = urllib.request.Request(f'{args.url}/generate', data=json.dumps(body).encode(),
+                                     headers={'Content-Type': 'application/json'})
+    start = time.perf_counter()
+    first = None
+    result = {'crystals': 0, 'errors': 0}
+    with urllib.request.urlopen(request, timeout=args.timeout) as response:
+        for line in response:
+            line = json.loads(line)
+            if line.get('done', False):
+                result['server_error'] = line.get('error')
+                break
+            if first is None:
+                first = time.perf_counter() - start
+            result['crystals'] += 1
+            result['errors'] += 'error' in line
+    result['latency_s'] = time.perf_counter() - start
+    result['first_crystal_s'] = first
+    return result
+
+
+def percentiles(values):
+    values = [v for v in values if v is not None]
+    if len(values) == 0:
+        return None
+    return {'mean': float(np.mean(values)), **{f'p{q}': float(np.percentile(values, q)) for q in [50, 90, 99]}}
+
+
+def main(args):
+    stats_before = json.loads(urllib.request.urlopen(f'{args.url}/stats').read())
+    start = time.perf_counter()
+    # concurrency clients, each sending its requests one after the other
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        results = list(pool.map(lambda i: generate(args, i), range(args.num_requests)))
+    wall = time.perf_counter() - start
+    stats_after = json.loads(urllib.request.urlopen(f'{args.url}/stats').read())
+
+    batches = stats_after['batches'] - stats_before['batches']
+    sampled = stats_after['crystals'] - stats_before['crystals']
+    crystals = sum(r['crystals'] for r in results)
+    report = {
+        'settings': vars(args),
+        'wall_time_s': wall,
+        'requests_per_s': args.num_requests / wall,
+        'crystals_per_s': crystals / wall,
+        'latency_s': percentiles([r['latency_s'] for r in results]),
+        'first_crystal_s': percentiles([r['first_crystal_s'] for r in results]),
+        'crystals': crystals,
+        'crystal_errors': sum(r['errors'] for r in results),
+        'failed_requests': sum(r.get('server_error') is not None for r in results),
+        # how well requests were coalesced
+        'batches': batches,
+        'mean_batch_size': sampled / max(batches, 1),
+        'sample_time_s': stats_after['sample_time_s'] - stats_before['sample_time_s'],
+    }
+    print(json.dumps(report, indent=2))
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://127.0.0.1:8765')
+    parser.add_argument('--num_requests', default=64, type=int)
+    parser.add_argument('--concurrency', default=16, type=int)
+    parser.add_argument('--num_crystals', default=4, type=int, help='crystals per request')
+    parser.add_argument('--spacegroups', nargs='+', type=int, default=None)
+    parser.add_argument('--num_atoms', default=None, type=int)
+    parser.add_argument('--formula', default=None)
+    parser.add_argument('--format', default='cif', choices=['cif', 'arrays'])
+    parser.add_argument('--timeout', default=3600., type=float)
+    parser.add_argument('--out', default=None, help='optional json report')
+
+    args = parser.parse_args()
+
+    main(args)
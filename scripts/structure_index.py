@@ -0,0 +1,304 @@
+import os
+import bisect
+from collections import Counter, defaultdict
+from functools import lru_cache, partial
+
+import numpy as np
+import torch
+from p_tqdm import p_map
+from tqdm import tqdm
+from pymatgen.core.structure import Structure
+from pymatgen.core.lattice import Lattice
+from pyxtal import pyxtal
+from pyxtal.symmetry import Group
+
+SITE_SYMM_AXES = 15
+SITE_SYMM_PGS = 13
+INDEX_VERSION = 1
+# symmetry tolerance of the keys, both sides of a comparison have to be keyed with the same one
+KEY_SYMPREC = 0.01
+
+
+@lru_cache(maxsize=None)
+def wyckoff_classes(spacegroup):
+    """
+    Site symmetries (num_classes, SITE_SYMM_AXES * SITE_SYMM_PGS) of the Wyckoff positions of a space group, one per
+    distinct site symmetry, with the label of the first position having it. Positions with the same site symmetry
+    (e.g. 4a and 4b of Fm-3m) cannot be told apart from the site symmetry outputs, so they share a label.
+    """
+    site_symms, labels = [], []
+    for wp in Group(spacegroup).Wyckoff_positions:
+        wp.get_site_symmetry()
+        site_symm = np.asarray(wp.get_site_symmetry_object().to_one_hot(), dtype=np.float32).reshape(-1)
+        if not any(np.array_equal(site_symm, other) for other in site_symms):
+            site_symms.append(site_symm)
+            labels.append(wp.get_label())
+    return np.stack(site_symms), labels
+
+
+def wyckoff_multiset(spacegroup, site_symm, counts=None):
+    # sorted (label, number of atoms) pairs, the site symmetry of every row matched to the closest class
+    site_symms, labels = wyckoff_classes(spacegroup)
+    site_symm = np.asarray(site_symm, dtype=np.float32)
+    # without the mask token of the masked prior, if any
+    site_symm = site_symm.reshape(len(site_symm), SITE_SYMM_AXES, -1)[..., :SITE_SYMM_PGS].reshape(len(site_symm), -1)
+    closest = np.linalg.norm(site_symm[:, None] - site_symms[None], axis=-1).argmin(-1)
+    counts = np.ones(len(closest), dtype=int) if counts is None else counts
+    counter = Counter()
+    for c, n in zip(closest, counts):
+        counter[labels[c]] += int(n)
+    return tuple(sorted(counter.items()))
+
+
+def sampled_key(structure, spacegroup, site_symmetries):
+    """
+    Invariant key of a generated structure from the sampled space group and the site symmetries of its atoms:
+    (reduced formula, space group, multiset of Wyckoff labels weighted by atoms). Free, unlike detected_key, but the
+    sampled symmetry of a structure can differ from the one detected in it.
+    """
+    spacegroup = int(spacegroup)
+    return (structure.composition.reduced_formula, spacegroup, wyckoff_multiset(spacegroup, site_symmetries))
+
+
+def detected_key(structure, symprec=KEY_SYMPREC):
+    # the key of sampled_key with the symmetry detected by pyxtal (as in get_symmetry_info), formula only on failure
+    formula = structure.composition.reduced_formula
+    xtal = pyxtal()
+    try:
+        xtal.from_seed(structure, tol=symprec)
+    except Exception:
+        return (formula, None, None)
+    spacegroup = xtal.group.number
+    site_symms, counts = [], []
+    for site in xtal.atom_sites:
+        site.wp.get_site_symmetry()
+        site_symms.append(np.asarray(site.wp.get_site_symmetry_object().to_one_hot()).reshape(-1))
+        counts.append(site.wp.multiplicity)
+    return (formula, spacegroup, wyckoff_multiset(spacegroup, np.stack(site_symms), counts))
+
+
+def volume_per_atom(structure):
+    return structure.volume / len(structure)
+
+
+def structure_arrays(structure):
+    return {'lattice': structure.lattice.matrix, 'frac_coords': structure.frac_coords,
+            'atom_types': np.array(structure.atomic_numbers)}
+
+
+def arrays_structure(arrays):
+    return Structure(Lattice(arrays['lattice']), arrays['atom_types'], arrays['frac_coords'])
+
+
+def index_entry(structure, symprec=KEY_SYMPREC):
+    if isinstance(structure, str):
+        structure = Structure.from_str(structure, fmt='cif')
+    return structure_arrays(structure), volume_per_atom(structure), detected_key(structure, symprec)
+
+
+def within_volume(vpa, other_vpa, vol_tol):
+    return vol_tol is None or abs(vpa - other_vpa) <= vol_tol * other_vpa
+
+
+def matcher_vol_tol(matcher, vol_tol):
+    # the volume window is only exact for matchers that do not rescale volumes, it is skipped for the others
+    return None if getattr(matcher, 'scale', False) else vol_tol
+
+
+def matches(matcher, structure, other):
+    try:
+        return matcher.fit(structure, other)
+    except Exception:
+        return False
+
+
+def dedup_bucket(bucket, matcher, vol_tol=None):
+    """
+    bucket: (index, vpa, structure) of structures with the same key. Every structure is compared to the first
+    structures of the groups found so far (in order of index) whose volume per atom is within vol_tol.
+    Returns the indices of the structures that are not duplicates of an earlier one.
+    """
+    representatives = []
+    for index, vpa, structure in sorted(bucket, key=lambda member: member[0]):
+        if not any(within_volume(vpa, rep_vpa, vol_tol) and matches(matcher, structure, rep)
+                   for _, rep_vpa, rep in representatives):
+            representatives.append((index, vpa, structure))
+    return [index for index, _, _ in representatives]
+
+
+def match_bucket(task, matcher, vol_tol=None):
+    # task: (queries, candidates) of one key, (index, vpa, structure) and (vpa, arrays). Returns the matched indices
+    queries, candidates = task
+    candidates = [(vpa, arrays_structure(arrays)) for vpa, arrays in candidates]
+    return [index for index, vpa, structure in queries
+            if any(within_volume(vpa, other_vpa, vol_tol) and matches(matcher, structure, other)
+                   for other_vpa, other in candidates)]
+
+
+def run_buckets(func, tasks, sizes, num_workers=None):
+    num_workers = os.cpu_count() if num_workers is None else num_workers
+    if num_workers <= 1 or len(tasks) <= 1:
+        return [func(task) for task in tqdm(tasks)]
+    # the largest buckets first, so that they do not end up last on a single worker
+    order = sorted(range(len(tasks)), key=lambda i: -sizes[i])
+    results = dict(zip(order, p_map(func, [tasks[i] for i in order], num_cpus=num_workers)))
+    return [results[i] for i in range(len(tasks))]
+
+
+def default_matcher(**kwargs):
+    from pymatgen.analysis.structure_matcher import StructureMatcher
+    return StructureMatcher(**kwargs)
+
+
+def unique_flags(structures, keys, vol_tol=0.1, num_workers=None, matcher=None):
+    """
+    Whether every structure is the first of its duplicates. Stage 1 buckets the structures by key, stage 2 runs
+    StructureMatcher only within buckets (in parallel over buckets), and only for volumes per atom within vol_tol
+    when the matcher does not rescale volumes (scale=False, the default StructureMatcher does).
+    """
+    matcher = default_matcher() if matcher is None else matcher
+    vol_tol = matcher_vol_tol(matcher, vol_tol)
+    buckets = defaultdict(list)
+    for index, (structure, key) in enumerate(zip(structures, keys)):
+        buckets[key].append((index, volume_per_atom(structure), structure))
+    unique = np.zeros(len(structures), dtype=bool)
+    single = [bucket[0][0] for bucket in buckets.values() if len(bucket) == 1]
+    unique[single] = True
+    tasks = [bucket for bucket in buckets.values() if len(bucket) > 1]
+    sizes = [len(bucket) ** 2 for bucket in tasks]
+    for indices in run_buckets(partial(dedup_bucket, matcher=matcher, vol_tol=vol_tol), tasks, sizes, num_workers):
+        unique[indices] = True
+    return unique
+
+
+class StructureIndex(object):
+    """
+    Reference structures (e.g. the training set) bucketed by the key of detected_key and sorted by volume per atom
+    within a bucket, persisted with torch.save. The keys of the reference structures, whose symmetry detection is the
+    expensive part, are computed once when the index is built, so that the novelty of a new batch only needs the keys
+    of the batch and StructureMatcher within the matching buckets.
+    """
+
+    def __init__(self, symprec=KEY_SYMPREC, vol_tol=0.1):
+        self.symprec = symprec
+        self.vol_tol = vol_tol
+        self.entries = []
+        # key -> sorted [(vpa, entry index)]
+        self.buckets = defaultdict(list)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, structures, num_workers=None):
+        """
+        Adds pymatgen structures or cif strings, their keys are computed in parallel.
+        """
+        func = partial(index_entry, symprec=self.symprec)
+        if num_workers == 1 or len(structures) <= 1:
+            entries = [func(structure) for structure in tqdm(structures)]
+        else:
+            entries = p_map(func, list(structures), num_cpus=num_workers or os.cpu_count())
+        for arrays, vpa, key in entries:
+            self.buckets[key].append((vpa, len(self.entries)))
+            self.entries.append(arrays)
+        for bucket in self.buckets.values():
+            bucket.sort()
+
+    def candidates(self, key, vpa, vol_tol=None):
+        # (vpa, arrays) of the entries with this key and a volume per atom within vol_tol of vpa
+        bucket = self.buckets.get(key, [])
+        if vol_tol is None:
+            return [(other_vpa, self.entries[i]) for other_vpa, i in bucket]
+        start = bisect.bisect_left(bucket, (vpa / (1 + vol_tol), -1))
+        end = bisect.bisect_right(bucket, (vpa / (1 - vol_tol), len(self.entries))) if vol_tol < 1 else len(bucket)
+        return [(other_vpa, self.entries[i]) for other_vpa, i in bucket[start:end]]
+
+    def novel_flags(self, structures, keys, num_workers=None, matcher=None, recheck_detected=False):
+        """
+        Whether every structure matches none of the indexed structures, keys as given by sampled_key or detected_key.
+        The volume window vol_tol only applies to matchers that do not rescale volumes. With recheck_detected, the
+        structures found novel under their (sampled) keys are keyed again by detected_key at self.symprec, the
+        symmetry detection of the index, and those whose key changes are matched again under it. Only the structures
+        that look novel then pay for the symmetry detection.
+        """
+        matcher = default_matcher() if matcher is None else matcher
+        vol_tol = matcher_vol_tol(matcher, self.vol_tol)
+        queries = defaultdict(list)
+        for index, (structure, key) in enumerate(zip(structures, keys)):
+            queries[key].append((index, volume_per_atom(structure), structure))
+        tasks = []
+        for key, members in queries.items():
+            candidates = {}
+            for _, vpa, _ in members:
+                for other_vpa, arrays in self.candidates(key, vpa, vol_tol):
+                    candidates[id(arrays)] = (other_vpa, arrays)
+            if len(candidates) > 0:
+                tasks.append((members, list(candidates.values())))
+        novel = np.ones(len(structures), dtype=bool)
+        sizes = [len(members) * len(candidates) for members, candidates in tasks]
+        func = partial(match_bucket, matcher=matcher, vol_tol=vol_tol)
+        for indices in run_buckets(func, tasks, sizes, num_workers):
+            novel[indices] = False
+
+        if recheck_detected and novel.any():
+            recheck = np.flatnonzero(novel)
+            detected = detect_keys([structures[i] for i in recheck], self.symprec, num_workers)
+            changed = [(i, key) for i, key in zip(recheck.tolist(), detected) if key != keys[i]]
+            if len(changed) > 0:
+                renovel = self.novel_flags([structures[i] for i, _ in changed], [key for _, key in changed],
+                                           num_workers=num_workers, matcher=matcher)
+                novel[[i for i, _ in changed]] = renovel
+        return novel
+
+    def save(self, path):
+        torch.save({'version': INDEX_VERSION, 'symprec': self.symprec, 'vol_tol': self.vol_tol,
+                    'entries': self.entries, 'buckets': dict(self.buckets)}, path)
+
+    @classmethod
+    def load(cls, path):
+        state = torch.load(path)
+        if state.get('version', None) != INDEX_VERSION:
+            raise ValueError(f'{path} is not a structure index of version {INDEX_VERSION}')
+        index = cls(symprec=state['symprec'], vol_tol=state['vol_tol'])
+        index.entries = state['entries']
+        index.buckets = defaultdict(list, state['buckets'])
+        return index
+
+    @classmethod
+    def load_or_build(cls, path, csv_path=None, num_workers=None, **kwargs):
+        """
+        The index saved at path, or the index of the cif column of csv_path, saved to path.
+        """
+        if os.path.exists(path):
+            return cls.load(path)
+        import pandas as pd
+        index = cls(**kwargs)
+        index.add(list(pd.read_csv(csv_path)['cif']), num_workers=num_workers)
+        index.save(path)
+        return index
+
+
+def detect_keys(structures, symprec=KEY_SYMPREC, num_workers=None):
+    func = partial(detected_key, symprec=symprec)
+    if num_workers == 1 or len(structures) <= 1:
+        return [func(structure) for structure in structures]
+    return p_map(func, list(structures), num_cpus=num_workers or os.cpu_count())
+
+
+def crystal_keys(crystals, symprec=KEY_SYMPREC, num_workers=None):
+    """
+    Keys of Crystal objects (with a structure): from the sampled space group and site symmetries when the crystal
+    has them (generation outputs), which needs no symmetry detection, detected at symprec otherwise (in parallel).
+    Sampled keys can differ from the detected keys of a StructureIndex, see novel_flags(recheck_detected=True).
+    """
+    keys = [None] * len(crystals)
+    detect = []
+    for i, crystal in enumerate(crystals):
+        if crystal.spacegroup is not None and 'site_symmetries' in crystal.dict:
+            keys[i] = sampled_key(crystal.structure, crystal.spacegroup, crystal.dict['site_symmetries'])
+        else:
+            detect.append(i)
+    if len(detect) > 0:
+        for i, key in zip(detect, detect_keys([crystals[i].structure for i in detect], symprec, num_workers)):
+            keys[i] = key
+    return keys
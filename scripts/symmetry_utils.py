@@ -0,0 +1,176 @@
+import os
+import time
+import pickle
+import hashlib
+import multiprocessing as mp
+from multiprocessing.connection import wait
+
+import numpy as np
+import spglib
+from tqdm import tqdm
+
+import sys
+sys.path.append('.')
+
+from symmcd.common.data_utils import lattice_params_to_matrix
+
+# pymatgen's SpacegroupAnalyzer default, used so results match the previous code path
+ANGLE_TOLERANCE = 5.0
+# spacegroup reported when symmetry detection fails or times out (same fallback as Crystal.get_symmetry)
+DEFAULT_SPACEGROUP = 1
+# spglib is fast on most structures, a few workers are enough to absorb the slow ones
+DEFAULT_WORKERS = 4
+
+
+def crystal_to_cell(lengths, angles, frac_coords, atom_types):
+    lattice = lattice_params_to_matrix(*(np.asarray(lengths).tolist() + np.asarray(angles).tolist()))
+    return (np.asarray(lattice, dtype=float),
+            np.asarray(frac_coords, dtype=float).reshape(-1, 3),
+            np.asarray(atom_types, dtype=int).reshape(-1))
+
+
+def structure_to_cell(structure):
+    return (structure.lattice.matrix, structure.frac_coords,
+            np.array([site.specie.Z for site in structure]))
+
+
+def cell_hash(cell, symprec, angle_tolerance=ANGLE_TOLERANCE, decimals=6):
+    lattice, frac_coords, numbers = cell
+    h = hashlib.sha1()
+    h.update(np.round(lattice, decimals).astype(np.float64).tobytes())
+    h.update(np.round(np.asarray(frac_coords) % 1., decimals).astype(np.float64).tobytes())
+    h.update(np.asarray(numbers, dtype=np.int64).tobytes())
+    h.update(f'{symprec}-{angle_tolerance}'.encode())
+    return h.hexdigest()
+
+
+def get_spacegroup_number(cell, symprec=0.1, angle_tolerance=ANGLE_TOLERANCE):
+    """Spacegroup number of a (lattice, frac_coords, numbers) cell, or None if spglib fails."""
+    try:
+        dataset = spglib.get_symmetry_dataset(cell, symprec=symprec, angle_tolerance=angle_tolerance)
+    except Exception:
+        return None
+    if dataset is None:
+        return None
+    return int(dataset['number'])
+
+
+def detection_worker(conn, symprec, angle_tolerance):
+    # detects the spacegroups of the cells sent through conn, one at a time, until it is closed
+    while True:
+        try:
+            cell = conn.recv()
+        except EOFError:
+            return
+        conn.send(get_spacegroup_number(cell, symprec, angle_tolerance))
+
+
+class SymmetryService(object):
+    """
+    Batched spacegroup detection with per-structure time limits and a hash cache.
+
+    Cells are sent one at a time to `num_workers` worker processes (DEFAULT_WORKERS or the number
+    of cpus if fewer). If a structure does not finish within `timeout` seconds of being sent, its
+    worker is killed and replaced, and only that structure is reported as DEFAULT_SPACEGROUP.
+    Timeouts and failures are not cached, so they are detected again by later calls.
+    With num_workers=0 everything runs in the current process without time limits.
+    """
+
+    def __init__(self, symprec=0.1, angle_tolerance=ANGLE_TOLERANCE, timeout=10.,
+                 num_workers=None, cache_path=None):
+        self.symprec = symprec
+        self.angle_tolerance = angle_tolerance
+        self.timeout = timeout
+        self.num_workers = min(DEFAULT_WORKERS, os.cpu_count()) if num_workers is None else num_workers
+        self.cache_path = cache_path
+        self.cache = {}
+        self.num_timeouts = 0
+        if cache_path is not None and os.path.exists(cache_path):
+            with open(cache_path, 'rb') as f:
+                self.cache = pickle.load(f)
+
+    def save_cache(self):
+        if self.cache_path is not None:
+            with open(self.cache_path, 'wb') as f:
+                pickle.dump(self.cache, f)
+
+    def get_spacegroups_from_cells(self, cells):
+        keys = [cell_hash(cell, self.symprec, self.angle_tolerance) for cell in cells]
+        missing = {}
+        for key, cell in zip(keys, cells):
+            if key not in self.cache and key not in missing:
+                missing[key] = cell
+        if len(missing) > 0:
+            if self.num_workers == 0:
+                results = {key: get_spacegroup_number(cell, self.symprec, self.angle_tolerance)
+                           for key, cell in tqdm(missing.items())}
+            else:
+                results = self._run_pool(missing)
+            for key, number in results.items():
+                if number is not None:
+                    self.cache[key] = number
+            self.save_cache()
+        return [self.cache.get(key, DEFAULT_SPACEGROUP) for key in keys]
+
+    def get_spacegroups(self, crystals):
+        """Spacegroup numbers for a list of constructed `Crystal` objects."""
+        cells = [crystal_to_cell(c.lengths, c.angles, c.frac_coords, c.atom_types) for c in crystals]
+        return self.get_spacegroups_from_cells(cells)
+
+    def start_worker(self):
+        conn, worker_conn = mp.Pipe()
+        process = mp.Process(target=detection_worker, args=(worker_conn, self.symprec, self.angle_tolerance),
+                             daemon=True)
+        process.start()
+        worker_conn.close()
+        return process, conn
+
+    def stop_worker(self, worker, kill=False):
+        process, conn = worker
+        if kill:
+            process.kill()
+        conn.close()
+        process.join()
+
+    def _run_pool(self, cells):
+        results = {}
+        pending = list(cells.items())
+        workers = [self.start_worker() for _ in range(min(self.num_workers, len(pending)))]
+        # worker index -> (key, time it was sent) of the cell it is working on
+        running = {}
+        pbar = tqdm(total=len(pending))
+        try:
+            while pending or running:
+                for w in range(len(workers)):
+                    if w not in running and pending:
+                        key, cell = pending.pop()
+                        workers[w][1].send(cell)
+                        running[w] = (key, time.monotonic())
+                first_deadline = min(start for _, start in running.values()) + self.timeout
+                conns = {workers[w][1]: w for w in running}
+                for conn in wait(list(conns), timeout=max(first_deadline - time.monotonic(), 0.)):
+                    w = conns[conn]
+                    key, _ = running.pop(w)
+                    try:
+                        results[key] = conn.recv()
+                    except EOFError:
+                        # the worker died (e.g. a crash inside spglib)
+                        results[key] = None
+                        self.stop_worker(workers[w], kill=True)
+                        workers[w] = self.start_worker()
+                    pbar.update(1)
+                now = time.monotonic()
+                for w, (key, start) in list(running.items()):
+                    if now - start >= self.timeout:
+                        # the worker is stuck inside spglib and cannot be interrupted, replace it
+                        self.stop_worker(workers[w], kill=True)
+                        workers[w] = self.start_worker()
+                        del running[w]
+                        results[key] = None
+                        self.num_timeouts += 1
+                        pbar.update(1)
+        finally:
+            for worker in workers:
+                self.stop_worker(worker, kill=len(running) > 0)
+            pbar.close()
+        return results
@@ -0,0 +1,70 @@
+import os
+import time
+import json
+import argparse
+import torch
+import hydra
+from pathlib import Path
+
+import sys
+sys.path.append('.')
+from scripts.eval_utils import load_config
+from scripts.compute_metrics import gen_eval_from_arrays
+
+
+def load_checkpoint(model_path, cfg, ckpt, device):
+    Model = hydra.utils.get_class(cfg.model._target_)
+    model = Model.load_from_checkpoint(str(ckpt), strict=False, map_location=device)
+    model.lattice_scaler = torch.load(model_path / 'lattice_scaler.pt')
+    model.scaler = torch.load(model_path / 'prop_scaler.pt')
+    return model.to(device).eval()
+
+
+def evaluate_checkpoint(model_path, cfg, ckpt, device):
+    model = load_checkpoint(model_path, cfg, ckpt, device)
+    with torch.no_grad():
+        pred_crys_array_list = model.sample_gen_eval_arrays()
+    gen_metrics = gen_eval_from_arrays(pred_crys_array_list, prop_device=device, **model.gen_eval_kwargs())
+    del model
+    return {k: (float(v) if v is not None else None) for k, v in gen_metrics.items()}
+
+
+def main(args):
+    # runs the generation metrics of a training run on its saved checkpoints, outside of the training process
+    model_path = Path(args.model_path)
+    cfg = load_config(model_path)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    out_file = model_path / args.out_file
+    results = json.loads(out_file.read_text()) if out_file.exists() else {}
+
+    while True:
+        for ckpt in sorted(model_path.glob(args.ckpt_glob), key=os.path.getmtime):
+            # checkpoints such as last.ckpt are overwritten in place, the modification time tells them apart
+            key = f'{ckpt.relative_to(model_path)}@{os.path.getmtime(ckpt):.0f}'
+            if key in results:
+                continue
+            print(f'Evaluating {key}')
+            try:
+                results[key] = evaluate_checkpoint(model_path, cfg, ckpt, device)
+            except Exception as e:
+                # the checkpoint may still be in the middle of being written
+                print(f'Failed to evaluate {key}: {e}')
+                continue
+            print(results[key])
+            out_file.write_text(json.dumps(results, indent=2))
+        if args.once:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', required=True, help='hydra run directory of the training run')
+    parser.add_argument('--ckpt_glob', default='*.ckpt')
+    parser.add_argument('--out_file', default='gen_eval_watch.json')
+    parser.add_argument('--interval', default=60, type=float, help='seconds between scans for new checkpoints')
+    parser.add_argument('--once', action='store_true', help='evaluate the current checkpoints and exit')
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,110 @@
+import os
+import shutil
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+import hydra
+import torch
+from pytorch_lightning import Callback
+
+
+def evaluate_checkpoint(model_path, ckpt_path, device):
+    # runs in a worker process: loads the weights of ckpt_path, samples and computes the generation metrics
+    from pathlib import Path
+    from scripts.eval_utils import load_config
+    from scripts.watch_gen_eval import evaluate_checkpoint as evaluate
+    return evaluate(Path(model_path), load_config(Path(model_path)), ckpt_path, device)
+
+
+class AsyncGenEval(Callback):
+    """
+    Generation metrics of `simple_gen_evaluation` computed off the training loop.
+
+    Every `every_n_epochs` validation epochs, the current weights are saved to `dirpath`/gen_eval/ and
+    a pool of worker processes loads them, samples crystals on `device` and computes the metrics, which
+    are logged at the end of the first validation epoch after they are ready. The training ranks only
+    wait for the checkpoint to be written. Since `monitor` arrives late, checkpoint selection on it is
+    deferred: the best checkpoint is copied to best_{monitor}.ckpt, which load_model picks up.
+    """
+
+    def __init__(self, dirpath, every_n_epochs, num_workers=1, device='cpu', monitor='valid', mode='max'):
+        super().__init__()
+        self.model_path = str(dirpath)
+        self.dirpath = os.path.join(dirpath, 'gen_eval')
+        self.every_n_epochs = every_n_epochs
+        self.num_workers = num_workers
+        self.device = device
+        self.monitor = monitor
+        self.mode = mode
+        self.best_score = None
+        self.executor = None
+        # (epoch, checkpoint path, future) of evaluations that have not been logged yet
+        self.pending = []
+
+    def setup(self, trainer, pl_module, stage):
+        if trainer.is_global_zero and self.executor is None:
+            os.makedirs(self.dirpath, exist_ok=True)
+            # spawn, the training process holds CUDA state
+            self.executor = ProcessPoolExecutor(self.num_workers, mp_context=mp.get_context('spawn'))
+
+    def on_validation_epoch_end(self, trainer, pl_module):
+        if trainer.sanity_checking:
+            return
+        self.collect(trainer)
+        epoch = trainer.current_epoch
+        if (epoch + 1) % self.every_n_epochs != 0:
+            return
+        ckpt_path = os.path.join(self.dirpath, f'epoch={epoch}.ckpt')
+        # collective in DDP, every rank has to call it
+        trainer.save_checkpoint(ckpt_path, weights_only=True)
+        if trainer.is_global_zero:
+            future = self.executor.submit(evaluate_checkpoint, self.model_path, ckpt_path, self.device)
+            self.pending.append((epoch, ckpt_path, future))
+            hydra.utils.log.info(f'Submitted generation metrics of epoch {epoch + 1}, {len(self.pending)} pending')
+
+    def on_fit_end(self, trainer, pl_module):
+        self.collect(trainer, wait=True)
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def on_exception(self, trainer, pl_module, exception):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def is_better(self, score):
+        if self.best_score is None:
+            return True
+        return score > self.best_score if self.mode == 'max' else score < self.best_score
+
+    def collect(self, trainer, wait=False):
+        if not trainer.is_global_zero:
+            return
+        pending = []
+        for epoch, ckpt_path, future in self.pending:
+            if not wait and not future.done():
+                pending.append((epoch, ckpt_path, future))
+                continue
+            try:
+                gen_metrics = future.result()
+            except Exception as e:
+                hydra.utils.log.warning(f'Generation metrics of epoch {epoch + 1} failed: {e}')
+                os.remove(ckpt_path)
+                continue
+            gen_metrics = {k: float(v) for k, v in gen_metrics.items() if v is not None}
+            hydra.utils.log.info(f'Generation metrics of epoch {epoch + 1}: {gen_metrics}')
+            if trainer.logger is not None:
+                trainer.logger.log_metrics({**gen_metrics, 'gen_eval_epoch': epoch}, step=trainer.global_step)
+            score = gen_metrics.get(self.monitor)
+            if score is not None and self.is_better(score):
+                self.best_score = score
+                shutil.copy(ckpt_path, os.path.join(self.dirpath, f'best_{self.monitor}.ckpt'))
+            os.remove(ckpt_path)
+        self.pending = pending
+
+    def state_dict(self):
+        return {'best_score': self.best_score}
+
+    def load_state_dict(self, state_dict):
+        self.best_score = state_dict['best_score']
@@ -0,0 +1,134 @@
+import io
+import json
+import mmap
+import struct
+from pathlib import Path
+
+import hydra
+import torch
+from omegaconf import OmegaConf
+
+
+MAGIC = b'SYMMCDB1'
+ALIGNMENT = 64
+DTYPES = {str(dtype).split('.')[-1]: dtype for dtype in [
+    torch.float64, torch.float32, torch.float16, torch.bfloat16,
+    torch.int64, torch.int32, torch.int16, torch.int8, torch.uint8, torch.bool]}
+
+
+def _align(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_bundle(path, cfg, state_dict, files):
+    """
+    Single file inference bundle: MAGIC, the length of a json header, the header and the data, in which every tensor
+    of state_dict is stored raw at a 64 bytes aligned offset, so that it can be used in place from a memory map.
+    files are other objects (scalers, marginals, ...) saved with torch.save, they are small and loaded as copies.
+    cfg is stored resolved, so that interpolations of the training environment are not needed at load time.
+    """
+    header = {'format_version': 1, 'config': OmegaConf.to_container(cfg, resolve=True), 'tensors': {}, 'files': {}}
+    chunks = []
+    offset = 0
+    for name, tensor in state_dict.items():
+        data = tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes() if tensor.numel() > 0 else b''
+        header['tensors'][name] = {'dtype': str(tensor.dtype).split('.')[-1], 'shape': list(tensor.shape), 'offset': offset}
+        chunks.append((offset, data))
+        offset = _align(offset + len(data))
+    for name, obj in files.items():
+        buffer = io.BytesIO()
+        torch.save(obj, buffer)
+        data = buffer.getvalue()
+        header['files'][name] = {'offset': offset, 'nbytes': len(data)}
+        chunks.append((offset, data))
+        offset = _align(offset + len(data))
+
+    header = json.dumps(header).encode()
+    data_start = _align(len(MAGIC) + 8 + len(header))
+    with open(path, 'wb') as f:
+        f.write(MAGIC + struct.pack('<Q', len(header)) + header)
+        for chunk_offset, data in chunks:
+            f.seek(data_start + chunk_offset)
+            f.write(data)
+        f.truncate(data_start + offset)
+
+
+def read_bundle(path):
+    """
+    Header, tensors and files of a bundle. The tensors are views of a copy-on-write memory map of the file,
+    nothing is read before they are used and writing to them does not modify the file.
+    """
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    if buffer[:len(MAGIC)] != MAGIC:
+        raise ValueError(f'{path} is not an inference bundle')
+    header_len, = struct.unpack('<Q', buffer[len(MAGIC):len(MAGIC) + 8])
+    header = json.loads(buffer[len(MAGIC) + 8:len(MAGIC) + 8 + header_len])
+    data_start = _align(len(MAGIC) + 8 + header_len)
+
+    tensors = {}
+    for name, info in header['tensors'].items():
+        dtype = DTYPES[info['dtype']]
+        numel = 1
+        for size in info['shape']:
+            numel *= size
+        if numel == 0:
+            tensors[name] = torch.empty(info['shape'], dtype=dtype)
+        else:
+            tensors[name] = torch.frombuffer(buffer, dtype=dtype, count=numel,
+                                             offset=data_start + info['offset']).view(info['shape'])
+    files = {name: torch.load(io.BytesIO(buffer[data_start + info['offset']:data_start + info['offset'] + info['nbytes']]))
+             for name, info in header['files'].items()}
+    return header, tensors, files
+
+
+def export_bundle(model_path, out_path):
+    """
+    Bundle of a model directory (as read by scripts.eval_utils.load_model): weights, resolved config, scalers,
+    marginals of the discrete model and the space group statistics of the training set (sg_info.pt) when present.
+    """
+    from scripts.eval_utils import load_model
+    model_path = Path(model_path)
+    model, _, cfg = load_model(model_path)
+    files = {
+        'lattice_scaler': torch.load(model_path / 'lattice_scaler.pt'),
+        'prop_scaler': torch.load(model_path / 'prop_scaler.pt'),
+    }
+    datamodule = cfg.data.datamodule
+    for key in ['atom_marginals_path', 'ss_marginals_path']:
+        if key in datamodule and Path(datamodule[key]).exists():
+            files[key] = torch.load(datamodule[key])
+    sg_info_path = datamodule.datasets.train.get('sg_info_path', None)
+    if sg_info_path is not None and Path(sg_info_path).exists():
+        files['sg_info'] = torch.load(sg_info_path)
+    write_bundle(out_path, cfg, model.state_dict(), files)
+
+
+def load_bundle(path, device=None):
+    """
+    Model of a bundle, constructed once and with the weights of the bundle used in place on CPU (copied once to
+    device otherwise). Returns the model, its config and the space group statistics (None if not in the bundle),
+    i.e. the (sg_num_atoms, sg_dist, sg_number_binary_mapper) of SampleDataset.
+    """
+    header, tensors, files = read_bundle(path)
+    cfg = OmegaConf.create(header['config'])
+
+    datamodule = cfg.data.datamodule
+    # read from the bundle instead of the paths of the config, each only if it was bundled
+    from symmcd.pl_modules.discrete_diffusion_w_site_symm import MARGINALS
+    for key in ['atom_marginals_path', 'ss_marginals_path']:
+        if key in files:
+            MARGINALS[datamodule[key]] = files[key]
+
+    model = hydra.utils.instantiate(cfg.model, optim=cfg.optim, data=cfg.data, logging=cfg.logging, _recursive_=False)
+    # strict=False only so that both kinds of mismatch are reported together
+    missing, unexpected = model.load_state_dict(tensors, strict=False, assign=True)
+    if len(missing) > 0 or len(unexpected) > 0:
+        raise RuntimeError(f'{path} does not match the model of its config: missing keys {list(missing)}, '
+                           f'unexpected keys {list(unexpected)}')
+    model.lattice_scaler = files['lattice_scaler']
+    model.scaler = files['prop_scaler']
+    model.eval()
+    if device is not None:
+        model.to(device)
+    return model, cfg, files.get('sg_info', None)
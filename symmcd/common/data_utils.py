@@ -17,7 +17,6 @@ from pymatgen.analysis import local_env
 
 from networkx.algorithms.components import is_connected
 
-from sklearn.metrics import accuracy_score, recall_score, precision_score
 
 from torch_scatter import scatter
 from torch_scatter import segment_coo, segment_csr
@@ -116,6 +115,7 @@ B_MATRICES[3, 1, 1] = -1
 B_MATRICES[4, 0, 0] = B_MATRICES[4, 1, 1] = 1
 B_MATRICES[4, 2, 2] = -2
 B_MATRICES[5, 0, 0] =  B_MATRICES[5, 1, 1]  = B_MATRICES[5, 2, 2]  = 1
+B_MATRICES_TORCH = {}
 MAX_ATOMIC_NUM=94
 N_SPACEGROUPS = 230
 N_AXES = 15
@@ -173,7 +173,11 @@ CrystalNN = local_env.CrystalNN(
 def build_crystal(crystal_str, niggli=True, primitive=False):
     """Build crystal from cif string."""
     crystal = Structure.from_str(crystal_str, fmt='cif')
+    return reduce_crystal(crystal, niggli, primitive)
 
+
+def reduce_crystal(crystal, niggli=True, primitive=False):
+    # primitive and/or niggli reduced structure, with the lattice of its lattice parameters (as build_crystal)
     if primitive:
         crystal = crystal.get_primitive_structure()
 
@@ -407,7 +411,11 @@ def lattice_ks_to_matrix_torch(ks):
     Args:
         ks: torch.Tensor of shape (N, 6)
     """
-    S = torch.einsum('bij,nb->nij', torch.tensor(B_MATRICES, device=ks.device, dtype=ks.dtype), ks)
+    key = (ks.device, ks.dtype)
+    if key not in B_MATRICES_TORCH:
+        # copied once per device, a host to device copy at every call cannot be captured in a CUDA graph
+        B_MATRICES_TORCH[key] = torch.tensor(B_MATRICES, device=ks.device, dtype=ks.dtype)
+    S = torch.einsum('bij,nb->nij', B_MATRICES_TORCH[key], ks)
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
         L = torch.matrix_exp(S)
@@ -1464,6 +1472,7 @@ def batch_accuracy_precision_recall(
     pred_edges = pred_edge_probs.max(dim=1)[1].float()
     target_edges = edge_overlap_mask.float()
 
+    from sklearn.metrics import accuracy_score, recall_score, precision_score
     start_idx = 0
     accuracies, precisions, recalls = [], [], []
     for num_bond in num_bonds.tolist():
@@ -0,0 +1,114 @@
+import json
+import time
+import functools
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+
+class Profiler(object):
+    """
+    Named wall-clock timers and counters, off by default so that the instrumented code pays a flag check only.
+
+    With cuda_sync, CUDA is synchronized at both ends of every timer, so that asynchronous kernels are attributed
+    to the timer that launched them (this slows down the run). With record_functions, every timer is also a
+    torch.profiler range, visible in a trace of torch.profiler.profile.
+    Timers only cover the current process, work done in worker pools is timed as a whole by the caller.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.cuda_sync = False
+        self.record_functions = False
+        self.paused = 0
+        self.start_time = time.perf_counter()
+        self.reset()
+
+    def configure(self, enabled=True, cuda_sync=False, record_functions=False):
+        self.enabled = enabled
+        self.cuda_sync = cuda_sync and torch.cuda.is_available()
+        self.record_functions = record_functions
+        self.start_time = time.perf_counter()
+
+    def reset(self):
+        self.timers = defaultdict(lambda: [0, 0.])
+        self.counters = defaultdict(int)
+
+    @property
+    def active(self):
+        return self.enabled and self.paused == 0
+
+    @contextmanager
+    def pause(self):
+        # e.g. around compiled or CUDA graph captured code, where host timing and synchronization do not belong
+        self.paused += 1
+        try:
+            yield
+        finally:
+            self.paused -= 1
+
+    @contextmanager
+    def _timer(self, name):
+        if self.cuda_sync:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        with torch.profiler.record_function(name) if self.record_functions else nullcontext():
+            yield
+            if self.cuda_sync:
+                torch.cuda.synchronize()
+        timer = self.timers[name]
+        timer[0] += 1
+        timer[1] += time.perf_counter() - start
+
+    def timer(self, name):
+        return self._timer(name) if self.active else nullcontext()
+
+    def count(self, name, n=1):
+        if self.active:
+            self.counters[name] += n
+
+    def report(self):
+        return {
+            'wall_time_s': time.perf_counter() - self.start_time,
+            'cuda_sync': self.cuda_sync,
+            'timers': {name: {'count': count, 'total_s': total, 'mean_s': total / count}
+                       for name, (count, total) in sorted(self.timers.items(), key=lambda x: -x[1][1])},
+            'counters': dict(self.counters),
+        }
+
+    def save(self, path, **extra):
+        with open(path, 'w') as f:
+            json.dump({**self.report(), **extra}, f, indent=2)
+
+
+def merge_reports(reports):
+    # reports of several processes, e.g. generation shards, wall times are summed as well
+    timers = defaultdict(lambda: [0, 0.])
+    counters = defaultdict(int)
+    for report in reports:
+        for name, timer in report['timers'].items():
+            timers[name][0] += timer['count']
+            timers[name][1] += timer['total_s']
+        for name, n in report['counters'].items():
+            counters[name] += n
+    return {
+        'wall_time_s': sum(report['wall_time_s'] for report in reports),
+        'cuda_sync': any(report['cuda_sync'] for report in reports),
+        'timers': {name: {'count': count, 'total_s': total, 'mean_s': total / count}
+                   for name, (count, total) in sorted(timers.items(), key=lambda x: -x[1][1])},
+        'counters': dict(counters),
+    }
+
+
+PROFILER = Profiler()
+
+
+def timed(name):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with PROFILER.timer(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -85,13 +85,25 @@ def log_hyperparameters(
     trainer.logger.log_hyperparams = lambda params: None
 
 
-# Load environment variables
-load_envs()
-
-# Set the cwd to the project root
-PROJECT_ROOT: Path = Path(get_env("PROJECT_ROOT"))
-assert (
-    PROJECT_ROOT.exists()
-), "You must configure the PROJECT_ROOT environment variable in a .env file!"
-
-os.chdir(PROJECT_ROOT)
+def get_project_root() -> Path:
+    """
+    Load the environment variables, check PROJECT_ROOT and set the cwd to it.
+    """
+    load_envs()
+    project_root: Path = Path(get_env("PROJECT_ROOT"))
+    assert (
+        project_root.exists()
+    ), "You must configure the PROJECT_ROOT environment variable in a .env file!"
+
+    os.chdir(project_root)
+    return project_root
+
+
+def __getattr__(name):
+    # PROJECT_ROOT is resolved on first use (e.g. `from symmcd.common.utils import PROJECT_ROOT`), so that modules
+    # importing only the helpers above do not read .env and change the working directory
+    if name == "PROJECT_ROOT":
+        global PROJECT_ROOT
+        PROJECT_ROOT = get_project_root()
+        return PROJECT_ROOT
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,116 @@
+from pathlib import Path
+import sys
+sys.path.append('.')
+import copy
+import json
+import hydra
+import torch
+import omegaconf
+import pytorch_lightning as pl
+from hydra.core.hydra_config import HydraConfig
+from omegaconf import OmegaConf, open_dict
+from pytorch_lightning import seed_everything
+
+from symmcd.common.utils import PROJECT_ROOT
+from symmcd.pl_modules.distillation import ProgressiveDistillation
+from scripts.eval_utils import load_model
+from scripts.compute_metrics import gen_eval_from_arrays
+
+
+def evaluate(model, num_steps, cfg, device):
+    model.hparams.data.eval_generate_samples = cfg.eval_generate_samples
+    with torch.no_grad():
+        pred_crys_array_list = model.sample_gen_eval_arrays(num_steps=num_steps)
+    gen_metrics = gen_eval_from_arrays(pred_crys_array_list, prop_device=device, **model.gen_eval_kwargs())
+    return {k: (float(v) if v is not None else None) for k, v in gen_metrics.items()}
+
+
+def save_student(student, teacher_cfg, teacher_path, out_dir, num_steps, epoch, global_step):
+    # a model directory that load_model (and thus scripts/generation.py) can read, sampling with num_steps by default
+    out_dir.mkdir(parents=True, exist_ok=True)
+    student_cfg = copy.deepcopy(teacher_cfg)
+    with open_dict(student_cfg):
+        student_cfg.model.sample_steps = num_steps
+    (out_dir / 'hparams.yaml').write_text(OmegaConf.to_yaml(cfg=student_cfg))
+    for scaler in ['lattice_scaler.pt', 'prop_scaler.pt']:
+        torch.save(torch.load(teacher_path / scaler), out_dir / scaler)
+    torch.save({
+        'state_dict': student.state_dict(),
+        'hyper_parameters': dict(student.hparams),
+        'pytorch-lightning_version': pl.__version__,
+    }, out_dir / f'epoch={epoch}-step={global_step}.ckpt')
+
+
+def run(cfg: omegaconf.DictConfig) -> None:
+    """
+    Progressive distillation of a discrete site symmetry model: every stage halves the number of sampling steps,
+    from cfg.start_steps down to cfg.min_steps, with the student of a stage as the teacher of the next one.
+    """
+    seed_everything(cfg.random_seed)
+    teacher_path = Path(cfg.teacher_path)
+    hydra_dir = Path(HydraConfig.get().run.dir)
+    device = 'cuda' if cfg.accelerator != 'cpu' and torch.cuda.is_available() else 'cpu'
+
+    teacher, _, teacher_cfg = load_model(teacher_path)
+    timesteps = teacher.beta_scheduler.timesteps
+    num_steps = cfg.start_steps or timesteps
+    if timesteps % num_steps != 0 or num_steps // 2 < cfg.min_steps:
+        raise ValueError(f'start_steps={num_steps} must divide the {timesteps} timesteps and be at least 2 * min_steps')
+
+    with open_dict(teacher_cfg):
+        teacher_cfg.data.datamodule.batch_size.train = cfg.batch_size
+    hydra.utils.log.info(f"Instantiating <{teacher_cfg.data.datamodule._target_}>")
+    datamodule: pl.LightningDataModule = hydra.utils.instantiate(
+        teacher_cfg.data.datamodule, _recursive_=False, scaler_path=teacher_path
+    )
+
+    metrics = {}
+    if cfg.eval_teacher:
+        metrics[num_steps] = evaluate(teacher.to(device).eval(), num_steps, cfg, device)
+        hydra.utils.log.info(f"Teacher with {num_steps} steps: {metrics[num_steps]}")
+
+    stage = 0
+    while num_steps // 2 >= cfg.min_steps:
+        student_steps = num_steps // 2
+        if timesteps % student_steps != 0:
+            raise ValueError(f'{student_steps} steps do not divide the {timesteps} timesteps')
+        hydra.utils.log.info(f"Stage {stage}: distilling {num_steps} into {student_steps} steps")
+
+        student = copy.deepcopy(teacher)
+        module = ProgressiveDistillation(
+            teacher, student, teacher_stride=timesteps // num_steps, lr=cfg.lr, step_lr=cfg.step_lr,
+            cost_lattice=cfg.cost_lattice, cost_coord=cfg.cost_coord, cost_type=cfg.cost_type, cost_symm=cfg.cost_symm)
+        trainer = pl.Trainer(
+            default_root_dir=hydra_dir,
+            accelerator=cfg.accelerator,
+            devices=1,
+            max_epochs=cfg.epochs_per_stage,
+            limit_train_batches=cfg.limit_train_batches,
+            limit_val_batches=0,
+            num_sanity_val_steps=0,
+            gradient_clip_val=cfg.gradient_clip_val,
+            logger=False,
+            enable_checkpointing=False,
+        )
+        trainer.fit(model=module, datamodule=datamodule)
+
+        student.hparams.sample_steps = student_steps
+        student = student.to(device).eval()
+        metrics[student_steps] = evaluate(student, student_steps, cfg, device)
+        hydra.utils.log.info(f"Student with {student_steps} steps: {metrics[student_steps]}")
+        save_student(student, teacher_cfg, teacher_path, hydra_dir / f'steps_{student_steps}', student_steps,
+                     cfg.epochs_per_stage - 1, trainer.global_step)
+        (hydra_dir / 'distill_metrics.json').write_text(json.dumps(metrics, indent=2))
+
+        teacher = student
+        num_steps = student_steps
+        stage += 1
+
+
+@hydra.main(config_path=str(PROJECT_ROOT / "conf"), config_name="distill")
+def main(cfg: omegaconf.DictConfig):
+    run(cfg)
+
+
+if __name__ == "__main__":
+    main()
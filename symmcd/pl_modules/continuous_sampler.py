@@ -0,0 +1,147 @@
+import math
+
+import torch
+from torch_geometric.data import Batch
+from torch_geometric.utils import to_dense_batch
+
+from symmcd.common.data_utils import sg_to_ks_mask
+from symmcd.common.profiling import PROFILER
+
+
+class ContinuousBatchSampler(object):
+    """
+    Continuous batching of the reverse process of the discrete site symmetry model (CSPDiffusion): a pool of
+    num_slots crystals, each at its own timestep. After every step the crystals that reached t = 0 are evicted and
+    finalized, and free slots are refilled with new crystals drawn from data (e.g. a SampleDataset), at most
+    max_admit per step. By default max_admit is the number of crystals finishing per step once the pool is full,
+    num_slots / num_steps, so that the timesteps of the pool stay spread out instead of moving in lockstep.
+
+    The schedule coefficients of every slot are gathered from the scheduler buffers with its own timestep
+    (see reverse_step). The batch and the sampling context are rebuilt when crystals are admitted or evicted.
+    With prune_every > 0, the crystals found by model.degenerate_crystals (with prune_kwargs) every prune_every steps
+    are evicted without output, freeing their slots for new crystals.
+    """
+
+    def __init__(self, model, data, num_slots, step_lr=1e-5, num_steps=None, max_admit=None, prune_every=0,
+                 prune_kwargs=None):
+        self.model = model
+        self.data = iter(data)
+        self.num_slots = num_slots
+        self.step_lr = step_lr
+        timesteps = model.beta_scheduler.timesteps
+        num_steps = num_steps or model.hparams.get('sample_steps', None) or timesteps
+        if timesteps % num_steps != 0:
+            raise ValueError(f'num_steps={num_steps} does not divide the {timesteps} timesteps')
+        self.stride = timesteps // num_steps
+        self.max_admit = max_admit or math.ceil(num_slots / num_steps)
+        self.prune_every = prune_every
+        self.prune_kwargs = prune_kwargs or {}
+        # Data of the crystals in the pool, in the order of the state tensors
+        self.slots = []
+        self.state = None
+        self.t = None
+        self.batch = None
+        self.ctx = None
+        self.exhausted = False
+        self.counters = {'steps': 0, 'slot_steps': 0, 'crystals': 0, 'pruned': 0}
+
+    def admit(self):
+        new = []
+        while not self.exhausted and len(self.slots) + len(new) < self.num_slots and len(new) < self.max_admit:
+            try:
+                new.append(next(self.data))
+            except StopIteration:
+                self.exhausted = True
+        if len(new) == 0:
+            return False
+
+        batch = Batch.from_data_list(new).to(self.model.device)
+        with PROFILER.timer('sample/init'):
+            state, _ = self.model.init_sample(batch, self.step_lr)
+        t = torch.full((len(new),), self.model.beta_scheduler.timesteps, dtype=torch.long, device=self.model.device)
+        if self.state is None:
+            self.state, self.t = state, t
+        else:
+            # the atoms of the new crystals are appended after the atoms of the crystals in the pool
+            self.state = tuple(torch.cat([x, x_new]) for x, x_new in zip(self.state, state))
+            self.t = torch.cat([self.t, t])
+        self.slots.extend(new)
+        PROFILER.count('sample/crystals', len(new))
+        return True
+
+    def build_context(self):
+        self.batch = Batch.from_data_list(self.slots).to(self.model.device)
+        with PROFILER.timer('sample/to_dense_batch'):
+            _, node_mask = to_dense_batch(self.batch.batch, self.batch.batch, fill_value=0)
+        ks_mask, ks_add = sg_to_ks_mask(self.batch.spacegroup)
+        x_t, l_t, k_t = self.state[:3]
+        # the current state stands for x_T, l_T and k_T, which only matter as frozen coordinates / lattices and shapes
+        self.ctx = self.model.sample_context(self.batch, node_mask, ks_mask, ks_add, x_t, l_t, k_t, self.step_lr,
+                                             stride=self.stride)
+
+    def evict(self, degenerate=None):
+        finished_mask = self.t <= 0
+        evicted = finished_mask if degenerate is None else finished_mask | degenerate
+        if not evicted.any():
+            return [], None
+        finished_nodes = finished_mask[self.batch.batch]
+        evicted_nodes = evicted[self.batch.batch]
+        x_t, l_t, k_t, t_t, symm_t = self.state
+        final = {
+            'num_atoms': self.batch.num_atoms[finished_mask],
+            'atom_types': t_t[finished_nodes],
+            'site_symm': symm_t[finished_nodes],
+            'frac_coords': x_t[finished_nodes],
+            'lattices': l_t[finished_mask],
+            'ks': k_t[finished_mask],
+            'spacegroup': self.batch.spacegroup[finished_mask],
+        }
+        finished = [data for data, is_finished in zip(self.slots, finished_mask.tolist()) if is_finished]
+        self.slots = [data for data, is_evicted in zip(self.slots, evicted.tolist()) if not is_evicted]
+        self.state = (x_t[~evicted_nodes], l_t[~evicted], k_t[~evicted], t_t[~evicted_nodes], symm_t[~evicted_nodes])
+        self.t = self.t[~evicted]
+        self.ctx = None
+        self.counters['crystals'] += len(finished)
+        self.counters['pruned'] += int(evicted.sum()) - len(finished)
+        PROFILER.count('sample/pruned', int(evicted.sum()) - len(finished))
+
+        # no outputs when only empty crystals (all atoms of the dummy type) finish
+        all_dummy = bool(self.model.dummy_atoms(final['atom_types']).all())
+        if len(finished) == 0 or all_dummy:
+            return finished, None
+        return finished, self.model.finalize_sample(final, final['spacegroup'], final['num_atoms'])
+
+    @torch.no_grad()
+    def step(self):
+        """
+        Admits new crystals, runs one sampling step on the pool and evicts the crystals that finished or were pruned.
+        Returns the Data of the finished crystals and their outputs as in sample (None if all of them came out empty).
+        """
+        if self.admit() or self.ctx is None:
+            if len(self.slots) == 0:
+                return [], None
+            self.build_context()
+        degenerate = None
+        if self.prune_every > 0 and (self.counters['steps'] + 1) % self.prune_every == 0:
+            with PROFILER.timer('sample/step'):
+                self.state, prob_a = self.model.sample_step_with_probs(self.t, *self.state, self.ctx)
+            with PROFILER.timer('sample/prune'):
+                degenerate = self.model.degenerate_crystals(self.state, prob_a, self.t - self.stride, self.ctx,
+                                                            **self.prune_kwargs)
+        else:
+            with PROFILER.timer('sample/step'):
+                self.state = self.model.sample_step(self.t, *self.state, self.ctx)
+        self.t = self.t - self.stride
+        self.counters['steps'] += 1
+        self.counters['slot_steps'] += len(self.slots)
+        return self.evict(degenerate)
+
+    def done(self):
+        return self.exhausted and len(self.slots) == 0
+
+    def __iter__(self):
+        # (finished Data, outputs) whenever crystals finish, until data is exhausted and the pool is empty
+        while not self.done():
+            finished, outputs = self.step()
+            if len(finished) > 0:
+                yield finished, outputs
@@ -3,6 +3,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 import math
+from torch.utils.checkpoint import checkpoint
 from torch_scatter import scatter
 from torch_scatter.composite import scatter_softmax
 from torch_geometric.utils import to_dense_adj, dense_to_sparse
@@ -20,19 +21,33 @@ N_SS = 13
 SITE_SYMM_DIM = N_AXES * N_SS
 
 class SinusoidsEmbedding(nn.Module):
-    def __init__(self, n_frequencies = 10, n_space = 3):
+    def __init__(self, n_frequencies = 10, n_space = 3, fused = False):
         super().__init__()
         self.n_frequencies = n_frequencies
         self.n_space = n_space
+        self.fused = fused
         self.frequencies = 2 * math.pi * torch.arange(self.n_frequencies)
         self.dim = self.n_frequencies * 2 * self.n_space
 
     def forward(self, x):
+        if self.fused:
+            return self.fused_forward(x)
         emb = x.unsqueeze(-1) * self.frequencies[None, None, :].to(x.device)
         emb = emb.reshape(-1, self.n_frequencies * self.n_space)
         emb = torch.cat((emb.sin(), emb.cos()), dim=-1)
         return emb.detach()
 
+    @torch.no_grad()
+    def fused_forward(self, x):
+        # same values and layout as forward, but sin and cos are written straight into the output
+        # instead of allocating both and concatenating them (peak 3 instead of 5 times (E, n_space * n_frequencies))
+        half = self.n_frequencies * self.n_space
+        emb = x.unsqueeze(-1) * self.frequencies[None, None, :].to(x.device)
+        out = torch.empty(x.shape[0], 2 * half, dtype=emb.dtype, device=emb.device)
+        torch.sin(emb, out=out[:, :half].view(-1, self.n_space, self.n_frequencies))
+        torch.cos(emb, out=out[:, half:].view(-1, self.n_space, self.n_frequencies))
+        return out
+
 
 class CSPLayer(nn.Module):
     """ Message passing layer for cspnet."""
@@ -44,10 +59,15 @@ class CSPLayer(nn.Module):
         dis_emb=None,
         ln=False,
         ip=True,
-        use_ks=False
+        use_ks=False,
+        factorize_edge_mlp=False,
+        edge_chunk_size=None
     ):
         super(CSPLayer, self).__init__()
 
+        self.hidden_dim = hidden_dim
+        self.factorize_edge_mlp = factorize_edge_mlp
+        self.edge_chunk_size = edge_chunk_size
         self.dis_dim = 3
         self.dis_emb = dis_emb
         self.ip = ip
@@ -69,35 +89,79 @@ class CSPLayer(nn.Module):
         if self.ln:
             self.layer_norm = nn.LayerNorm(hidden_dim)
     
-    def edge_model(self, node_features, frac_coords, lattice_feats, edge_index, edge2graph, frac_diff = None):
-
-        hi, hj = node_features[edge_index[0]], node_features[edge_index[1]]
-        if frac_diff is None:
-            xi, xj = frac_coords[edge_index[0]], frac_coords[edge_index[1]]
-            frac_diff = (xj - xi) % 1.
-        if self.dis_emb is not None:
-            frac_diff = self.dis_emb(frac_diff)
+    def edge_model(self, node_features, frac_coords, lattice_feats, edge_index, edge2graph, frac_diff = None, frac_diff_emb = None):
+
+        if not self.factorize_edge_mlp:
+            hi, hj = node_features[edge_index[0]], node_features[edge_index[1]]
+        if frac_diff_emb is not None:
+            # embedded once per forward in CSPNet and shared by all layers
+            frac_diff = frac_diff_emb
+        else:
+            if frac_diff is None:
+                xi, xj = frac_coords[edge_index[0]], frac_coords[edge_index[1]]
+                frac_diff = (xj - xi) % 1.
+            if self.dis_emb is not None:
+                frac_diff = self.dis_emb(frac_diff)
         if self.ip:
             lattice_feats = lattice_feats @ lattice_feats.transpose(-1, -2)
         lattice_feats_flatten = lattice_feats.view(-1, self.lattice_dim)
+        if self.factorize_edge_mlp:
+            edge_features = self.edge_mlp[1:](
+                self.factorized_edge_input(node_features, lattice_feats_flatten, frac_diff, edge_index, edge2graph))
+            return edge_features
         lattice_feats_flatten_edges = lattice_feats_flatten[edge2graph]
         edges_input = torch.cat([hi, hj, lattice_feats_flatten_edges, frac_diff], dim=1)
         edge_features = self.edge_mlp(edges_input)
         return edge_features
 
-    def node_model(self, node_features, edge_features, edge_index):
-        agg = scatter(edge_features, edge_index[0], dim = 0, reduce='mean', dim_size=node_features.shape[0])
+    def factorized_edge_input(self, node_features, lattice_feats_flatten, frac_diff, edge_index, edge2graph):
+        # edge_mlp[0] applied to [hi, hj, lattice, frac_diff] without building the concatenation:
+        # its weight is split by input block, nodes and lattices are projected once and gathered per edge
+        linear = self.edge_mlp[0]
+        w_i, w_j, w_lattice, w_dis = torch.split(
+            linear.weight, [self.hidden_dim, self.hidden_dim, self.lattice_dim, self.dis_dim], dim=1)
+        proj_i = F.linear(node_features, w_i)
+        proj_j = F.linear(node_features, w_j)
+        proj_lattice = F.linear(lattice_feats_flatten, w_lattice, linear.bias)
+        return proj_i[edge_index[0]] + proj_j[edge_index[1]] + proj_lattice[edge2graph] + F.linear(frac_diff, w_dis)
+
+    def chunked_edge_aggregation(self, node_features, frac_coords, lattice_feats, edge_index, edge2graph, frac_diff = None, frac_diff_emb = None):
+        # scatter mean of the edge features, computed edge_chunk_size edges at a time. Under autograd every chunk
+        # is recomputed in backward, so at most one chunk of edge activations is alive at a time.
+        agg = None
+        for start in range(0, edge_index.shape[1], self.edge_chunk_size):
+            chunk = slice(start, start + self.edge_chunk_size)
+            args = (node_features, frac_coords, lattice_feats, edge_index[:, chunk], edge2graph[chunk],
+                    frac_diff[chunk] if frac_diff is not None else None,
+                    frac_diff_emb[chunk] if frac_diff_emb is not None else None)
+            if torch.is_grad_enabled():
+                edge_features = checkpoint(self.edge_model, *args, use_reentrant=False)
+            else:
+                edge_features = self.edge_model(*args)
+            if agg is None:
+                agg = edge_features.new_zeros(node_features.shape[0], edge_features.shape[1])
+            agg = agg.index_add(0, edge_index[0, chunk], edge_features)
+        count = scatter(torch.ones_like(edge_index[0]), edge_index[0], dim = 0, reduce='sum', dim_size=node_features.shape[0])
+        return agg / count.clamp(min=1).unsqueeze(-1).to(agg.dtype)
+
+    def node_model(self, node_features, edge_features, edge_index, agg = None):
+        if agg is None:
+            agg = scatter(edge_features, edge_index[0], dim = 0, reduce='mean', dim_size=node_features.shape[0])
         agg = torch.cat([node_features, agg], dim = 1)
         out = self.node_mlp(agg)
         return out
 
-    def forward(self, node_features, frac_coords, lattice_feats, edge_index, edge2graph, frac_diff = None):
+    def forward(self, node_features, frac_coords, lattice_feats, edge_index, edge2graph, frac_diff = None, frac_diff_emb = None):
 
         node_input = node_features
         if self.ln:
             node_features = self.layer_norm(node_input)
-        edge_features = self.edge_model(node_features, frac_coords, lattice_feats, edge_index, edge2graph, frac_diff)
-        node_output = self.node_model(node_features, edge_features, edge_index)
+        if self.edge_chunk_size is not None and edge_index.shape[1] > self.edge_chunk_size:
+            agg = self.chunked_edge_aggregation(node_features, frac_coords, lattice_feats, edge_index, edge2graph, frac_diff, frac_diff_emb)
+            node_output = self.node_model(node_features, None, edge_index, agg = agg)
+        else:
+            edge_features = self.edge_model(node_features, frac_coords, lattice_feats, edge_index, edge2graph, frac_diff, frac_diff_emb)
+            node_output = self.node_model(node_features, edge_features, edge_index)
         return node_input + node_output
 
 class TransformerLayer(nn.Module):
@@ -112,8 +176,8 @@ class TransformerLayer(nn.Module):
         if self.ln:
             self.layer_norm = nn.LayerNorm(hidden_dim)
 
-    def forward(self, node_features, frac_coords, lattice_feats, edge_index, node2graph, frac_diff = None):
-        edge_features = self.dis_emb(frac_diff)
+    def forward(self, node_features, frac_coords, lattice_feats, edge_index, node2graph, frac_diff = None, frac_diff_emb = None):
+        edge_features = self.dis_emb(frac_diff) if frac_diff_emb is None else frac_diff_emb
         node_input = node_features
         if self.ln:
             node_features = self.layer_norm(node_input)
@@ -136,8 +200,8 @@ class TransformerLayer(nn.Module):
         if self.ln:
             self.layer_norm = nn.LayerNorm(hidden_dim)
 
-    def forward(self, node_features, frac_coords, lattice_feats, edge_index, node2graph, frac_diff = None):
-        edge_features = self.dis_emb(frac_diff)
+    def forward(self, node_features, frac_coords, lattice_feats, edge_index, node2graph, frac_diff = None, frac_diff_emb = None):
+        edge_features = self.dis_emb(frac_diff) if frac_diff_emb is None else frac_diff_emb
         node_input = node_features
         if self.ln:
             node_features = self.layer_norm(node_input)
@@ -173,7 +237,11 @@ class CSPNet(nn.Module):
         pred_site_symm_type = False,
         site_symm_matrix_embed=False,
         mask_token=False,
-        heads=8
+        heads=8,
+        factorize_edge_mlp=False,
+        fused_dis_emb=False,
+        checkpoint_layers=False,
+        edge_chunk_size=None
     ):
         super(CSPNet, self).__init__()
 
@@ -203,7 +271,7 @@ class CSPNet(nn.Module):
         if act_fn == 'silu':
             self.act_fn = nn.SiLU()
         if dis_emb == 'sin':
-            self.dis_emb = SinusoidsEmbedding(n_frequencies = num_freqs)
+            self.dis_emb = SinusoidsEmbedding(n_frequencies = num_freqs, fused = fused_dis_emb)
         elif dis_emb == 'none':
             self.dis_emb = None
         if self.use_gt_frac_coords and self.dis_emb:
@@ -214,7 +282,8 @@ class CSPNet(nn.Module):
         for i in range(0, num_layers):
             if network == 'gnn':
                 self.add_module(
-                    "csp_layer_%d" % i, CSPLayer(hidden_dim, self.act_fn, self.dis_emb, ln=ln, ip=ip, use_ks=use_ks)
+                    "csp_layer_%d" % i, CSPLayer(hidden_dim, self.act_fn, self.dis_emb, ln=ln, ip=ip, use_ks=use_ks,
+                                                 factorize_edge_mlp=factorize_edge_mlp, edge_chunk_size=edge_chunk_size)
                 )  
             elif network == 'transformer':
                 self.add_module(
@@ -222,6 +291,7 @@ class CSPNet(nn.Module):
                 )   
         self.network = network       
         self.num_layers = num_layers
+        self.checkpoint_layers = checkpoint_layers
         self.coord_out = nn.Linear(hidden_dim, 3, bias = False)
         self.lattice_out = nn.Linear(hidden_dim, lattice_dim, bias = False)
         self.cutoff = cutoff
@@ -354,16 +424,37 @@ class CSPNet(nn.Module):
             return edge_index_new, -edge_vector_new
             
 
-    def forward(self, t, atom_types, frac_coords, lattice_feats, lattices, num_atoms, node2graph, site_symm_probs=None):
-
-        edges, frac_diff = self.gen_edges(num_atoms, frac_coords, lattices, node2graph)
+    def embed_edges(self, num_atoms, frac_coords, lattices, node2graph, edge_cache=None):
+        if edge_cache is not None and 'edges' in edge_cache:
+            return edge_cache['edges']
+        if edge_cache is not None and self.edge_style == 'fc':
+            # the fully connected graph only depends on num_atoms, and building it syncs with the host
+            if 'fc_edges' not in edge_cache:
+                edge_cache['fc_edges'], _ = self.gen_edges(num_atoms, frac_coords, lattices, node2graph)
+            edges = edge_cache['fc_edges']
+            frac_diff = frac_coords[edges[1]] - frac_coords[edges[0]]
+        else:
+            edges, frac_diff = self.gen_edges(num_atoms, frac_coords, lattices, node2graph)
         edge2graph = node2graph[edges[0]]
+        # the distance embedding only depends on the edges, computed once for all layers
+        frac_diff_emb = self.dis_emb(frac_diff) if self.dis_emb is not None else None
+        if edge_cache is not None and edge_cache.get('frozen_coords', False):
+            edge_cache['edges'] = (edges, edge2graph, frac_diff, frac_diff_emb)
+        return edges, edge2graph, frac_diff, frac_diff_emb
+
+    def forward(self, t, atom_types, frac_coords, lattice_feats, lattices, num_atoms, node2graph, site_symm_probs=None, edge_cache=None):
+        """
+        edge_cache: optional dict kept across calls on the same batch, e.g. across sampling steps. The fully connected
+        edges are built once; with edge_cache['frozen_coords'] set, the distances and their embedding are reused as well,
+        which is only valid while frac_coords do not change.
+        """
+        edges, edge2graph, frac_diff, frac_diff_emb = self.embed_edges(num_atoms, frac_coords, lattices, node2graph, edge_cache)
         if self.smooth:
             node_features = self.node_embedding(atom_types)
         else:
             node_features = self.node_embedding(atom_types - 1)
 
-        t_per_atom = t.repeat_interleave(num_atoms, dim=0)
+        t_per_atom = t[node2graph]
         node_features = torch.cat([node_features, t_per_atom], dim=1)
         if self.use_site_symm:
             if self.site_symm_matrix_embed:
@@ -376,18 +467,22 @@ class CSPNet(nn.Module):
             node_features = torch.cat([node_features, self.dis_emb(frac_coords)], dim=1)
         node_features = self.atom_latent_emb(node_features)
 
+        # only the layer inputs are kept for backward, the activations inside a layer are recomputed
+        checkpoint_layers = self.checkpoint_layers and torch.is_grad_enabled()
         for i in range(0, self.num_layers):
-            if self.network == 'transformer':
-                node_features = self._modules["csp_layer_%d" % i](node_features, frac_coords, lattice_feats, edges, node2graph, frac_diff = frac_diff)
-            elif self.network == 'gnn':
-                node_features = self._modules["csp_layer_%d" % i](node_features, frac_coords, lattice_feats, edges, edge2graph, frac_diff = frac_diff)
+            layer = self._modules["csp_layer_%d" % i]
+            graph_index = node2graph if self.network == 'transformer' else edge2graph
+            if checkpoint_layers:
+                node_features = checkpoint(layer, node_features, frac_coords, lattice_feats, edges, graph_index, frac_diff, frac_diff_emb, use_reentrant=False)
+            else:
+                node_features = layer(node_features, frac_coords, lattice_feats, edges, graph_index, frac_diff = frac_diff, frac_diff_emb = frac_diff_emb)
 
         if self.ln:
             node_features = self.final_layer_norm(node_features)
 
         coord_out = self.coord_out(node_features)
 
-        graph_features = scatter(node_features, node2graph, dim = 0, reduce = 'mean')
+        graph_features = scatter(node_features, node2graph, dim = 0, reduce = 'mean', dim_size = num_atoms.shape[0])
         lattice_out = self.lattice_out(graph_features)
         if not self.use_ks:
             lattice_out = lattice_out.view(-1, 3, 3)
@@ -411,3 +506,150 @@ class CSPNet(nn.Module):
 
         return lattice_out, coord_out
 
+
+
+def quantize_dynamic_int8(decoder):
+    """
+    Copy of a CSPNet with dynamic int8 quantization of its Linear layers (int8 weights, activations quantized on
+    the fly per batch), for CPU inference. The input embeddings (atom types, site symmetries) stay fp32, and so does
+    the first edge layer with factorize_edge_mlp, whose weight is split by input block.
+    """
+    keep_fp32 = ('node_embedding', 'axis_embedding', 'site_symm_embedding')
+    names = set()
+    for name, module in decoder.named_modules():
+        if not isinstance(module, nn.Linear) or name.startswith(keep_fp32):
+            continue
+        layer_name = name.rsplit('.edge_mlp.0', 1)[0]
+        if name.endswith('.edge_mlp.0') and getattr(decoder.get_submodule(layer_name), 'factorize_edge_mlp', False):
+            continue
+        names.add(name)
+    return torch.ao.quantization.quantize_dynamic(decoder, qconfig_spec=names, dtype=torch.qint8)
+
+
+def scatter_sum(src, index, out):
+    # rows of src summed into the rows of out, with native ops (ScatterElements in ONNX, torch_scatter does not export)
+    return out.scatter_add(0, index.unsqueeze(-1).expand_as(src), src)
+
+
+class ExportableCSPLayer(nn.Module):
+    """ CSPLayer of ExportableCSPNet, the edge inputs other than the node features are built once per forward."""
+
+    def __init__(self, layer):
+        super(ExportableCSPLayer, self).__init__()
+        self.edge_mlp = layer.edge_mlp
+        self.node_mlp = layer.node_mlp
+        self.layer_norm = layer.layer_norm if layer.ln else nn.Identity()
+
+    def forward(self, node_features, edge_index, edge_attr, edge_count):
+        h = self.layer_norm(node_features)
+        edge_features = self.edge_mlp(torch.cat([h[edge_index[0]], h[edge_index[1]], edge_attr], dim=1))
+        agg = scatter_sum(edge_features, edge_index[0], torch.zeros_like(h)) / edge_count
+        return node_features + self.node_mlp(torch.cat([h, agg], dim=1))
+
+
+class ExportableCSPNet(nn.Module):
+    """
+    CSPNet (gnn network) specialized to its configuration at construction, for torch.jit.script and torch.onnx.export.
+    The edges are inputs (see export_edges) instead of being built from num_atoms, and the outputs are always
+    (lattice_out, coord_out, type_out, site_symm_out), with (num_nodes, 0) tensors for the heads the decoder does not have.
+    The parameters are shared with the eager decoder.
+    """
+
+    def __init__(self, decoder):
+        super(ExportableCSPNet, self).__init__()
+        if decoder.network != 'gnn':
+            raise ValueError(f'Only the gnn network can be exported, got {decoder.network}')
+        self.type_offset = 0 if decoder.smooth else 1
+        self.node_embedding = decoder.node_embedding
+        self.use_site_symm = decoder.use_site_symm
+        self.site_symm_matrix_embed = decoder.site_symm_matrix_embed
+        self.n_ss = decoder.n_ss
+        self.ss_matrix_embed_dim = getattr(decoder, 'ss_matrix_embed_dim', 0)
+        self.axis_embedding = decoder.axis_embedding if decoder.site_symm_matrix_embed else nn.Identity()
+        self.site_symm_embedding = decoder.site_symm_embedding
+        self.use_dis_emb = decoder.dis_emb is not None
+        frequencies = decoder.dis_emb.frequencies.clone() if self.use_dis_emb else torch.zeros(0)
+        self.register_buffer('frequencies', frequencies, persistent=False)
+        # CSPNet.forward only adds the coordinates with their distance embedding
+        self.use_frac_coords = decoder.use_gt_frac_coords and self.use_dis_emb
+        self.atom_latent_emb = decoder.atom_latent_emb
+        self.layers = nn.ModuleList([ExportableCSPLayer(decoder._modules["csp_layer_%d" % i]) for i in range(decoder.num_layers)])
+        self.final_layer_norm = decoder.final_layer_norm if decoder.ln else nn.Identity()
+        self.coord_out = decoder.coord_out
+        self.lattice_out = decoder.lattice_out
+        self.ip = decoder.ip
+        self.use_ks = decoder.use_ks
+        self.site_symm_dim = decoder.site_symm_dim
+        self.type_out = decoder.type_out if decoder.pred_type else None
+        # as in CSPNet.forward, the matrix output is only used when both types and site symmetries are predicted
+        ss_matrix_out = decoder.pred_type and decoder.pred_site_symm_type and decoder.site_symm_matrix_embed
+        self.ss_matrix_out_dim = getattr(decoder, 'ss_matrix_out_dim', 0)
+        self.axis_wise_out = decoder.axis_wise_out if ss_matrix_out else None
+        self.symm_wise_out = decoder.symm_wise_out if ss_matrix_out else None
+        self.site_symm_out = decoder.site_symm_out if decoder.pred_site_symm_type and not ss_matrix_out else None
+
+    def sinusoids(self, x):
+        # SinusoidsEmbedding.forward
+        emb = (x.unsqueeze(-1) * self.frequencies).reshape(x.shape[0], -1)
+        return torch.cat([emb.sin(), emb.cos()], dim=-1)
+
+    def forward(self, t, atom_types, frac_coords, lattice_feats, lattices, node2graph, site_symm_probs, edge_index, edge_shift):
+        """
+        Inputs as in CSPNet.forward, site_symm_probs is ignored without use_site_symm. The distance of edge e is
+        frac_coords[edge_index[1, e]] - frac_coords[edge_index[0, e]] + edge_shift[e].
+        """
+        frac_diff = frac_coords[edge_index[1]] - frac_coords[edge_index[0]] + edge_shift
+        if self.use_dis_emb:
+            frac_diff = self.sinusoids(frac_diff)
+        if self.ip:
+            lattice_feats = lattice_feats @ lattice_feats.transpose(-1, -2)
+        lattice_feats_flatten = lattice_feats.reshape(lattice_feats.shape[0], -1)
+        edge_attr = torch.cat([lattice_feats_flatten[node2graph[edge_index[0]]], frac_diff], dim=1)
+
+        node_inputs = [self.node_embedding(atom_types - self.type_offset), t[node2graph]]
+        if self.use_site_symm:
+            if self.site_symm_matrix_embed:
+                axis_embeddings = self.axis_embedding(site_symm_probs.reshape(-1, N_AXES, self.n_ss))
+                site_symm_probs = axis_embeddings.reshape(-1, N_AXES * self.ss_matrix_embed_dim)
+            node_inputs.append(self.site_symm_embedding(site_symm_probs))
+        if self.use_frac_coords:
+            node_inputs.append(self.sinusoids(frac_coords))
+        node_features = self.atom_latent_emb(torch.cat(node_inputs, dim=1))
+
+        ones = torch.ones_like(frac_coords[:, :1])
+        edge_count = scatter_sum(torch.ones_like(edge_shift[:, :1]), edge_index[0], torch.zeros_like(ones)).clamp(min=1)
+        for layer in self.layers:
+            node_features = layer(node_features, edge_index, edge_attr, edge_count)
+        node_features = self.final_layer_norm(node_features)
+
+        coord_out = self.coord_out(node_features)
+        graph_count = scatter_sum(ones, node2graph, torch.zeros_like(lattice_feats_flatten[:, :1])).clamp(min=1)
+        graph_features = scatter_sum(node_features, node2graph,
+                                     node_features.new_zeros((lattice_feats_flatten.shape[0], node_features.shape[1])))
+        lattice_out = self.lattice_out(graph_features / graph_count)
+        if not self.use_ks:
+            lattice_out = lattice_out.view(-1, 3, 3)
+            if self.ip:
+                lattice_out = lattice_out @ lattices
+
+        type_out = node_features[:, :0]
+        if self.type_out is not None:
+            type_out = self.type_out(node_features)
+        site_symm_out = node_features[:, :0]
+        if self.axis_wise_out is not None and self.symm_wise_out is not None:
+            axis_embs = self.axis_wise_out(node_features).reshape(-1, N_AXES, self.ss_matrix_out_dim)
+            symm_embs = self.symm_wise_out(node_features).reshape(-1, self.n_ss, self.ss_matrix_out_dim)
+            site_symm_out = (axis_embs @ symm_embs.transpose(-1, -2)).reshape(-1, self.site_symm_dim)
+        elif self.site_symm_out is not None:
+            site_symm_out = self.site_symm_out(node_features)
+        return lattice_out, coord_out, type_out, site_symm_out
+
+
+def export_edges(decoder, num_atoms, frac_coords, lattices, node2graph):
+    """
+    Edge inputs (edge_index, edge_shift) of ExportableCSPNet from the edges of the eager decoder. The fully connected
+    edges only depend on num_atoms and have zero shifts, so they can be reused for every step of a batch.
+    """
+    edges, frac_diff = decoder.gen_edges(num_atoms, frac_coords, lattices, node2graph)
+    edge_shift = (frac_diff - (frac_coords[edges[1]] - frac_coords[edges[0]])).round()
+    return edges, edge_shift
@@ -17,7 +17,6 @@ from torch_scatter.composite import scatter_softmax
 from torch_geometric.utils import to_dense_adj, dense_to_sparse
 from tqdm import tqdm
 
-from symmcd.common.utils import PROJECT_ROOT
 from symmcd.common.data_utils import (
     EPSILON, cart_to_frac_coords, mard, lengths_angles_to_volume, lattice_params_to_matrix_torch,
     frac_to_cart_coords, min_distance_sqr_pbc, lattice_ks_to_matrix_torch)
@@ -209,6 +208,10 @@ class CSPDiffusion(BaseModule):
         }}
 
 
+        # fully connected edges are built once, with frozen coordinates their distance embedding is reused as well
+        reuse_edges = self.keep_coords and (self.decoder.edge_style == 'fc' or self.keep_lattice)
+        edge_cache = {'frozen_coords': reuse_edges}
+
         for t in tqdm(range(time_start, 0, -1)):
 
             times = torch.full((batch_size, ), t, device = self.device)
@@ -252,7 +255,7 @@ class CSPDiffusion(BaseModule):
             std_x = torch.sqrt(2 * step_size)
 
             lattice_feats_t = k_t if self.use_ks else l_t
-            pred_lattice, pred_x = self.decoder(time_emb, batch.atom_types, x_t, lattice_feats_t, l_t, batch.num_atoms, batch.batch)
+            pred_lattice, pred_x = self.decoder(time_emb, batch.atom_types, x_t, lattice_feats_t, l_t, batch.num_atoms, batch.batch, edge_cache=edge_cache)
 
             pred_x = pred_x * torch.sqrt(sigma_norm)
 
@@ -273,7 +276,7 @@ class CSPDiffusion(BaseModule):
             std_x = torch.sqrt((adjacent_sigma_x ** 2 * (sigma_x ** 2 - adjacent_sigma_x ** 2)) / (sigma_x ** 2))   
             lattice_feats_t_minus_05 = k_t_minus_05 if self.use_ks else l_t_minus_05
 
-            pred_lattice, pred_x = self.decoder(time_emb, batch.atom_types, x_t_minus_05, lattice_feats_t_minus_05, l_t_minus_05, batch.num_atoms, batch.batch)
+            pred_lattice, pred_x = self.decoder(time_emb, batch.atom_types, x_t_minus_05, lattice_feats_t_minus_05, l_t_minus_05, batch.num_atoms, batch.batch, edge_cache=edge_cache)
 
             pred_x = pred_x * torch.sqrt(sigma_norm)
 
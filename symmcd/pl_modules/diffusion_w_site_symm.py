@@ -20,7 +20,6 @@ from tqdm import tqdm
 
 from pyxtal.symmetry import search_cloest_wp, Group
 
-from symmcd.common.utils import PROJECT_ROOT
 from symmcd.common.data_utils import (
     lattice_params_to_matrix_torch, lattice_ks_to_matrix_torch, sg_to_ks_mask, mask_ks,)
 
@@ -41,9 +40,6 @@ for spacegroup in range(1, 231):
         wp.get_site_symmetry()
         SG_TO_WP_TO_SITE_SYMM[spacegroup][wp] = wp.get_site_symmetry_object().to_one_hot()
 
-from scripts.generation import SampleDataset
-from scripts.compute_metrics import Crystal, GenEval, get_gt_crys_ori
-from scripts.eval_utils import lattices_to_params_shape, smact_validity, structure_validity, get_crystals_list
 import re
 
 
@@ -362,6 +358,10 @@ class CSPDiffusion(BaseModule):
             'spacegroup': batch.spacegroup,
         }}
 
+        # fully connected edges are built once, with frozen coordinates their distance embedding is reused as well
+        reuse_edges = self.keep_coords and (self.decoder.edge_style == 'fc' or self.keep_lattice)
+        edge_cache = {'frozen_coords': reuse_edges}
+
         for t in tqdm(range(self.beta_scheduler.timesteps, 0, -1)):
 
             times = torch.full((batch_size, ), t, device = self.device)
@@ -417,7 +417,7 @@ class CSPDiffusion(BaseModule):
             lattice_feats_t = k_t if self.use_ks else l_t
             preds = self.decoder(time_emb, t_t, x_t, 
                             lattice_feats_t, l_t, batch.num_atoms, 
-                            batch.batch, site_symm_probs=symm_t)
+                            batch.batch, site_symm_probs=symm_t, edge_cache=edge_cache)
             
             _, pred_x, _, _  = preds
 
@@ -452,7 +452,7 @@ class CSPDiffusion(BaseModule):
             
             preds = self.decoder(time_emb, t_t_minus_05, x_t_minus_05, 
                             lattice_feats_t_minus_05, l_t_minus_05, batch.num_atoms, 
-                            batch.batch, site_symm_probs=symm_t_minus_05)
+                            batch.batch, site_symm_probs=symm_t_minus_05, edge_cache=edge_cache)
             
             pred_l, pred_x, pred_t, pred_symm  = preds
 
@@ -561,13 +561,40 @@ class CSPDiffusion(BaseModule):
             prog_bar=True,
         )
         
-        if (self.current_epoch + 1) % self.hparams.data.eval_every_epoch == 0 and batch_idx == 0:
-            # run a simpler evaluation
+        if (self.current_epoch + 1) % self.hparams.data.eval_every_epoch == 0 and batch_idx == 0 \
+                and not self.hparams.data.get('eval_async', False):
+            # run a simpler evaluation (with eval_async it runs in the AsyncGenEval callback instead)
             self.simple_gen_evaluation()
     
         return loss
 
     def simple_gen_evaluation(self):
+        # the evaluation stack (matminer, pymatgen matching, ...) is only imported when used
+        from scripts.compute_metrics import gen_eval_from_arrays
+        pred_crys_array_list = self.sample_gen_eval_arrays()
+        print(f"INFO: Done generating {self.hparams.data.eval_generate_samples} crystals (Epoch: {self.current_epoch + 1})")
+        gen_metrics = gen_eval_from_arrays(pred_crys_array_list, prop_device=self.device, **self.gen_eval_kwargs())
+        print(gen_metrics)
+        
+        self.log_dict(gen_metrics)
+
+    def gen_eval_kwargs(self):
+        val_set = self.hparams.data.datamodule.datasets.val[0]
+        # e.g. only ['validity'], which skips the fingerprints entirely and logs `valid_without_fp` instead of `valid`
+        metrics = self.hparams.data.get('eval_gen_metrics', None)
+        return {
+            'gt_csv_path': val_set.path,
+            'gt_crys_path': val_set.gt_crys_path,
+            'eval_model_name': self.hparams.data.eval_model_name,
+            'gt_prop_eval_path': val_set.gt_prop_eval_path,
+            'metrics': list(metrics) if metrics is not None else None,
+            'train_csv_path': self.hparams.data.datamodule.datasets.train.path,
+            'train_index_path': self.hparams.data.get('novelty_index_path', None),
+        }
+
+    def sample_gen_eval_arrays(self):
+        from scripts.generation import SampleDataset
+        from scripts.eval_utils import lattices_to_params_shape, get_crystals_list
         
         eval_model_name_dataset = {
             "mp20": "mp", # encompasses mp20, mpts52
@@ -611,26 +638,7 @@ class CSPDiffusion(BaseModule):
         
         # generated crystals
         kwargs = {"spacegroups": spacegroups, "site_symmetries": site_symmetries}
-        pred_crys_array_list = get_crystals_list(frac_coords, atom_types, lengths, angles, num_atoms, **kwargs)
-        gen_crys = p_map(lambda x: Crystal(x), pred_crys_array_list)
-        print(f"INFO: Done generating {self.hparams.data.eval_generate_samples} crystals (Epoch: {self.current_epoch + 1})")
-        
-        # ground truth crystals
-        if os.path.exists(self.hparams.data.datamodule.datasets.val[0].gt_crys_path):
-            gt_crys = torch.load(self.hparams.data.datamodule.datasets.val[0].gt_crys_path)
-        else:
-            csv = pd.read_csv(self.hparams.data.datamodule.datasets.val[0].path)
-            gt_crys = t_map(get_gt_crys_ori, csv['cif'])
-            torch.save(gt_crys, self.hparams.data.datamodule.datasets.val[0].gt_crys_path)
-            
-        print(f"INFO: Done reading ground truth crystals (Epoch: {self.current_epoch + 1})")
-        
-        gen_evaluator = GenEval(gen_crys, gt_crys, n_samples=0, eval_model_name=self.hparams.data.eval_model_name,
-                                gt_prop_eval_path=self.hparams.data.datamodule.datasets.val[0].gt_prop_eval_path)
-        gen_metrics = gen_evaluator.get_metrics()
-        print(gen_metrics)
-        
-        self.log_dict(gen_metrics)
+        return get_crystals_list(frac_coords, atom_types, lengths, angles, num_atoms, **kwargs)
     
     def test_step(self, batch: Any, batch_idx: int) -> torch.Tensor:
 
@@ -1,4 +1,5 @@
 import math, copy
+import functools
 import json
 import os
 import numpy as np
@@ -8,10 +9,11 @@ import pandas as pd
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch_geometric.data import DataLoader
+from torch_geometric.data import DataLoader, Batch
 
 
 from collections import defaultdict
+from contextlib import nullcontext
 from typing import Any, Dict, List
 import hydra
 import omegaconf
@@ -23,17 +25,14 @@ from tqdm import tqdm
 
 from pyxtal.symmetry import search_cloest_wp, Group
 
-from symmcd.common.utils import PROJECT_ROOT
 from symmcd.common.data_utils import (
     EPSILON, cart_to_frac_coords, mard, lengths_angles_to_volume, lattice_params_to_matrix_torch,
     frac_to_cart_coords, min_distance_sqr_pbc, lattice_ks_to_matrix_torch,
     sg_to_ks_mask, mask_ks, N_SPACEGROUPS)
 
 from symmcd.pl_modules.diff_utils import d_log_p_wrapped_normal
+from symmcd.common.profiling import PROFILER
 from symmcd.pl_modules.model import build_mlp
-from scripts.generation import SampleDataset
-from scripts.compute_metrics import Crystal, GenEval, get_gt_crys_ori
-from scripts.eval_utils import lattices_to_params_shape,  get_crystals_list
 
 
 MAX_ATOMIC_NUM=94
@@ -62,6 +61,8 @@ class DiscreteNoise(nn.Module):
         self.site_symm_pgs = SITE_SYMM_PGS
         self.site_symm_axes = SITE_SYMM_AXES
         self.max_atomic_num = MAX_ATOMIC_NUM
+        # checks that sync with the host at every sampling step
+        self.debug = False
 
     def ss_to_sections(self, ss):
         return [ss[..., i*self.site_symm_pgs:(i+1)*self.site_symm_pgs] for i in range(self.site_symm_axes)]
@@ -84,16 +85,17 @@ class DiscreteNoise(nn.Module):
             idx += ni
         return torch.cat(outs, -1)
 
-    def q_t(self, P, t):
-        alpha = self.beta_scheduler.alphas[t]
+    def q_t(self, P, t, s=None):
+        # transition from t - 1 to t, or from s to t when s is given
+        alpha = self.beta_scheduler.alphas[t] if s is None else self.sigma_sqr_ratio(s, t)
         num_classes = P.shape[-1]
         return alpha.view(-1,1,1)*torch.eye(num_classes, device=P.device)+(1-alpha.view(-1,1,1))*P
     
-    def q_t_atom(self, t):
-        return self.q_t(self.P_a, t)
+    def q_t_atom(self, t, s=None):
+        return self.q_t(self.P_a, t, s)
 
-    def q_t_ss(self, t, sgs):
-        return [self.q_t(self.P_ss[i][sgs], t) for i in range(len(self.P_ss))]
+    def q_t_ss(self, t, sgs, s=None):
+        return [self.q_t(self.P_ss[i][sgs], t, s) for i in range(len(self.P_ss))]
 
     def q_t_bar(self, P, t):
         alpha_bar = self.beta_scheduler.alphas_cumprod[t]
@@ -129,6 +131,11 @@ class DiscreteNoise(nn.Module):
             outs.append(F.one_hot(torch.multinomial(site_symms[..., idx:idx+ni], 1).reshape(-1), ni).float())
             idx += ni
         return torch.cat(outs, 1)
+
+    def sample_categorical(self, probs):
+        # the draw of torch.multinomial(probs, 1), without its input checks on the host
+        q = torch.empty_like(probs).exponential_(1)
+        return (probs / q).argmax(dim=-1)
     
     def sample_limit_dist(self, node_mask, sgs):
         """ Sample from the limit distribution of the diffusion process"""
@@ -157,22 +164,22 @@ class DiscreteNoise(nn.Module):
         '''
         bs, n = node_mask.shape
         # The masked rows should define probability distributions as well
-        prob_a[~node_mask] = 1 / prob_a.shape[-1]
+        prob_a = prob_a.masked_fill(~node_mask.unsqueeze(-1), 1 / prob_a.shape[-1])
         prob_ss_list = self.ss_to_sections(prob_ss)
         #prob_ss_norm_list = []
         for i in range(SITE_SYMM_AXES):
-            prob_ss_list[i][~node_mask] = 1 / prob_ss_list[i].shape[-1]
+            prob_ss_list[i] = prob_ss_list[i].masked_fill(~node_mask.unsqueeze(-1), 1 / prob_ss_list[i].shape[-1])
         # Flatten the probability tensor to sample with multinomial
         prob_a = prob_a.reshape(bs * n, -1)       # (bs * n, dx_out)
         # Sample a
-        atom_t = prob_a.multinomial(1)                                  # (bs * n, 1)
+        atom_t = self.sample_categorical(prob_a)                        # (bs * n)
         atom_t = atom_t.reshape(bs, n)     # (bs, n)
         atom_t = F.one_hot(atom_t, num_classes=prob_a.shape[-1]).float()
         # Sample ss
         site_symm_t_list = []
         for i in range(SITE_SYMM_AXES):
             prob_ss_i = prob_ss_list[i].reshape(bs * n, -1)       # (bs * n, dx_out)
-            site_symm_t_i_cat = prob_ss_i.multinomial(1).reshape(bs, n)
+            site_symm_t_i_cat = self.sample_categorical(prob_ss_i).reshape(bs, n)
             site_symm_t_i =  F.one_hot(site_symm_t_i_cat, num_classes=self.site_symm_pgs).float()
             site_symm_t_list.append(site_symm_t_i)
         site_symm_t = torch.cat(site_symm_t_list, -1)
@@ -200,28 +207,36 @@ class DiscreteNoise(nn.Module):
         prod = Qtb @ X_t_transposed                 # bs, d0, N
         prod = prod.transpose(-1, -2)               # bs, N, d0
         denominator = prod.unsqueeze(-1)            # bs, N, d0, 
-        denominator[denominator == 0] = 1e-6
+        denominator = denominator.masked_fill(denominator == 0, 1e-6)
 
         out = numerator / denominator
         return out
 
-    def p_s_and_t_given_0_a(self, z_t_a, t, s):
+    def p_s_and_t_given_0_a(self, z_t_a, t, s, jump=False):
         Qtb_a = self.q_t_bar_atom(t)
         Qsb_a = self.q_t_bar_atom(s)
-        Qt_a = self.q_t_atom(t)
+        Qt_a = self.q_t_atom(t, s if jump else None)
         return self.p_s_and_t_given_0(z_t_a,Qt_a, Qsb_a, Qtb_a)
 
-    def p_s_and_t_given_0_ss(self, z_t_ss, t, s, sgs):
+    def p_s_and_t_given_0_ss(self, z_t_ss, t, s, sgs, jump=False):
         Qtb_ss = self.q_t_bar_ss(t, sgs)
         Qsb_ss = self.q_t_bar_ss(s, sgs)
-        Qt_ss = self.q_t_ss(t, sgs)
+        Qt_ss = self.q_t_ss(t, sgs, s if jump else None)
         p_s_and_t_given_0_site_symms = []#torch.zeros((list(z_t_ss.shape[:-1]) +  [27, 0]), device=z_t_ss.device)
         for i in range(len(self.P_ss)):
             p_s_and_t_given_0_site_symms.append(self.p_s_and_t_given_0(z_t_ss[i], Qt_ss[i], Qsb_ss[i], Qtb_ss[i]))
         return p_s_and_t_given_0_site_symms
 
-    def sample_zs_from_zt_and_pred(self, z_t_a, z_t_ss, pred_a, pred_ss, t, s, node_mask, sgs):
-        """Samples from zs ~ p(zs | zt). Only used during sampling. """
+    def sample_zs_from_zt_and_pred(self, z_t_a, z_t_ss, pred_a, pred_ss, t, s, node_mask, sgs, jump=False, allowed_a=None):
+        """Samples from zs ~ p(zs | zt). Only used during sampling. allowed_a (bs, d) restricts the atom types. """
+        prob_a, prob_ss = self.posterior_zs(z_t_a, z_t_ss, pred_a, pred_ss, t, s, sgs, jump)
+        if allowed_a is not None:
+            prob_a = self.mask_atom_types(prob_a, allowed_a)
+        sampled_a_s, sampled_ss_s = self.sample_discrete_features(prob_a, prob_ss, node_mask)
+        return sampled_a_s, sampled_ss_s
+
+    def posterior_zs(self, z_t_a, z_t_ss, pred_a, pred_ss, t, s, sgs, jump=False):
+        """Probabilities of p(zs | zt), s = t - 1 unless jump. """
 
         # Retrieve transitions matrix
         #Qtb_a = self.q_t_bar_atom(t)
@@ -233,15 +248,15 @@ class DiscreteNoise(nn.Module):
 
         # Normalize predictions for the categorical features
         z_t_ss_split = self.ss_to_sections(z_t_ss)
-        p_s_and_t_given_0_atom_types = self.p_s_and_t_given_0_a(z_t_a, t, s)
-        p_s_and_t_given_0_site_symms = self.p_s_and_t_given_0_ss(z_t_ss_split, t, s, sgs)
+        p_s_and_t_given_0_atom_types = self.p_s_and_t_given_0_a(z_t_a, t, s, jump)
+        p_s_and_t_given_0_site_symms = self.p_s_and_t_given_0_ss(z_t_ss_split, t, s, sgs, jump)
 
 
         # Dim of these two tensors: bs, N, d0, d_t-1
         #pred_a = F.softmax(pred_a, dim=-1)               # bs, n, d0
         weighted_a = pred_a.unsqueeze(-1) * p_s_and_t_given_0_atom_types         # bs, n, d0, d_t-1
         unnormalized_prob_a = weighted_a.sum(dim=2)                     # bs, n, d_t-1
-        unnormalized_prob_a[torch.sum(unnormalized_prob_a, dim=-1) == 0] = 1e-5
+        unnormalized_prob_a = unnormalized_prob_a.masked_fill(torch.sum(unnormalized_prob_a, dim=-1, keepdim=True) == 0, 1e-5)
         prob_a = unnormalized_prob_a / torch.sum(unnormalized_prob_a, dim=-1, keepdim=True)  # bs, n, d_t-1
 
         pred_ss_split = self.ss_to_sections(pred_ss)
@@ -250,16 +265,23 @@ class DiscreteNoise(nn.Module):
             #pred_ss_i = F.softmax(pred_ss_i, dim=-1)              # bs, n, d0
             weighted_ss = pred_ss_i.unsqueeze(-1) * p_s_and_t_given_0_site_symms_i         # bs, n, d0, d_t-1
             unnormalized_prob_ss = weighted_ss.sum(dim=2)                     # bs, n, d_t-1
-            unnormalized_prob_ss[torch.sum(unnormalized_prob_ss, dim=-1) == 0] = 1e-5
+            unnormalized_prob_ss = unnormalized_prob_ss.masked_fill(torch.sum(unnormalized_prob_ss, dim=-1, keepdim=True) == 0, 1e-5)
             prob_ss = unnormalized_prob_ss / torch.sum(unnormalized_prob_ss, dim=-1, keepdim=True)  # bs, n, d_t-1
             prob_ss_list.append(prob_ss)
         prob_ss = torch.cat(prob_ss_list, -1)
 
-        assert ((prob_a.sum(dim=-1) - 1).abs() < 1e-4).all()
-        assert ((prob_ss.sum(dim=-1) - len(prob_ss_list)).abs() < 1e-4).all()
+        if self.debug:
+            assert ((prob_a.sum(dim=-1) - 1).abs() < 1e-4).all()
+            assert ((prob_ss.sum(dim=-1) - len(prob_ss_list)).abs() < 1e-4).all()
 
-        sampled_a_s, sampled_ss_s = self.sample_discrete_features(prob_a, prob_ss, node_mask)
-        return sampled_a_s, sampled_ss_s
+        return prob_a, prob_ss
+
+    def mask_atom_types(self, prob_a, allowed_a):
+        """Probabilities of the atom types (bs, n, d) restricted to the allowed ones (bs, d), e.g. the elements of a composition. """
+        prob_a = prob_a * allowed_a.unsqueeze(1)
+        # uniform over the allowed types where the posterior has no mass on them
+        prob_a = torch.where(prob_a.sum(-1, keepdim=True) > 0, prob_a, allowed_a.unsqueeze(1).to(prob_a.dtype))
+        return prob_a / prob_a.sum(-1, keepdim=True)
 
     def discrete_loss(self, sample_a, sample_ss, pred_a, pred_ss):
         '''
@@ -274,10 +296,20 @@ class DiscreteNoise(nn.Module):
         loss_ss = torch.stack(losses).mean()
         return loss_a, loss_ss
 
+# marginals by path, loaded once per process, or set by load_bundle so that the files are not needed
+MARGINALS = {}
+
+
+def load_marginals(path):
+    if path not in MARGINALS:
+        MARGINALS[path] = torch.load(path)
+    return MARGINALS[path]
+
+
 class DiscreteNoiseMarginal(DiscreteNoise):
     def __init__(self, atom_marginals_path, ss_marginals_path, beta_scheduler):
-        atom_type_prior = torch.load(atom_marginals_path)
-        site_symm_prior_per_sg = torch.load(ss_marginals_path)
+        atom_type_prior = load_marginals(atom_marginals_path)
+        site_symm_prior_per_sg = load_marginals(ss_marginals_path)
         P_ss = nn.ParameterList([nn.Parameter(site_symm_prior_per_sg[i].unsqueeze(-2).expand(NUM_SPACEGROUPS, SITE_SYMM_PGS, SITE_SYMM_PGS).clone(), requires_grad=False) for i in range(SITE_SYMM_AXES)])
         P_a = nn.Parameter(atom_type_prior.unsqueeze(0).expand(MAX_ATOMIC_NUM, -1).clone(), requires_grad=False)
         super().__init__(atom_type_prior, site_symm_prior_per_sg, beta_scheduler, P_ss, P_a)
@@ -316,6 +348,73 @@ class DiscreteNoiseMasked(DiscreteNoise):
 
         return pred_a, pred_ss
 
+def per_crystal(coef, x):
+    # a 0-d coefficient as is, a (batch_size,) one viewed to broadcast over the crystals of x
+    return coef if coef.dim() == 0 else coef.view(-1, *[1] * (x.dim() - 1))
+
+
+def per_atom(coef, node2graph):
+    return coef if coef.dim() == 0 else coef[node2graph][:, None]
+
+
+def select_crystals(state, keep):
+    # the crystals of keep (bool, one per crystal) in a trajectory entry, which has per crystal and per atom tensors
+    keep_nodes = keep.repeat_interleave(state['num_atoms'])
+    return {k: v[keep] if k in ['num_atoms', 'lattices', 'ks', 'spacegroup'] else v[keep_nodes] for k, v in state.items()}
+
+
+@functools.lru_cache(maxsize=None)
+def wyckoff_site_symms(spacegroup):
+    # flattened site symmetries (num_wp, SITE_SYMM_DIM) and multiplicities of the Wyckoff positions of a space group
+    wps = list(SG_TO_WP_TO_SITE_SYMM[spacegroup].items())
+    return np.stack([np.asarray(site_symm).reshape(-1) for _, site_symm in wps]), np.array([wp.multiplicity for wp, _ in wps])
+
+
+def wyckoff_multiplicities(spacegroup, site_symm):
+    # multiplicities of the Wyckoff positions whose site symmetries agree the most with site_symm (n, SITE_SYMM_DIM)
+    site_symms, multiplicities = wyckoff_site_symms(spacegroup)
+    return multiplicities[(site_symm @ site_symms.T).argmax(-1)]
+
+
+def assign_composition(prob_a, multiplicities, counts):
+    """
+    Atom types (indices) of the n representatives of a crystal drawn from prob_a (n, d), under the constraint that
+    their counts weighted by the Wyckoff multiplicities are a multiple of counts (d,), the composition.
+    Representatives are drawn one by one among the types that still leave an exact assignment for the others.
+    Returns None when there is none, e.g. when the number of atoms of the cell is not a multiple of the formula.
+    """
+    elements = np.nonzero(counts)[0]
+    formula_counts = np.rint(counts[elements]).astype(int)
+    formula_counts = formula_counts // np.gcd.reduce(formula_counts)
+    multiplicities = [int(m) for m in multiplicities]
+    total = sum(multiplicities)
+    if total % formula_counts.sum() != 0:
+        return None
+
+    def take(remaining, j, m):
+        return remaining[:j] + (remaining[j] - m,) + remaining[j + 1:]
+
+    @functools.lru_cache(maxsize=None)
+    def feasible(i, remaining):
+        # whether representatives i, i + 1, ... can exactly fill the remaining counts
+        if i == len(multiplicities):
+            return not any(remaining)
+        m = multiplicities[i]
+        return any(feasible(i + 1, take(remaining, j, m)) for j in range(len(remaining)) if remaining[j] >= m)
+
+    remaining = tuple((formula_counts * (total // formula_counts.sum())).tolist())
+    if not feasible(0, remaining):
+        return None
+    types = np.empty(len(multiplicities), dtype=int)
+    for i, m in enumerate(multiplicities):
+        options = [j for j in range(len(remaining)) if remaining[j] >= m and feasible(i + 1, take(remaining, j, m))]
+        p = prob_a[i, elements[options]] + 1e-12
+        j = options[np.random.choice(len(options), p=p / p.sum())]
+        types[i] = elements[j]
+        remaining = take(remaining, j, m)
+    return types
+
+
 def find_num_atoms(dummy_ind, total_num_atoms):
     # num_atoms states how many atoms are there in each crystal (num_repr + dummy origin)
     actual_num_atoms = []
@@ -409,6 +508,7 @@ def modify_frac_coords(traj:Dict, spacegroups:List[int], num_repr:List[int]) ->
                 wp_projection_dists.append(wp_projection_dist)
         
         total_atoms += num_repr[index]
+    PROFILER.count('modify_frac_coords/representatives', int(total_atoms))
     
     traj['frac_coords'] = torch.cat([torch.from_numpy(x) for x in updated_frac_coords]).to(device)
     traj['atom_types'] = torch.cat([torch.from_numpy(x) for x in updated_atom_types]).to(device)
@@ -480,12 +580,15 @@ class CSPDiffusion(BaseModule):
         self.keep_coords = self.hparams.cost_coord < 1e-5
         self.use_ks = self.hparams.use_ks
         self.discrete_noise = self.init_discrete_noise(self.hparams.prior)
+        self.discrete_noise.debug = self.hparams.get('debug_sampling', False)
 
     def on_train_start(self):
+        metrics = self.hparams.data.get('eval_gen_metrics', None)
         log_dict = {
             'comp_valid': 0,
             'struct_valid': 0,
-            'valid': 0
+            # the name GenEval logs validity under when it only computes validity
+            'valid_without_fp' if metrics is not None and set(metrics) <= {'validity'} else 'valid': 0
         }
         self.log_dict(
             log_dict,
@@ -597,185 +700,505 @@ class CSPDiffusion(BaseModule):
             'loss_symm' : loss_symm,
         }
 
-    @torch.no_grad()
-    def sample(self, batch, diff_ratio = 1.0, step_lr = 1e-5):
+    def to_dense_nodes(self, x, ctx):
+        # to_dense_batch with the node positions computed once per batch
+        out = x.new_zeros(ctx['batch_size'] * ctx['n_max'], x.shape[-1])
+        return out.index_copy(0, ctx['dense_index'], x).view(ctx['batch_size'], ctx['n_max'], -1)
 
+    def from_dense_nodes(self, x, ctx):
+        return x.flatten(end_dim=1).index_select(0, ctx['dense_index'])
 
-        batch_size = batch.num_graphs
+    def sample_step(self, t, x_t, l_t, k_t, t_t, symm_t, ctx):
+        """
+        One corrector-predictor step from t to t - ctx['stride'] (1 by default), t is a 0-d long tensor, or a
+        (batch_size,) one with a timestep per crystal (see ContinuousBatchSampler).
+        Shapes are static and there is no host synchronization, so the step can be compiled or captured in a CUDA graph.
+        """
+        return self.sample_step_with_probs(t, x_t, l_t, k_t, t_t, symm_t, ctx)[0]
+
+    def sample_step_with_probs(self, t, x_t, l_t, k_t, t_t, symm_t, ctx):
+        # sample_step, also returning the dense probabilities of the atom types for degenerate_crystals
+        x_s, l_s, k_s, prob_a, prob_ss = self.reverse_step(t, x_t, l_t, k_t, t_t, symm_t, ctx)
+        with PROFILER.timer('sample/discrete_sampling'):
+            t_s, symm_s = self.discrete_noise.sample_discrete_features(prob_a, prob_ss, ctx['node_mask'])
+        return (x_s, l_s, k_s, self.from_dense_nodes(t_s, ctx), self.from_dense_nodes(symm_s, ctx)), prob_a
+
+    def dummy_type(self):
+        # index of the dummy type in the atom type probabilities: the mask token of the masked prior, the last class of
+        # the decoder (max_atoms=MAX_ATOMIC_NUM+mask_token). None without the masked prior, which has no such class
+        return self.discrete_noise.max_atomic_num - 1 if self.hparams.prior == 'masked' else None
+
+    def dummy_atoms(self, atom_types):
+        # atoms of the dummy type (bool per atom) given their one-hot types or type probabilities: those dropped by
+        # finalize_sample, also used by ContinuousBatchSampler.evict. No atom with the marginal prior (no dummy type)
+        dummy = self.dummy_type()
+        if dummy is None:
+            return torch.zeros(atom_types.shape[:-1], dtype=torch.bool, device=atom_types.device)
+        return atom_types.argmax(dim=-1) == dummy
+
+    def degenerate_crystals(self, state, prob_a, s, ctx, max_length=1000., collapse_t=None, collapse_prob=0.99):
+        """
+        Crystals of the state at timestep s that would be discarded at the end of sampling: lattices that are not finite
+        or have lengths above max_length (rejected by Crystal), coordinates that are not finite, and, from collapse_t
+        (a tenth of the timesteps by default) on, crystals whose atoms all have the dummy type (dummy_type, the type
+        dropped by finalize_sample) with probability at least collapse_prob (empty crystals). The marginal prior has no
+        dummy type and no empty crystals, so there only the first two criteria apply. s is an int or a (batch_size,) tensor, returns a bool per crystal.
+        """
+        x_s, l_s, k_s = state[:3]
+        collapse_t = self.beta_scheduler.timesteps // 10 if collapse_t is None else collapse_t
+
+        diverged = ~torch.isfinite(l_s).all(-1).all(-1) | (l_s.norm(dim=-1) > max_length).any(-1)
+        if self.use_ks:
+            diverged = diverged | ~torch.isfinite(k_s).all(-1)
+        bad_coords = scatter((~torch.isfinite(x_s).all(-1)).float(), ctx['node2graph'], dim=0,
+                             dim_size=ctx['batch_size'], reduce='max') > 0
+        dummy = self.dummy_type()
+        if dummy is None:
+            return diverged | bad_coords
+        dummy_prob = prob_a[..., dummy]
+        collapsed = ((dummy_prob >= collapse_prob) | ~ctx['node_mask']).all(-1) & torch.as_tensor(s <= collapse_t, device=self.device)
+        return diverged | bad_coords | collapsed
+
+    def constrain_composition(self, state, prob_a, batch, ctx):
+        """
+        The state at t = 0 with the atom types drawn again from prob_a so that the composition of every crystal,
+        counting the atoms of the Wyckoff positions of its sampled site symmetries, is a multiple of batch.composition,
+        and whether such an assignment exists for every crystal (bool, batch_size). The atom types of the crystals
+        without one are left as sampled, sample reports them in infeasible_index.
+        The assignment runs on the host, with a single transfer of the batch.
+        """
+        x_0, l_0, k_0, t_0, symm_0 = state
+        prob_a = prob_a[ctx['node_mask']].cpu().numpy()
+        site_symm = symm_0.reshape(-1, SITE_SYMM_AXES, self.discrete_noise.site_symm_pgs)[..., :SITE_SYMM_PGS]
+        site_symm = site_symm.flatten(-2, -1).cpu().numpy()
+        counts = batch.composition.reshape(batch.num_graphs, -1).cpu().numpy()
+        types = t_0.argmax(-1).cpu().numpy()
+        start = 0
+        feasible = np.ones(batch.num_graphs, dtype=bool)
+        for i, (num_atoms, spacegroup) in enumerate(zip(batch.num_atoms.tolist(), batch.spacegroup.tolist())):
+            end = start + num_atoms
+            assigned = assign_composition(prob_a[start:end], wyckoff_multiplicities(spacegroup, site_symm[start:end]), counts[i])
+            if assigned is None:
+                feasible[i] = False
+            else:
+                types[start:end] = assigned
+            start = end
+        PROFILER.count('sample/composition_infeasible', int((~feasible).sum()))
+        t_0 = F.one_hot(torch.from_numpy(types).to(self.device), num_classes=t_0.shape[-1]).to(t_0.dtype)
+        return (x_0, l_0, k_0, t_0, symm_0), torch.from_numpy(feasible).to(self.device)
 
+    def compact_sample(self, batch, state, ctx, keep):
+        """
+        The batch, state and sampling context restricted to the crystals of keep (bool, one per crystal).
+        """
+        keep_nodes = keep[ctx['node2graph']]
+        x_t, l_t, k_t, t_t, symm_t = state
+        state = (x_t[keep_nodes], l_t[keep], k_t[keep], t_t[keep_nodes], symm_t[keep_nodes])
+        batch = Batch.from_data_list(batch.index_select(keep.nonzero().squeeze(-1).tolist())).to(self.device)
+        with PROFILER.timer('sample/to_dense_batch'):
+            _, node_mask = to_dense_batch(batch.batch, batch.batch, fill_value=0)
         ks_mask, ks_add = sg_to_ks_mask(batch.spacegroup)
-        k_T = torch.randn([batch_size, 6]).to(self.device)
-        k_T = mask_ks(k_T, ks_mask, ks_add)
-        l_T = lattice_ks_to_matrix_torch(k_T)
-        x_T = torch.rand([batch.num_nodes, 3]).to(self.device)
+        kwargs = {k: ctx[k] for k in ['stride', 'deterministic'] if k in ctx}
+        ctx = self.sample_context(batch, node_mask, ks_mask, ks_add, ctx['x_T'][keep_nodes], ctx['l_T'][keep],
+                                  ctx['k_T'][keep], ctx['step_lr'], **kwargs)
+        return batch, state, ctx
 
-        _, node_mask = to_dense_batch(batch.batch, batch.batch, fill_value=0)
-        t_T, symm_T = self.discrete_noise.sample_limit_dist(node_mask, batch.spacegroup)
-        t_T = t_T[node_mask]
-        symm_T = symm_T[node_mask]
+    def reverse_step(self, t, x_t, l_t, k_t, t_t, symm_t, ctx):
+        """
+        sample_step up to the discrete sampling: returns the continuous updates and the dense (batch_size, n_max, .)
+        probabilities of the atom types and site symmetries at s = t - ctx['stride'].
+        With ctx['deterministic'] the continuous updates are their means (no noise), as used for distillation.
+        """
+        stride = ctx.get('stride', 1)
+        s = t - stride
+        times = t.expand(ctx['batch_size'])
+        time_emb = torch.cat([self.time_embedding(times), ctx['spacegroup_emb']], dim=-1)
+
+        alphas_cumprod = self.beta_scheduler.alphas_cumprod[t]
+        if stride == 1:
+            alphas = self.beta_scheduler.alphas[t]
+            sigmas = self.beta_scheduler.sigmas[t]
+        else:
+            # the same ancestral update for a jump from t to s
+            alphas = alphas_cumprod / self.beta_scheduler.alphas_cumprod[s]
+            sigmas = torch.sqrt((1 - alphas) * (1 - self.beta_scheduler.alphas_cumprod[s]) / (1 - alphas_cumprod))
+
+        # coefficients of the atoms and of the crystals, broadcast when there is one timestep per crystal
+        sigma_x = per_atom(self.sigma_scheduler.sigmas[t], ctx['node2graph'])
+        sigma_norm = per_atom(self.sigma_scheduler.sigmas_norm[t], ctx['node2graph'])
+
+        x_T, l_T, k_T = ctx['x_T'], ctx['l_T'], ctx['k_T']
+        lattice_T = k_T if self.use_ks else l_T
+        c0 = per_crystal(1.0 / torch.sqrt(alphas), lattice_T)
+        c1 = per_crystal((1 - alphas) / torch.sqrt(1 - alphas_cumprod), lattice_T)
+        sigmas = per_crystal(sigmas, lattice_T)
 
         if self.keep_coords:
-            x_T = batch.frac_coords
+            x_t = x_T
 
         if self.keep_lattice:
-            k_T = batch.ks
-            l_T = lattice_ks_to_matrix_torch(k_T) if self.use_ks else lattice_params_to_matrix_torch(batch.lengths, batch.angles)
+            l_t = l_T
+            k_t = k_T
 
-        traj = {self.beta_scheduler.timesteps : {
-            'num_atoms' : batch.num_atoms,
-            'atom_types' : t_T,
-            'site_symm' : symm_T,
-            'frac_coords' : x_T % 1.,
-            'lattices' : l_T,
-            'ks' : k_T,
-            'spacegroup': batch.spacegroup,
-        }}
+        # no noise at the last step, as a factor instead of a branch on t
+        noise = (s > 0).to(x_T.dtype) * (0. if ctx.get('deterministic', False) else 1.)
+        noise_x = per_atom(noise, ctx['node2graph'])
+        noise_lattice = per_crystal(noise, lattice_T)
 
-        for t in tqdm(range(self.beta_scheduler.timesteps, 0, -1)):
+        # Corrector
+        rand_k = torch.randn_like(k_T) * noise_lattice
+        rand_x = torch.randn_like(x_T) * noise_x
 
-            times = torch.full((batch_size, ), t, device = self.device)
+        step_size = ctx['step_lr'] * (sigma_x / self.sigma_scheduler.sigma_begin) ** 2
+        std_x = torch.sqrt(2 * step_size)
 
-            # get diffusion timestep embeddings, concatenated with spacegroup condition    
-            spacegroup_emb = self.spacegroup_embedding(batch.sg_condition.reshape(-1, SG_CONDITION_DIM))
-            time_emb = torch.cat([self.time_embedding(times), spacegroup_emb], dim=-1)
+        lattice_feats_t = k_t if self.use_ks else l_t
+        with PROFILER.timer('sample/decoder'):
+            _, pred_x, _, _ = self.decoder(time_emb, t_t, x_t,
+                                                  lattice_feats_t, l_t, ctx['num_atoms'],
+                                                  ctx['node2graph'], site_symm_probs=symm_t, edge_cache=ctx['edge_cache'])
 
-            alphas = self.beta_scheduler.alphas[t]
-            alphas_cumprod = self.beta_scheduler.alphas_cumprod[t]
+        pred_x = pred_x * torch.sqrt(sigma_norm)
 
-            sigmas = self.beta_scheduler.sigmas[t]
-            sigma_x = self.sigma_scheduler.sigmas[t]
-            sigma_norm = self.sigma_scheduler.sigmas_norm[t]
+        x_t_minus_05 = x_t - step_size * pred_x + std_x * rand_x if not self.keep_coords else x_t
 
-            c0 = 1.0 / torch.sqrt(alphas)
-            c1 = (1 - alphas) / torch.sqrt(1 - alphas_cumprod)
+        l_t_minus_05 = l_t
+        k_t_minus_05 = k_t
 
-            x_t = traj[t]['frac_coords']
-            l_t = traj[t]['lattices']
-            t_t = traj[t]['atom_types']
-            symm_t = traj[t]['site_symm']
-            k_t = traj[t]['ks']
+        t_t_minus_05 = t_t
 
+        symm_t_minus_05 = symm_t
 
-            if self.keep_coords:
-                x_t = x_T
 
-            if self.keep_lattice:
-                l_t = l_T
-                k_t = k_T
+        # Predictor
+        if self.use_ks:
+            rand_k = torch.randn_like(k_T) * noise_lattice
+        else:
+            rand_l = torch.randn_like(l_T) * noise_lattice
 
-            # Corrector
-            rand_k = torch.randn_like(k_T) if t > 1 else torch.zeros_like(k_T) 
-            rand_x = torch.randn_like(x_T) if t > 1 else torch.zeros_like(x_T)
+        rand_x = torch.randn_like(x_T) * noise_x
 
-            step_size = step_lr * (sigma_x / self.sigma_scheduler.sigma_begin) ** 2
-            std_x = torch.sqrt(2 * step_size)
+        adjacent_sigma_x = per_atom(self.sigma_scheduler.sigmas[s], ctx['node2graph'])
+        step_size = (sigma_x ** 2 - adjacent_sigma_x ** 2)
+        std_x = torch.sqrt((adjacent_sigma_x ** 2 * (sigma_x ** 2 - adjacent_sigma_x ** 2)) / (sigma_x ** 2))
+        lattice_feats_t_minus_05 = k_t_minus_05 if self.use_ks else l_t_minus_05
 
-            lattice_feats_t = k_t if self.use_ks else l_t
-            _, pred_x, _, _ = self.decoder(time_emb, t_t, x_t, 
-                                                  lattice_feats_t, l_t, batch.num_atoms, 
-                                                  batch.batch, site_symm_probs=symm_t)
+        with PROFILER.timer('sample/decoder'):
+            pred_l, pred_x, pred_t_logit, pred_symm_logit = self.decoder(time_emb, t_t_minus_05, x_t_minus_05,
+                                                        lattice_feats_t_minus_05, l_t_minus_05, ctx['num_atoms'],
+                                                        ctx['node2graph'], site_symm_probs=symm_t_minus_05, edge_cache=ctx['edge_cache'])
 
-            pred_x = pred_x * torch.sqrt(sigma_norm)
+        # Convert logits to probabilities
+        pred_t = F.softmax(pred_t_logit, -1)
+        pred_symm = F.softmax(self.discrete_noise.reshape_ss(pred_symm_logit), -1).flatten(-2, -1)
+        if self.hparams.prior == 'masked':
+            pred_t, pred_symm = self.discrete_noise.sub_predictions(pred_t, pred_symm, t_t_minus_05, symm_t_minus_05)
 
-            x_t_minus_05 = x_t - step_size * pred_x + std_x * rand_x if not self.keep_coords else x_t
+        pred_t = self.to_dense_nodes(pred_t, ctx)
+        pred_symm = self.to_dense_nodes(pred_symm, ctx)
+        pred_x = pred_x * torch.sqrt(sigma_norm)
 
-            l_t_minus_05 = l_t
-            k_t_minus_05 = k_t
+        x_t_minus_1 = x_t_minus_05 - step_size * pred_x + std_x * rand_x if not self.keep_coords else x_t
 
-            t_t_minus_05 = t_t
+        if self.use_ks:
+            k_t_minus_1 = c0 * (k_t_minus_05 - c1 * pred_l) + sigmas * rand_k if not self.keep_lattice else k_t
+            k_t_minus_1 = mask_ks(k_t_minus_1, ctx['ks_mask'], ctx['ks_add'])
+            l_t_minus_1 = lattice_ks_to_matrix_torch(k_t_minus_1) if not self.keep_lattice else l_t
+        else:
+            l_t_minus_1 = c0 * (l_t_minus_05 - c1 * pred_l) + sigmas * rand_l if not self.keep_lattice else l_t
+            k_t_minus_1 = k_t
+        with PROFILER.timer('sample/discrete_posterior'):
+            t_t_minus_05 = self.to_dense_nodes(t_t_minus_05, ctx)
+            symm_t_minus_05 = self.to_dense_nodes(symm_t_minus_05, ctx)
+            prob_t, prob_symm = self.discrete_noise.posterior_zs(t_t_minus_05, symm_t_minus_05, pred_t, pred_symm, times, times - stride, ctx['spacegroup'], jump = stride != 1)
+            if 'allowed_types' in ctx:
+                prob_t = self.discrete_noise.mask_atom_types(prob_t, ctx['allowed_types'])
+
+        return x_t_minus_1 % 1., l_t_minus_1, k_t_minus_1, prob_t, prob_symm
+
+    def capture_sample_step(self, state, ctx, warmup=3):
+        """
+        Records sample_step in a CUDA graph. The returned step copies its inputs into the static buffers of the graph
+        and replays it, the outputs are cloned since the next replay overwrites them.
+        """
+        static_t = torch.full((), self.beta_scheduler.timesteps, dtype=torch.long, device=self.device)
+        static_state = [x.clone() for x in state]
+        # warmup on a side stream before the capture, as required by torch.cuda.graph
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(warmup):
+                self.sample_step(static_t, *static_state, ctx)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            static_out = self.sample_step(static_t, *static_state, ctx)
+
+        def step(t, *args):
+            static_t.copy_(t)
+            for buffer, x in zip(static_state, args[:len(static_state)]):
+                buffer.copy_(x)
+            graph.replay()
+            return tuple(out.clone() for out in static_out)
+
+        return step
+
+    def init_sample(self, batch, step_lr, **kwargs):
+        """
+        Initial state (frac_coords, lattices, ks, atom_types, site_symm) of the reverse process and the context of
+        sample_step, i.e. everything that does not change across steps.
+        """
+        batch_size = batch.num_graphs
 
-            symm_t_minus_05 = symm_t
+        ks_mask, ks_add = sg_to_ks_mask(batch.spacegroup)
+        k_T = torch.randn([batch_size, 6]).to(self.device)
+        k_T = mask_ks(k_T, ks_mask, ks_add)
+        l_T = lattice_ks_to_matrix_torch(k_T)
+        x_T = torch.rand([batch.num_nodes, 3]).to(self.device)
 
+        with PROFILER.timer('sample/to_dense_batch'):
+            _, node_mask = to_dense_batch(batch.batch, batch.batch, fill_value=0)
+        t_T, symm_T = self.discrete_noise.sample_limit_dist(node_mask, batch.spacegroup)
+        t_T = t_T[node_mask]
+        symm_T = symm_T[node_mask]
 
-            # Predictor
-            if self.use_ks:
-                rand_k = torch.randn_like(k_T) if t > 1 else torch.zeros_like(k_T)
-            else:
-                rand_l = torch.randn_like(l_T) if t > 1 else torch.zeros_like(l_T)
+        if self.keep_coords:
+            x_T = batch.frac_coords
+
+        if self.keep_lattice:
+            k_T = batch.ks
+            l_T = lattice_ks_to_matrix_torch(k_T) if self.use_ks else lattice_params_to_matrix_torch(batch.lengths, batch.angles)
 
-            #rand_t = torch.randn_like(t_T) if t > 1 else torch.zeros_like(t_T)
-            #rand_symm = torch.randn_like(symm_T) if t > 1 else torch.zeros_like(symm_T)
-            rand_x = torch.randn_like(x_T) if t > 1 else torch.zeros_like(x_T)
+        ctx = self.sample_context(batch, node_mask, ks_mask, ks_add, x_T, l_T, k_T, step_lr, **kwargs)
+        return (x_T % 1., l_T, k_T, t_T, symm_T), ctx
 
-            adjacent_sigma_x = self.sigma_scheduler.sigmas[t-1] 
-            step_size = (sigma_x ** 2 - adjacent_sigma_x ** 2)
-            std_x = torch.sqrt((adjacent_sigma_x ** 2 * (sigma_x ** 2 - adjacent_sigma_x ** 2)) / (sigma_x ** 2))   
-            lattice_feats_t_minus_05 = k_t_minus_05 if self.use_ks else l_t_minus_05
+    def sample_context(self, batch, node_mask, ks_mask, ks_add, x_T, l_T, k_T, step_lr, **kwargs):
+        """
+        Everything sample_step needs that does not change across steps, kwargs are added as is (e.g. stride).
+        x_T, l_T and k_T are used as the frozen coordinates / lattices and for the shapes of the noise.
+        """
+        # fully connected edges are built once, with frozen coordinates their distance embedding is reused as well
+        reuse_edges = self.keep_coords and (self.decoder.edge_style == 'fc' or self.keep_lattice)
+        edge_cache = {'frozen_coords': reuse_edges}
+        if self.decoder.edge_style == 'fc' or reuse_edges:
+            self.decoder.embed_edges(batch.num_atoms, x_T, l_T, batch.batch, edge_cache)
+        if 'composition' in batch:
+            # composition-constrained sampling, only the elements of the composition (and the mask type) are allowed
+            allowed_types = batch.composition.reshape(batch.num_graphs, -1) > 0
+            num_types = self.discrete_noise.P_a.shape[-1]
+            kwargs['allowed_types'] = torch.cat(
+                [allowed_types, allowed_types.new_ones(batch.num_graphs, num_types - allowed_types.shape[1])], dim=-1)
 
-            pred_l, pred_x, pred_t_logit, pred_symm_logit = self.decoder(time_emb, t_t_minus_05, x_t_minus_05, 
-                                                        lattice_feats_t_minus_05, l_t_minus_05, batch.num_atoms, 
-                                                        batch.batch, site_symm_probs=symm_t_minus_05)
+        return {
+            'batch_size': batch.num_graphs,
+            'n_max': node_mask.shape[1],
+            'dense_index': node_mask.flatten().nonzero().squeeze(-1),
+            'node_mask': node_mask,
+            'num_atoms': batch.num_atoms,
+            'node2graph': batch.batch,
+            'spacegroup': batch.spacegroup,
+            'spacegroup_emb': self.spacegroup_embedding(batch.sg_condition.reshape(-1, SG_CONDITION_DIM)),
+            'ks_mask': ks_mask,
+            'ks_add': ks_add,
+            'x_T': x_T,
+            'l_T': l_T,
+            'k_T': k_T,
+            'step_lr': step_lr,
+            'edge_cache': edge_cache,
+            **kwargs,
+        }
 
-            # Convert logits to probabilities
-            pred_t = F.softmax(pred_t_logit, -1)
-            pred_symm = F.softmax(self.discrete_noise.reshape_ss(pred_symm_logit), -1).flatten(-2, -1)
-            if self.hparams.prior == 'masked':
-                pred_t, pred_symm = self.discrete_noise.sub_predictions(pred_t, pred_symm, t_t_minus_05, symm_t_minus_05)
+    def noise_batch(self, batch, t, step_lr = 1e-5, **kwargs):
+        """
+        State of the reverse process at timestep t (0-d long tensor), obtained by noising the crystals of batch
+        as in forward, and its sample_step context.
+        """
+        times = t.expand(batch.num_graphs)
+        atom_types, node_mask = to_dense_batch(batch.atom_types - 1, batch.batch, fill_value=0)
+        if self.hparams.prior == 'masked':
+            site_symm = torch.cat([batch.site_symm, torch.zeros_like(batch.site_symm)[..., :1]], dim=-1)
+        else:
+            site_symm = batch.site_symm
+        site_symms, _ = to_dense_batch(site_symm.flatten(-2, -1), batch.batch, fill_value=0)
+        alphas_cumprod = self.beta_scheduler.alphas_cumprod[t]
+        sigma_x = self.sigma_scheduler.sigmas[t]
 
-            pred_t, _ = to_dense_batch(pred_t, batch.batch, fill_value=0)
-            pred_symm, _ = to_dense_batch(pred_symm, batch.batch, fill_value=0)
-            pred_x = pred_x * torch.sqrt(sigma_norm)
+        ks_mask, ks_add = sg_to_ks_mask(batch.spacegroup)
+        k_t = batch.ks
+        if self.use_ks:
+            k_t = torch.sqrt(alphas_cumprod) * batch.ks + torch.sqrt(1. - alphas_cumprod) * torch.randn_like(batch.ks)
+            k_t = mask_ks(k_t, ks_mask, ks_add)
+            l_t = lattice_ks_to_matrix_torch(k_t)
+        else:
+            lattices = lattice_params_to_matrix_torch(batch.lengths, batch.angles)
+            l_t = torch.sqrt(alphas_cumprod) * lattices + torch.sqrt(1. - alphas_cumprod) * torch.randn_like(lattices)
+        x_t = (batch.frac_coords + sigma_x * torch.randn_like(batch.frac_coords)) % 1.
 
-            x_t_minus_1 = x_t_minus_05 - step_size * pred_x + std_x * rand_x if not self.keep_coords else x_t
+        if self.keep_coords:
+            x_t = batch.frac_coords
 
-            if self.use_ks:
-                k_t_minus_1 = c0 * (k_t_minus_05 - c1 * pred_l) + sigmas * rand_k if not self.keep_lattice else k_t
-                k_t_minus_1 = mask_ks(k_t_minus_1, ks_mask, ks_add)
-                l_t_minus_1 = lattice_ks_to_matrix_torch(k_t_minus_1) if not self.keep_lattice else l_t
-            else:
-                l_t_minus_1 = c0 * (l_t_minus_05 - c1 * pred_l) + sigmas * rand_l if not self.keep_lattice else l_t
-                k_t_minus_1 = k_t
-            t_t_minus_05, _ = to_dense_batch(t_t_minus_05, batch.batch, fill_value=0)
-            symm_t_minus_05, _ = to_dense_batch(symm_t_minus_05, batch.batch, fill_value=0)
-            t_t_minus_1, symm_t_minus_1 = self.discrete_noise.sample_zs_from_zt_and_pred(t_t_minus_05, symm_t_minus_05, pred_t, pred_symm, times, times-1, node_mask, batch.spacegroup)
-            #t_t_minus_1 = c0 * (t_t_minus_05 - c1 * pred_t) + sigmas * rand_t
-            #symm_t_minus_1 = c0 * (symm_t_minus_05 - c1 * pred_symm) + sigmas * rand_symm
-            t_t_minus_1 = t_t_minus_1[node_mask]
-            symm_t_minus_1 = symm_t_minus_1[node_mask]
-
-            traj[t - 1] = {
+        if self.keep_lattice:
+            k_t = batch.ks
+            l_t = lattice_ks_to_matrix_torch(k_t) if self.use_ks else lattice_params_to_matrix_torch(batch.lengths, batch.angles)
+
+        atom_types_onehot = F.one_hot(atom_types, num_classes=self.discrete_noise.max_atomic_num).float()
+        atom_type_probs = self.discrete_noise.apply_atom_noise(atom_types_onehot, times)
+        site_symm_probs = self.discrete_noise.apply_site_symm_noise(site_symms, times, batch.spacegroup)
+        t_t, symm_t = self.discrete_noise.sample_discrete_features(atom_type_probs, site_symm_probs, node_mask)
+
+        ctx = self.sample_context(batch, node_mask, ks_mask, ks_add, x_t, l_t, k_t, step_lr, **kwargs)
+        return (x_t, l_t, k_t, t_t[node_mask], symm_t[node_mask]), ctx
+
+    def finalize_sample(self, final, spacegroup, num_atoms):
+        """
+        Crystals from the state at t = 0 (a dict as in the trajectory of sample): dummy atoms and empty crystals are
+        removed and the asymmetric units are expanded with the predicted site symmetries.
+        """
+        # drop all dummy elements (see dummy_atoms)
+        dummy_ind = self.dummy_atoms(final['atom_types']).long()
+        final['frac_coords'] = final['frac_coords'][(1 - dummy_ind).bool()]
+        final['atom_types'] = final['atom_types'][(1 - dummy_ind).bool()]
+        final['site_symm'] = final['site_symm'][(1 - dummy_ind).bool()]
+        if self.hparams.prior == 'masked':
+            # Get rid of masking dimension
+            final['site_symm'] = final['site_symm'].reshape(-1, SITE_SYMM_AXES, self.discrete_noise.site_symm_pgs)[..., :SITE_SYMM_PGS].flatten(-2, -1)
+        # find for each crystal how many non-dummy atoms are there
+        with PROFILER.timer('sample/find_num_atoms'):
+            final['num_atoms'] = find_num_atoms(dummy_ind, num_atoms).to(self.device)
+        # remove lattices and ks for empty crystals corresponding to num_atoms = 0
+        empty_crystals = (final['num_atoms'] == 0).long()
+        # positions in the batch of the crystals that are kept
+        final['crystal_index'] = (1 - empty_crystals).nonzero().squeeze(-1).to(self.device)
+        final['ks'] = final['ks'][(1 - empty_crystals).bool()]
+        final['lattices'] = final['lattices'][(1 - empty_crystals).bool()]
+        print(f"Number of empty crystals generated: {empty_crystals.sum().item()}/{len(num_atoms)}")
+        PROFILER.count('sample/empty_crystals', empty_crystals.sum().item())
+        
+        # use predicted site symmetry to create copies of atoms
+        # frac coords, atom types and num atoms removed for empty crystals in modify_frac_coords()
+        with PROFILER.timer('sample/modify_frac_coords'):
+            final = modify_frac_coords(final, spacegroup, final['num_atoms'])
+        
+        # sanity checks for size of tensors
+        #assert final['frac_coords'].size(0) == final['atom_types'].size(0) == final['num_atoms'].sum()
+        #assert final['ks'].size(0) == final['lattices'].size(0) == final['num_atoms'].size(0)
+
+        return final
+
+    @torch.no_grad()
+    def sample(self, batch, diff_ratio = 1.0, step_lr = 1e-5, step_mode = 'eager', num_steps = None, prune_every = 0, prune_kwargs = None):
+        """
+        step_mode: 'eager', 'compile' (torch.compile of sample_step) or 'cuda_graph' (sample_step replayed from a CUDA graph)
+        num_steps: number of reverse steps, a divisor of the timesteps. Defaults to model.sample_steps, set on distilled
+        models, and to all timesteps otherwise.
+        prune_every: every prune_every steps, the crystals found by degenerate_crystals (with prune_kwargs) are dropped
+        from the batch, 0 to disable. The outputs then only hold the remaining crystals, see crystal_index and pruned_index.
+        With batch.composition, a (batch_size, MAX_ATOMIC_NUM) vector of counts per atom type, the atom types are
+        restricted to its elements at every step and assigned at the last one so that the composition is reached
+        (see constrain_composition). The positions in the input batch of the crystals for which the sampled site
+        symmetries admit no such assignment, and which do not have the composition, are given by infeasible_index.
+        """
+
+        batch_size = batch.num_graphs
+        num_steps = num_steps or self.hparams.get('sample_steps', None) or self.beta_scheduler.timesteps
+        if self.beta_scheduler.timesteps % num_steps != 0:
+            raise ValueError(f'num_steps={num_steps} does not divide the {self.beta_scheduler.timesteps} timesteps')
+        stride = self.beta_scheduler.timesteps // num_steps
+        if prune_every > 0 and step_mode != 'eager':
+            raise ValueError('pruning changes the shapes of the batch, it only runs with eager steps')
+        with PROFILER.timer('sample/init'):
+            state, ctx = self.init_sample(batch, step_lr, stride=stride)
+        x_T, l_T, k_T, t_T, symm_T = state
+        PROFILER.count('sample/crystals', batch_size)
+
+        traj = {self.beta_scheduler.timesteps : {
+            'num_atoms' : batch.num_atoms,
+            'atom_types' : t_T,
+            'site_symm' : symm_T,
+            'frac_coords' : x_T,
+            'lattices' : l_T,
+            'ks' : k_T,
+            'spacegroup': batch.spacegroup,
+        }}
+
+        if step_mode == 'eager':
+            step = self.sample_step
+        elif step_mode == 'compile':
+            step = torch.compile(self.sample_step, dynamic=False)
+        elif step_mode == 'cuda_graph':
+            if 'fc_edges' not in ctx['edge_cache'] and 'edges' not in ctx['edge_cache']:
+                raise ValueError('knn edges change with the coordinates and cannot be captured in a CUDA graph')
+            with PROFILER.timer('sample/capture'), PROFILER.pause():
+                step = self.capture_sample_step(state, ctx)
+        else:
+            raise ValueError(f'Unknown step_mode {step_mode}')
+        # indexing a device tensor instead of creating one from t at every step
+        timesteps = torch.arange(self.beta_scheduler.timesteps + 1, device=self.device)
+        # positions in the input batch of the crystals still sampled, at every step, and of the pruned crystals
+        active = torch.arange(batch_size, device=self.device)
+        traj_active = {self.beta_scheduler.timesteps: active}
+        pruned = []
+        infeasible = active.new_zeros(0)
+
+        for step_index, t in enumerate(tqdm(range(self.beta_scheduler.timesteps, 0, -stride))):
+
+            prune = prune_every > 0 and (step_index + 1) % prune_every == 0
+            constrain = 'allowed_types' in ctx and t == stride
+            if prune or constrain:
+                with PROFILER.timer('sample/step'):
+                    state, prob_a = self.sample_step_with_probs(timesteps[t], *state, ctx)
+            if constrain:
+                with PROFILER.timer('sample/composition'):
+                    state, feasible = self.constrain_composition(state, prob_a, batch, ctx)
+                    infeasible = active[~feasible]
+            if prune:
+                with PROFILER.timer('sample/prune'):
+                    degenerate = self.degenerate_crystals(state, prob_a, t - stride, ctx, **(prune_kwargs or {}))
+                    # the batch is never emptied, the last crystals are discarded at the end as before
+                    if degenerate.any() and not degenerate.all():
+                        pruned.append(active[degenerate])
+                        active = active[~degenerate]
+                        batch, state, ctx = self.compact_sample(batch, state, ctx, ~degenerate)
+                        PROFILER.count('sample/pruned', int(degenerate.sum()))
+            if not (prune or constrain):
+                # compiled and captured steps are timed as a whole
+                with PROFILER.timer('sample/step'), PROFILER.pause() if step_mode != 'eager' else nullcontext():
+                    state = step(timesteps[t], *state, ctx)
+            x_t_minus_1, l_t_minus_1, k_t_minus_1, t_t_minus_1, symm_t_minus_1 = state
+            traj_active[t - stride] = active
+
+            traj[t - stride] = {
                 'num_atoms' : batch.num_atoms,
                 'atom_types' : t_t_minus_1,
                 'site_symm' : symm_t_minus_1,
-                'frac_coords' : x_t_minus_1 % 1.,
+                'frac_coords' : x_t_minus_1,
                 'lattices' : l_t_minus_1,
                 'ks' : k_t_minus_1,
                 'spacegroup' : batch.spacegroup,
             }
+        if len(pruned) > 0:
+            # the trajectories of the pruned crystals are dropped from the earlier steps as well
+            for i in traj:
+                traj[i] = select_crystals(traj[i], torch.isin(traj_active[i], active))
+            print(f"Number of degenerate crystals pruned: {sum(len(p) for p in pruned)}/{batch_size}")
+
         traj_stack = {
             'num_atoms' : batch.num_atoms,
-            'atom_types' : torch.stack([traj[i]['atom_types'] for i in range(self.beta_scheduler.timesteps, -1, -1)]).argmax(dim=-1) + 1,
-            'site_symm' : torch.stack([traj[i]['site_symm'] for i in range(self.beta_scheduler.timesteps, -1, -1)]),
-            'all_frac_coords' : torch.stack([traj[i]['frac_coords'] for i in range(self.beta_scheduler.timesteps, -1, -1)]),
-            'all_lattices' : torch.stack([traj[i]['lattices'] for i in range(self.beta_scheduler.timesteps, -1, -1)]),
-            'all_ks': torch.stack([traj[i]['ks'] for i in range(self.beta_scheduler.timesteps, -1, -1)]),
-            'all_spacegroup': torch.stack([traj[i]['spacegroup'] for i in range(self.beta_scheduler.timesteps, -1, -1)]),
+            'atom_types' : torch.stack([traj[i]['atom_types'] for i in range(self.beta_scheduler.timesteps, -1, -stride)]).argmax(dim=-1) + 1,
+            'site_symm' : torch.stack([traj[i]['site_symm'] for i in range(self.beta_scheduler.timesteps, -1, -stride)]),
+            'all_frac_coords' : torch.stack([traj[i]['frac_coords'] for i in range(self.beta_scheduler.timesteps, -1, -stride)]),
+            'all_lattices' : torch.stack([traj[i]['lattices'] for i in range(self.beta_scheduler.timesteps, -1, -stride)]),
+            'all_ks': torch.stack([traj[i]['ks'] for i in range(self.beta_scheduler.timesteps, -1, -stride)]),
+            'all_spacegroup': torch.stack([traj[i]['spacegroup'] for i in range(self.beta_scheduler.timesteps, -1, -stride)]),
         }
 
 
-        # drop all dummy elements (atom types = MAX_ATOMIC_NUM)
-        dummy_ind = (traj[0]['atom_types'].argmax(dim=-1) == self.discrete_noise.max_atomic_num).long()
-        traj[0]['frac_coords'] = traj[0]['frac_coords'][(1 - dummy_ind).bool()]
-        traj[0]['atom_types'] = traj[0]['atom_types'][(1 - dummy_ind).bool()]
-        traj[0]['site_symm'] = traj[0]['site_symm'][(1 - dummy_ind).bool()]
-        if self.hparams.prior == 'masked':
-            # Get rid of masking dimension
-            traj[0]['site_symm'] = traj[0]['site_symm'].reshape(-1, SITE_SYMM_AXES, self.discrete_noise.site_symm_pgs)[..., :SITE_SYMM_PGS].flatten(-2, -1)
-        # find for each crystal how many non-dummy atoms are there
-        traj[0]['num_atoms'] = find_num_atoms(dummy_ind, batch.num_atoms).to(self.device)
-        # remove lattices and ks for empty crystals corresponding to num_atoms = 0
-        empty_crystals = (traj[0]['num_atoms'] == 0).long()
-        traj[0]['ks'] = traj[0]['ks'][(1 - empty_crystals).bool()]
-        traj[0]['lattices'] = traj[0]['lattices'][(1 - empty_crystals).bool()]
-        print(f"Number of empty crystals generated: {empty_crystals.sum().item()}/{batch_size}")
-        
-        # use predicted site symmetry to create copies of atoms
-        # frac coords, atom types and num atoms removed for empty crystals in modify_frac_coords()
-        traj[0] = modify_frac_coords(traj[0], batch.spacegroup, traj[0]['num_atoms'])
-        
-        # sanity checks for size of tensors
-        #assert traj[0]['frac_coords'].size(0) == traj[0]['atom_types'].size(0) == traj[0]['num_atoms'].sum()
-        #assert traj[0]['ks'].size(0) == traj[0]['lattices'].size(0) == traj[0]['num_atoms'].size(0)
+        traj[0] = self.finalize_sample(traj[0], batch.spacegroup, batch.num_atoms)
+        # positions in the input batch
+        traj[0]['crystal_index'] = active[traj[0]['crystal_index']]
+        traj[0]['pruned_index'] = torch.cat(pruned) if len(pruned) > 0 else active.new_zeros(0)
+        traj[0]['infeasible_index'] = infeasible
 
         return traj[0], traj_stack
 
@@ -821,13 +1244,40 @@ class CSPDiffusion(BaseModule):
             prog_bar=True,
         )
 
-        if (self.current_epoch + 1) % self.hparams.data.eval_every_epoch == 0 and batch_idx == 0:
-            # run a simpler evaluation
+        if (self.current_epoch + 1) % self.hparams.data.eval_every_epoch == 0 and batch_idx == 0 \
+                and not self.hparams.data.get('eval_async', False):
+            # run a simpler evaluation (with eval_async it runs in the AsyncGenEval callback instead)
             self.simple_gen_evaluation()
 
         return loss
 
     def simple_gen_evaluation(self):
+        # the evaluation stack (matminer, pymatgen matching, ...) is only imported when used
+        from scripts.compute_metrics import gen_eval_from_arrays
+        pred_crys_array_list = self.sample_gen_eval_arrays()
+        print(f"INFO: Done generating {self.hparams.data.eval_generate_samples} crystals (Epoch: {self.current_epoch + 1})")
+        gen_metrics = gen_eval_from_arrays(pred_crys_array_list, prop_device=self.device, **self.gen_eval_kwargs())
+        print(gen_metrics)
+        
+        self.log_dict(gen_metrics)
+
+    def gen_eval_kwargs(self):
+        val_set = self.hparams.data.datamodule.datasets.val[0]
+        # e.g. only ['validity'], which skips the fingerprints entirely and logs `valid_without_fp` instead of `valid`
+        metrics = self.hparams.data.get('eval_gen_metrics', None)
+        return {
+            'gt_csv_path': val_set.path,
+            'gt_crys_path': val_set.gt_crys_path,
+            'eval_model_name': self.hparams.data.eval_model_name,
+            'gt_prop_eval_path': val_set.gt_prop_eval_path,
+            'metrics': list(metrics) if metrics is not None else None,
+            'train_csv_path': self.hparams.data.datamodule.datasets.train.path,
+            'train_index_path': self.hparams.data.get('novelty_index_path', None),
+        }
+
+    def sample_gen_eval_arrays(self, num_steps=None):
+        from scripts.generation import SampleDataset
+        from scripts.eval_utils import lattices_to_params_shape, get_crystals_list
         
         eval_model_name_dataset = {
             "mp20": "mp", # encompasses mp20, mpsa52
@@ -849,9 +1299,8 @@ class CSPDiffusion(BaseModule):
         site_symmetries = []
         for idx, batch in enumerate(test_loader):
 
-            if torch.cuda.is_available():
-                batch.cuda()
-            outputs, traj = self.sample(batch, step_lr = 1e-5)
+            batch = batch.to(self.device)
+            outputs, traj = self.sample(batch, step_lr = 1e-5, num_steps = num_steps)
             del traj
             frac_coords.append(outputs['frac_coords'].detach().cpu())
             num_atoms.append(outputs['num_atoms'].detach().cpu())
@@ -871,26 +1320,7 @@ class CSPDiffusion(BaseModule):
         
         # generated crystals
         kwargs = {"spacegroups": spacegroups, "site_symmetries": site_symmetries}
-        pred_crys_array_list = get_crystals_list(frac_coords, atom_types, lengths, angles, num_atoms, **kwargs)
-        gen_crys = p_map(lambda x: Crystal(x), pred_crys_array_list)
-        print(f"INFO: Done generating {self.hparams.data.eval_generate_samples} crystals (Epoch: {self.current_epoch + 1})")
-        
-        # ground truth crystals
-        if os.path.exists(self.hparams.data.datamodule.datasets.val[0].gt_crys_path):
-            gt_crys = torch.load(self.hparams.data.datamodule.datasets.val[0].gt_crys_path)
-        else:
-            csv = pd.read_csv(self.hparams.data.datamodule.datasets.val[0].path)
-            gt_crys = t_map(get_gt_crys_ori, csv['cif'])
-            torch.save(gt_crys, self.hparams.data.datamodule.datasets.val[0].gt_crys_path)
-            
-        print(f"INFO: Done reading ground truth crystals (Epoch: {self.current_epoch + 1})")
-        
-        gen_evaluator = GenEval(gen_crys, gt_crys, n_samples=0, eval_model_name=self.hparams.data.eval_model_name,
-                                gt_prop_eval_path=self.hparams.data.datamodule.datasets.val[0].gt_prop_eval_path)
-        gen_metrics = gen_evaluator.get_metrics()
-        print(gen_metrics)
-        
-        self.log_dict(gen_metrics)
+        return get_crystals_list(frac_coords, atom_types, lengths, angles, num_atoms, **kwargs)
 
     def test_step(self, batch: Any, batch_idx: int) -> torch.Tensor:
 
@@ -0,0 +1,97 @@
+import torch
+import pytorch_lightning as pl
+
+
+def wrapped_mse(a, b):
+    # fractional coordinates are compared on the torus
+    return (((a - b + 0.5) % 1.) - 0.5).pow(2).mean()
+
+
+def categorical_kl(p, q):
+    # KL(p || q) over the last dimension
+    return (p * (torch.log(p + 1e-20) - torch.log(q + 1e-20))).sum(-1)
+
+
+class ProgressiveDistillation(pl.LightningModule):
+    """
+    One stage of progressive distillation of the discrete CSPDiffusion sampler (Salimans & Ho, 2022): one student step
+    of stride 2 * teacher_stride is trained to match two deterministic teacher steps of stride teacher_stride.
+    The student is initialized from the teacher, which is frozen.
+    """
+    def __init__(self, teacher, student, teacher_stride, lr=1e-4, step_lr=1e-5,
+                 cost_lattice=1., cost_coord=1., cost_type=1., cost_symm=1.):
+        super().__init__()
+        self.save_hyperparameters(ignore=['teacher', 'student'])
+        self.teacher = teacher
+        self.student = student
+        self.teacher.requires_grad_(False)
+        self.teacher_stride = teacher_stride
+        self.student_stride = 2 * teacher_stride
+
+    def on_train_epoch_start(self):
+        self.teacher.eval()
+
+    def configure_optimizers(self):
+        return torch.optim.Adam(self.student.parameters(), lr=self.hparams.lr)
+
+    def sample_t(self):
+        # a timestep on the student grid
+        num_student_steps = self.teacher.beta_scheduler.timesteps // self.student_stride
+        k = torch.randint(1, num_student_steps + 1, (), device=self.device)
+        return k * self.student_stride
+
+    @torch.no_grad()
+    def teacher_target(self, batch, t, state, ctx):
+        teacher = self.teacher
+        x_t, l_t, k_t, t_t, symm_t = state
+        ctx = teacher.sample_context(batch, ctx['node_mask'], ctx['ks_mask'], ctx['ks_add'], x_t, l_t, k_t,
+                                     self.hparams.step_lr, stride=self.teacher_stride, deterministic=True)
+        x_s, l_s, k_s, prob_a, prob_ss = teacher.reverse_step(t, x_t, l_t, k_t, t_t, symm_t, ctx)
+        # the discrete posterior is not deterministic, the intermediate state is sampled from it
+        t_s, symm_s = teacher.discrete_noise.sample_discrete_features(prob_a, prob_ss, ctx['node_mask'])
+        t_s, symm_s = teacher.from_dense_nodes(t_s, ctx), teacher.from_dense_nodes(symm_s, ctx)
+        return teacher.reverse_step(t - self.teacher_stride, x_s, l_s, k_s, t_s, symm_s, ctx)
+
+    def distillation_loss(self, batch):
+        t = self.sample_t()
+        state, ctx = self.student.noise_batch(batch, t, self.hparams.step_lr,
+                                              stride=self.student_stride, deterministic=True)
+        target = self.teacher_target(batch, t, state, ctx)
+        pred = self.student.reverse_step(t, *state, ctx)
+
+        x_tar, l_tar, k_tar, prob_a_tar, prob_ss_tar = target
+        x_pred, l_pred, k_pred, prob_a_pred, prob_ss_pred = pred
+
+        loss_coord = wrapped_mse(x_pred, x_tar)
+        loss_lattice = torch.mean((k_pred - k_tar) ** 2) if self.student.use_ks else torch.mean((l_pred - l_tar) ** 2)
+        loss_type = self.student.from_dense_nodes(categorical_kl(prob_a_tar, prob_a_pred)[..., None], ctx).mean()
+        noise = self.student.discrete_noise
+        loss_symm = torch.stack([
+            self.student.from_dense_nodes(categorical_kl(p, q)[..., None], ctx).mean()
+            for p, q in zip(noise.ss_to_sections(prob_ss_tar), noise.ss_to_sections(prob_ss_pred))]).mean()
+
+        loss = (
+            self.hparams.cost_lattice * loss_lattice +
+            self.hparams.cost_coord * loss_coord +
+            self.hparams.cost_type * loss_type +
+            self.hparams.cost_symm * loss_symm
+        )
+
+        return {
+            'loss' : loss,
+            'loss_lattice' : loss_lattice,
+            'loss_coord' : loss_coord,
+            'loss_type' : loss_type,
+            'loss_symm' : loss_symm,
+        }
+
+    def training_step(self, batch, batch_idx):
+        output_dict = self.distillation_loss(batch)
+        self.log_dict(
+            {f'distill_{k}': v for k, v in output_dict.items()},
+            on_step=True,
+            on_epoch=True,
+            prog_bar=True,
+            batch_size=batch.num_graphs,
+        )
+        return output_dict['loss']
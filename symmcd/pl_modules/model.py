@@ -10,7 +10,6 @@ from torch.nn import functional as F
 from torch_scatter import scatter
 from tqdm import tqdm
 
-from symmcd.common.utils import PROJECT_ROOT
 from symmcd.common.data_utils import (
     EPSILON, cart_to_frac_coords, mard, lengths_angles_to_volume,
     frac_to_cart_coords, min_distance_sqr_pbc)
@@ -133,7 +132,6 @@ class CrystGNN_Supervise(BaseModule):
 
 
 
-@hydra.main(config_path=str(PROJECT_ROOT / "conf"), config_name="default")
 def main(cfg: omegaconf.DictConfig):
     model: pl.LightningModule = hydra.utils.instantiate(
         cfg.model,
@@ -146,4 +144,6 @@ def main(cfg: omegaconf.DictConfig):
 
 
 if __name__ == "__main__":
-    main()
+    # PROJECT_ROOT loads .env and changes the working directory, the decoders import this module
+    from symmcd.common.utils import PROJECT_ROOT
+    hydra.main(config_path=str(PROJECT_ROOT / "conf"), config_name="default")(main)()
@@ -19,6 +19,7 @@ from pytorch_lightning.loggers import WandbLogger
 from pytorch_lightning.strategies import DDPStrategy
 
 from symmcd.common.utils import log_hyperparameters, PROJECT_ROOT
+from symmcd.common.async_gen_eval import AsyncGenEval
 
 import wandb
 
@@ -26,6 +27,22 @@ torch.set_float32_matmul_precision('high')
 
 def build_callbacks(cfg: DictConfig, hydra_dir: Path) -> List[Callback]:
     callbacks: List[Callback] = []
+    # with asynchronous generation metrics the monitored metric arrives epochs late,
+    # so checkpoint selection on it is done by AsyncGenEval instead
+    eval_async = cfg.data.get('eval_async', False)
+
+    if eval_async:
+        hydra.utils.log.info("Adding callback <AsyncGenEval>")
+        callbacks.append(
+            AsyncGenEval(
+                dirpath=hydra_dir,
+                every_n_epochs=cfg.data.eval_every_epoch,
+                num_workers=cfg.data.get('eval_async_workers', 1),
+                device=cfg.data.get('eval_async_device', 'cpu'),
+                monitor=cfg.train.monitor_metric,
+                mode=cfg.train.monitor_metric_mode,
+            )
+        )
 
     if "lr_monitor" in cfg.logging:
         hydra.utils.log.info("Adding callback <LearningRateMonitor>")
@@ -36,7 +53,11 @@ def build_callbacks(cfg: DictConfig, hydra_dir: Path) -> List[Callback]:
             )
         )
 
-    if "early_stopping" in cfg.train:
+    if "early_stopping" in cfg.train and eval_async:
+        hydra.utils.log.warning(
+            f"EarlyStopping on {cfg.train.monitor_metric} is disabled with data.eval_async, "
+            f"the metric is only known epochs after the weights it scores")
+    elif "early_stopping" in cfg.train:
         hydra.utils.log.info("Adding callback <EarlyStopping>")
         callbacks.append(
             EarlyStopping(
@@ -49,10 +70,14 @@ def build_callbacks(cfg: DictConfig, hydra_dir: Path) -> List[Callback]:
 
     if "model_checkpoints" in cfg.train:
         hydra.utils.log.info("Adding callback <ModelCheckpoint>")
+        if eval_async:
+            hydra.utils.log.info(
+                f"ModelCheckpoint keeps the last {cfg.train.model_checkpoints.save_top_k} checkpoints, the best one "
+                f"on {cfg.train.monitor_metric} is kept in {hydra_dir / 'gen_eval'} (found by load_model)")
         callbacks.append(
             ModelCheckpoint(
                 dirpath=hydra_dir,
-                monitor=cfg.train.monitor_metric,
+                monitor=None if eval_async else cfg.train.monitor_metric,
                 mode=cfg.train.monitor_metric_mode,
                 save_top_k=cfg.train.model_checkpoints.save_top_k,
                 verbose=cfg.train.model_checkpoints.verbose,